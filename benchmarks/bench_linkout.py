@@ -0,0 +1,439 @@
+# Benchmarks for the LinkOut pipeline stages, on synthetic
+# (ucpms_id, eschol_id, pubmed_id) rows.
+#
+# Usage, from the repo root:
+#   python benchmarks/bench_linkout.py --sizes 10k,100k
+#   python benchmarks/bench_linkout.py --sizes 1M --stages render,logging_db_insert
+#   python benchmarks/bench_linkout.py --save-baseline
+#
+# Each stage reports wall time, rows per second and peak traced memory.
+# Rows are generated before each stage starts, so neither the time nor the
+# memory of generating them is counted; memory is measured in a second,
+# traced run of the stage, since tracing slows it down.
+# Results are compared against benchmarks/baselines.json, and
+# --save-baseline writes the current results there. The committed baseline
+# is from a default run (--sizes 10k,100k, SQLite, local FTP server);
+# rows/s depends on the machine, so on another one, save a baseline from
+# the commit you start from before comparing a change against it.
+#
+# Output is checked by the tests under tests/ (python -m pytest tests),
+# against files the scripts wrote before linkout_xml.
+#
+# Stand-ins: the logging DB stage runs against an in-memory SQLite table,
+# or a local MySQL database if --mysql-host etc. are given. The FTP stage
+# needs pyftpdlib for a local server, and is skipped without it.
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+# Shared modules live in the repo root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import linkout_csv
+import linkout_db
+import linkout_ftp
+import linkout_validate
+import linkout_xml
+from linkout_items import LinkOutItems
+
+baselines_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+regression_threshold = 0.20
+page_size = 20000
+size_suffixes = {'k': 1000, 'M': 1000 * 1000}
+eschol_id_chars = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+# =========================
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark the LinkOut pipeline stages.")
+    parser.add_argument('--sizes', default="10k,100k",
+                        help="Comma-separated row counts, e.g. 10k,100k,1M,5M.")
+    parser.add_argument('--stages', default=",".join(stages),
+                        help=f"Comma-separated stages to run (default: all of {', '.join(stages)}).")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="Store these results as the new baseline.")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="Skip the traced run that measures peak memory.")
+    parser.add_argument('--seed', type=int, default=7383)
+    parser.add_argument('--mysql-host')
+    parser.add_argument('--mysql-user')
+    parser.add_argument('--mysql-password')
+    parser.add_argument('--mysql-database',
+                        help="A scratch database; its linkout_items table is dropped and recreated.")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    selected_stages = args.stages.split(',')
+
+    results = {}
+    for size in sizes:
+        rows = list(generate_rows(size, args.seed))
+        for stage_name in selected_stages:
+            result = run_stage(stage_name, rows, args)
+            if result is None:
+                continue
+            key = f"{stage_name}/{size}"
+            results[key] = result
+            print(format_result(key, result))
+
+    baselines = load_baselines()
+    regressions = compare_to_baselines(results, baselines)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    if args.save_baseline:
+        baselines.update(results)
+        with open(baselines_file, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} baselines to {baselines_file}")
+
+    if regressions:
+        sys.exit(1)
+
+
+# =========================
+# Synthetic data
+def parse_size(size):
+    if size[-1] in size_suffixes:
+        return int(float(size[:-1]) * size_suffixes[size[-1]])
+    return int(size)
+
+
+def generate_rows(row_count, seed=7383):
+    rng = random.Random(seed)
+    for i in range(row_count):
+        yield {
+            'id': i + 1,
+            'ucpms_id': rng.randrange(1000000, 9999999),
+            'eschol_id': 'qt' + ''.join(rng.choices(eschol_id_chars, k=8)),
+            'pubmed_id': rng.randrange(10000000, 40000000)}
+
+
+# =========================
+# Stages: each takes (rows, args) and returns the number of rows
+# processed, or None to skip.
+def stage_chunk_into_n(rows, args):
+    pages = list(chunk_into_n(rows, page_size))
+    return sum(len(page) for page in pages)
+
+
+def chunk_into_n(full_list, n):
+    for i in range(0, len(full_list), n):
+        yield full_list[i:i + n]
+
+
+def stage_render(rows, args):
+    with tempfile.TemporaryDirectory() as output_dir:
+        for page_number, page in enumerate(iter_pages(rows, page_size)):
+            linkout_xml.write_resource_file(
+                f"{output_dir}/bench_{str(page_number).zfill(5)}.xml", linkout_xml.item_links(page))
+    return len(rows)
+
+
+def stage_render_paginated(rows, args):
+    with tempfile.TemporaryDirectory() as output_dir:
+        for page_number, (page, rendered_links) in enumerate(linkout_xml.paginate_items(rows)):
+            linkout_xml.write_rendered_resource_file(
+                f"{output_dir}/bench_{str(page_number).zfill(5)}.xml", rendered_links, len(page))
+    return len(rows)
+
+
+# Includes packing the rows into a LinkOutItems batch, which is where
+# its memory saving over lists of dicts shows up.
+def stage_render_columnar(rows, args):
+    items = LinkOutItems.from_items(rows)
+    with tempfile.TemporaryDirectory() as output_dir:
+        for page_number, page in enumerate(items.pages(page_size)):
+            page.write_resource_file(f"{output_dir}/bench_{str(page_number).zfill(5)}.xml")
+    return len(rows)
+
+
+# The ElementTree build submit_new_pubmed_items used before linkout_xml,
+# unchanged, as the speed reference.
+def stage_render_elementtree(rows, args):
+    with tempfile.TemporaryDirectory() as output_dir:
+        for page_number, page in enumerate(iter_pages(rows, page_size)):
+            with open(f"{output_dir}/bench_{str(page_number).zfill(5)}.xml", 'w') as f:
+                f.write(linkout_xml.doctype_header)
+                xml_data = create_xml_data(page)
+                ET.indent(xml_data, space="\t", level=0)
+                xml_string = ET.tostring(xml_data, encoding='unicode')
+                xml_string = xml_string.replace('&amp;', '&')
+                f.write(xml_string)
+    return len(rows)
+
+
+def create_xml_data(new_items):
+    link_set = ET.Element("LinkSet")
+
+    for item in new_items:
+        link = ET.SubElement(link_set, "Link")
+        ET.SubElement(link, "LinkId").text = item['eschol_id']
+        ET.SubElement(link, "ProviderId").text = "7383"
+        ET.SubElement(link, "IconUrl").text = "&icon.url;"
+
+        # Link > ObjectSelector
+        object_selector = ET.SubElement(link, "ObjectSelector")
+        ET.SubElement(object_selector, "Database").text = "PubMed"
+
+        # Link > ObjectSelector > ObjectList
+        object_list = ET.SubElement(object_selector, "ObjectList")
+        ET.SubElement(object_list, "ObjId").text = str(item['pubmed_id'])
+
+        # Link > ObjectURL
+        object_url = ET.SubElement(link, "ObjectUrl")
+        ET.SubElement(object_url, "Base").text = '&base.url;'
+        ET.SubElement(object_url, "Rule").text = item['eschol_id'][2:]
+        ET.SubElement(object_url, "UrlName").text = "Full text from University of California eScholarship"
+        ET.SubElement(object_url, "Attribute").text = "full-text PDF"
+
+    return link_set
+
+
+def write_batch_csv(file_name, rows):
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ucpms_id', 'eschol_id', 'pubmed_id'])
+        for row in rows:
+            writer.writerow([row['ucpms_id'], row['eschol_id'], row['pubmed_id']])
+
+
+def iter_pages(items, n):
+    page = []
+    for item in items:
+        page.append(item)
+        if len(page) == n:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+# Validates the files render_paginated writes. This stage's time includes
+# rendering them; compare it with render_paginated to get the validation cost.
+def stage_validate(rows, args):
+    with tempfile.TemporaryDirectory() as output_dir:
+        files = []
+        for page_number, (page, rendered_links) in enumerate(linkout_xml.paginate_items(rows)):
+            file_name = f"{output_dir}/bench_{str(page_number).zfill(5)}.xml"
+            linkout_xml.write_rendered_resource_file(file_name, rendered_links, len(page))
+            files.append(file_name)
+        if linkout_validate.validate_files(files):
+            raise AssertionError("Benchmark files failed validation.")
+    return len(rows)
+
+
+# This stage's time includes writing the CSV it reads.
+def stage_csv_ingest(rows, args):
+    with tempfile.TemporaryDirectory() as output_dir:
+        file_name = f"{output_dir}/batch.csv"
+        write_batch_csv(file_name, rows)
+        csv_reader = linkout_csv.CsvItemReader(file_name)
+        item_count = sum(len(batch) for batch in csv_reader)
+        if item_count != len(rows) or csv_reader.rejects:
+            raise AssertionError("linkout_csv didn't read back the benchmark rows.")
+    return len(rows)
+
+
+def stage_logging_db_insert(rows, args):
+    with open_logging_db(args) as mysql_conn, contextlib.redirect_stdout(io.StringIO()):
+        linkout_db.bulk_insert_linkout_items(mysql_conn, rows)
+    return len(rows)
+
+
+def stage_ftp_upload(rows, args):
+    try:
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+    except ImportError:
+        print("Skipping ftp_upload: pyftpdlib isn't installed.")
+        return None
+
+    ftp_logger = logging.getLogger('pyftpdlib')
+    ftp_logger.addHandler(logging.NullHandler())
+    ftp_logger.setLevel(logging.WARNING)
+    ftp_logger.propagate = False
+    with tempfile.TemporaryDirectory() as ftp_root, tempfile.TemporaryDirectory() as output_dir:
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('bench', 'bench', ftp_root, perm='elradfmwMT')
+        handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+        server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+
+        # This stage's time includes rendering the files to upload;
+        # compare it with the render stage to get the upload cost alone.
+        files = []
+        for page_number, page in enumerate(iter_pages(rows, page_size)):
+            file_name = f"{output_dir}/bench_{str(page_number).zfill(5)}.xml"
+            linkout_xml.write_resource_file(file_name, linkout_xml.item_links(page))
+            files.append(file_name)
+
+        env = {
+            'LINKOUT_FTP_URL': '127.0.0.1',
+            'LINKOUT_FTP_PORT': str(server.address[1]),
+            'LINKOUT_FTP_USER': 'bench',
+            'LINKOUT_FTP_PASSWORD': 'bench',
+            'LINKOUT_FTP_DIR': '/'}
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                linkout_ftp.upload_files(env, files)
+        finally:
+            server.close_all()
+
+    return len(rows)
+
+
+stages = {
+    'chunk_into_n': stage_chunk_into_n,
+    'render': stage_render,
+    'render_paginated': stage_render_paginated,
+    'render_columnar': stage_render_columnar,
+    'render_elementtree': stage_render_elementtree,
+    'validate': stage_validate,
+    'csv_ingest': stage_csv_ingest,
+    'logging_db_insert': stage_logging_db_insert,
+    'ftp_upload': stage_ftp_upload,
+}
+
+
+# =========================
+# Logging DB stand-ins
+@contextlib.contextmanager
+def open_logging_db(args):
+    if args.mysql_host:
+        import pymysql
+        mysql_conn = pymysql.connect(
+            host=args.mysql_host,
+            user=args.mysql_user,
+            password=args.mysql_password,
+            database=args.mysql_database,
+            cursorclass=pymysql.cursors.DictCursor)
+        with mysql_conn.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS linkout_items")
+            cursor.execute(linkout_items_ddl)
+    else:
+        mysql_conn = SQLiteLoggingDB()
+
+    try:
+        yield mysql_conn
+    finally:
+        mysql_conn.close()
+
+
+linkout_items_ddl = """
+    CREATE TABLE linkout_items (
+        id INTEGER PRIMARY KEY AUTO_INCREMENT,
+        ucpms_id INTEGER,
+        eschol_id VARCHAR(16) NOT NULL UNIQUE,
+        pubmed_id INTEGER,
+        submitted DATETIME NULL,
+        pubmed_filename VARCHAR(255) NULL)"""
+
+
+# Accepts the MySQL-flavored SQL linkout_db sends, for the statements
+# it needs here.
+class SQLiteLoggingDB:
+
+    def __init__(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(linkout_items_ddl.replace("AUTO_INCREMENT", "AUTOINCREMENT"))
+
+    def cursor(self):
+        return SQLiteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteCursor:
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cursor.close()
+
+    def execute(self, sql, params=()):
+        sql = sql.replace("INSERT IGNORE", "INSERT OR IGNORE").replace("%s", "?")
+        self.cursor.execute(sql, list(params))
+        return self.cursor.rowcount
+
+
+# =========================
+# Measurement and baselines
+def run_stage(stage_name, rows, args):
+    stage = stages[stage_name]
+
+    start = time.perf_counter()
+    processed = stage(rows, args)
+    seconds = time.perf_counter() - start
+    if processed is None:
+        return None
+
+    peak_bytes = 0
+    if not args.no_memory:
+        tracemalloc.start()
+        stage(rows, args)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(processed / seconds) if seconds > 0 else None,
+        'peak_memory_mb': round(peak_bytes / 1024 / 1024, 2)}
+
+
+def format_result(key, result):
+    return f"{key:<32} {result['seconds']:>10.3f}s " \
+           f"{result['rows_per_second'] or 0:>12,} rows/s " \
+           f"{result['peak_memory_mb']:>10.2f} MB peak"
+
+
+def load_baselines():
+    if not os.path.exists(baselines_file):
+        return {}
+    with open(baselines_file, 'r') as f:
+        return json.load(f)
+
+
+def compare_to_baselines(results, baselines):
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        if result['rows_per_second'] and baseline['rows_per_second'] \
+                and result['rows_per_second'] < baseline['rows_per_second'] * (1 - regression_threshold):
+            regressions.append(
+                f"{key}: {result['rows_per_second']:,} rows/s vs. baseline {baseline['rows_per_second']:,}")
+        if result['peak_memory_mb'] > baseline['peak_memory_mb'] * (1 + regression_threshold) + 1:
+            regressions.append(
+                f"{key}: {result['peak_memory_mb']} MB peak vs. baseline {baseline['peak_memory_mb']} MB")
+    return regressions
+
+
+# =========================
+if __name__ == '__main__':
+    main()
@@ -2,59 +2,132 @@
 # https://www.ncbi.nlm.nih.gov/books/NBK3812/
 
 from dotenv import dotenv_values
-import pymysql
-import pyodbc
+import argparse
+import datetime
+from itertools import islice
+import json
+import os
+import time
+import linkout_connections
+import linkout_db
+import linkout_metrics
+import linkout_sources
 import submit_new_pubmed_items
+from submitted_id_cache import SubmittedIdCache
 
 submission_threshold = 1000
 
+# Incremental enqueue vars
+watermark_file = "state/enqueue_watermark.json"
+watermark_lookback = datetime.timedelta(days=1)
+lookup_batch_size = 1000
+elements_fetch_size = 5000
+temp_table_batch_size = 10000
 
-# =========================
-# Get Connections
-def get_eschol_db_connection(env):
-    return pymysql.connect(
-        host=env['ESCHOL_DB_SERVER_PROD'],
-        user=env['ESCHOL_DB_USER_PROD'],
-        password=env['ESCHOL_DB_PASSWORD_PROD'],
-        database=env['ESCHOL_DB_DATABASE_PROD'],
-        cursorclass=pymysql.cursors.DictCursor)
-
-
-def get_logging_db_connection(env):
-    return pymysql.connect(
-        host=env['LOGGING_DB_SERVER'],
-        user=env['LOGGING_DB_USER'],
-        password=env['LOGGING_DB_PASSWORD'],
-        database=env['LOGGING_DB_DATABASE'],
-        cursorclass=pymysql.cursors.DictCursor)
-
-
-def get_elements_report_db_connection(env):
-    mssql_conn = pyodbc.connect(
-        driver=env['ELEMENTS_REPORTING_DB_DRIVER_PROD'],
-        server=(env['ELEMENTS_REPORTING_DB_SERVER_PROD'] + ',' + env['ELEMENTS_REPORTING_DB_PORT_PROD']),
-        database=env['ELEMENTS_REPORTING_DB_DATABASE_PROD'],
-        uid=env['ELEMENTS_REPORTING_DB_USER_PROD'],
-        pwd=env['ELEMENTS_REPORTING_DB_PASSWORD_PROD'],
-        trustservercertificate='yes')
-    mssql_conn.autocommit = True  # Required when queries use TRANSACTION
-    return mssql_conn
+# Merge mode vars
+merge_sources = ('elements', 'eschol', 'csv')
+conflicts_file = "output/enqueue_pmid_conflicts.csv"
 
 
 # =========================
-def main():
-    env = dotenv_values(".env")
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Enqueue new eScholarship pubmed items for LinkOut submission.")
+    parser.add_argument(
+        '--mode', choices=['incremental', 'reconcile', 'merge'], default='incremental',
+        help="incremental: only query Elements for records created since the "
+             "last run's watermark. reconcile: compare every Elements record "
+             "against the full list of submitted IDs. Incremental falls back "
+             "to reconcile when no watermark has been saved yet. merge: read "
+             "every source in --sources at once and merge them by eSchol ID, "
+             "holding back items whose sources disagree on the PMID.")
+    parser.add_argument(
+        '--sources', default=','.join(merge_sources),
+        help=f"Comma-separated sources for merge mode (default: {','.join(merge_sources)}).")
+    parser.add_argument(
+        '--csv-file', default=linkout_sources.batch_input_file,
+        help="The Elements batch CSV read by merge mode's csv source.")
+    parser.add_argument(
+        '--dedupe', choices=['server', 'local'], default='server',
+        help="server: filter out submitted IDs in the databases. local: sync "
+             "a local cache of submitted IDs from the logging DB and filter "
+             "candidates against it.")
+    parser.add_argument(
+        '--staging', choices=['indexed', 'heap'], default='indexed',
+        help="How reconcile mode with server dedupe stages submitted IDs in "
+             "Elements. indexed: a primary-keyed temp table loaded in sorted "
+             "batches, filtered with NOT EXISTS. heap: the old unkeyed temp "
+             "table filtered with NOT IN.")
+    args = parser.parse_args()
+    args.sources = args.sources.split(',')
+    unknown_sources = set(args.sources) - set(merge_sources)
+    if unknown_sources:
+        parser.error(f"Unknown sources: {', '.join(sorted(unknown_sources))}")
+    return args
 
-    # Get the pubs we've already submitted - returns a list of eschol_ids.
-    submitted_ids = get_previous_pubmed_submissions(env)
 
-    # Get newly-added eSchol pubmed items;
-    # Add them to the logging db
-    # Check the total number of enqueued items
-    new_pubmed_items = get_new_pmid_pubs(env, submitted_ids)
-    if new_pubmed_items:
-        total_enqueued = add_new_items_to_logging_db(env, new_pubmed_items)
+def main():
+    args = get_args()
+    env = dotenv_values(".env")
+    # submit_new_pubmed_items.main() runs inside this manager too,
+    # so it reuses the logging DB connection opened here.
+    with linkout_metrics.RunMetrics('enqueue_new_pubmed_items_elements', env) as metrics, \
+            linkout_connections.ConnectionManager(env):
+        enqueue_new_items(args, env, metrics)
+
+
+def enqueue_new_items(args, env, metrics):
+    watermark = load_watermark()
+    latest = LatestCreatedWhen()
+    merge = None
+
+    # Each mode builds a stream of new items; nothing is read from Elements
+    # until the logging DB insert below starts consuming it.
+    if args.mode == 'merge':
+        # Read every source at once, then filter out what's already logged
+        print(f"Merge mode: reading {', '.join(args.sources)} at once.")
+        merge = linkout_sources.SourceMerge(get_merge_sources(env, args, latest))
+        if args.dedupe == 'local':
+            new_pubmed_items = remove_cached_items(env, merge)
+        else:
+            new_pubmed_items = remove_logged_items(env, merge)
+    elif args.mode == 'incremental' and watermark is not None:
+        # Get Elements records created since the last run,
+        # minus any the logging DB already has.
+        since = watermark - watermark_lookback
+        print(f"Incremental mode: querying Elements records created since {since}.")
+        candidate_items = latest.track(iter_new_pmid_pubs_since(env, since))
+        if args.dedupe == 'local':
+            new_pubmed_items = remove_cached_items(env, candidate_items)
+        else:
+            new_pubmed_items = remove_logged_items(env, candidate_items)
+    elif args.dedupe == 'local':
+        # Get every Elements record and filter against the local cache
+        print("Reconcile mode: checking every Elements record against the local ID cache.")
+        new_pubmed_items = remove_cached_items(env, latest.track(iter_all_pmid_pubs(env)))
     else:
+        # Get the pubs we've already submitted - returns a list of eschol_ids.
+        print("Reconcile mode: checking every Elements record against the logging DB.")
+        with metrics.stage('get_previous_submissions'):
+            submitted_ids = get_previous_pubmed_submissions(env)
+        new_pubmed_items = latest.track(
+            iter_new_pmid_pubs(env, submitted_ids, staging=args.staging))
+
+    # Add the new items to the logging db as they stream in from Elements,
+    # then check the total number of enqueued items
+    with metrics.stage('elements_to_logging_db'):
+        new_item_count, total_enqueued = add_new_items_to_logging_db(env, new_pubmed_items)
+
+    # Only advance the watermark once the new items are safely logged
+    if latest.created_when is not None:
+        save_watermark(latest.created_when)
+
+    if merge is not None and merge.conflicts:
+        os.makedirs(os.path.dirname(conflicts_file), exist_ok=True)
+        merge.write_conflicts(conflicts_file)
+        print(f"{len(merge.conflicts)} eSchol IDs with conflicting PMIDs written to {conflicts_file}.")
+
+    if not new_item_count:
         print("No new pmid publications in eScholarship. Exiting.")
         exit(1)
 
@@ -67,91 +140,295 @@ def main():
         exit(1)
 
 
+# Passes items through, keeping the latest created_when seen,
+# which becomes the next run's watermark.
+class LatestCreatedWhen:
+
+    def __init__(self):
+        self.created_when = None
+
+    def track(self, items):
+        for item in items:
+            if self.created_when is None or item.created_when > self.created_when:
+                self.created_when = item.created_when
+            yield item
+
+
+# {source name: rows} for merge mode. Elements is read in full, like
+# reconcile mode, and its latest created_when still moves the watermark.
+def get_merge_sources(env, args, latest):
+    sources = {}
+    if 'elements' in args.sources:
+        sources['elements'] = latest.track(iter_all_pmid_pubs(env))
+    if 'eschol' in args.sources:
+        sources['eschol'] = linkout_sources.iter_eschol_items(env)
+    if 'csv' in args.sources:
+        sources['csv'] = linkout_sources.iter_csv_items(args.csv_file)
+    return sources
+
+
 # =========================
 def get_previous_pubmed_submissions(env):
-    mysql_conn = get_logging_db_connection(env)
+    submitted_pubs = linkout_connections.retry(env, 'logging_db', fetch_submitted_pubs)
+    submitted_ids = [i['eschol_id'] for i in submitted_pubs]
+    return submitted_ids
+
 
+def fetch_submitted_pubs(mysql_conn):
     # Get the Item IDs already submitted
     with mysql_conn.cursor() as cursor:
         print("Connected to the logging DB. Collecting previously-submitted IDs.")
         cursor.execute("SELECT eschol_id FROM linkout_items")
         submitted_pubs = cursor.fetchall()
-    mysql_conn.close()
+        linkout_metrics.count('db_round_trips')
+        linkout_metrics.count('rows', len(submitted_pubs))
+    return submitted_pubs
 
-    submitted_ids = [i['eschol_id'] for i in submitted_pubs]
-    return submitted_ids
 
+def iter_new_pmid_pubs(env, submitted_ids, staging='indexed'):
 
-def get_new_pmid_pubs(env, submitted_ids):
-
-    # connect to the mySql db
-    mssql_conn = get_elements_report_db_connection(env)
-    with mssql_conn.cursor() as cursor:
+    with linkout_connections.connection(env, 'elements_db') as mssql_conn, \
+            mssql_conn.cursor() as cursor:
         print("Connected to Elements Reporting DB.")
 
-        print("Creating temp table with submitted IDs.")
-        cursor.execute("CREATE TABLE #linkout_ids (id varchar(16))")
-        temp_table_insert = "INSERT INTO #linkout_ids (id) VALUES (?)"
-        cursor.fast_executemany = True  # enables bulk inserting in executemany
-        submitted_ids = [[s] for s in submitted_ids]  # Required format for executemany
-        cursor.executemany(temp_table_insert, submitted_ids)
-        mssql_conn.commit()
+        with linkout_metrics.stage('temp_table_load'):
+            if staging == 'heap':
+                load_heap_temp_table(mssql_conn, cursor, submitted_ids)
+                where_clause = "epr.[data source proprietary ID] not in (select li.id from #linkout_ids li)"
+            else:
+                load_indexed_temp_table(mssql_conn, cursor, submitted_ids)
+                where_clause = """not exists (
+                select 1 from #linkout_ids li
+                where li.id = epr.[data source proprietary ID])"""
 
         print("Querying Elements Reporting DB for new pubmed items")
-        get_new_eschol_pubmed_items = """
-            SET TRANSACTION ISOLATION LEVEL SNAPSHOT;
-            BEGIN TRANSACTION;
-            select
-                p.id as ucpms_id,
-                epr.[data source proprietary ID] as eschol_id,
-                ppr.[data source proprietary ID] as pubmed_id
-            from
-                publication p
-                    join [publication record] epr
-                        on p.id = epr.[publication id]
-                        and epr.[data source] = 'escholarship'
-                    join [publication record file] prf
-                        on epr.id = prf.[Publication Record ID]
-                        and prf.[index] = 0
-                    join [Publication Record] ppr
-                        on p.id = ppr.[publication id]
-                        and ppr.[data source] = 'pubmed'
-            where
-                epr.[data source proprietary ID]
-                    not in (select li.id from #linkout_ids li)
-            order by
-                ppr.[Created When];
-            COMMIT TRANSACTION;"""
-        cursor.execute(get_new_eschol_pubmed_items)
-
-        # pyodbc doesn't return dicts automatically, we have to make them ourselves
-        columns = [column[0] for column in cursor.description]
-        new_eschol_pubmed_items = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-    mssql_conn.close()
-
-    return new_eschol_pubmed_items
+        yield from iter_elements_rows(cursor, get_elements_pubmed_items_sql(where_clause))
+        drop_temp_table(cursor)
+
+
+# The connection goes back to the pool afterwards, where #linkout_ids
+# would otherwise outlive the query that needed it.
+def drop_temp_table(cursor):
+    cursor.execute("DROP TABLE #linkout_ids")
+    linkout_metrics.count('db_round_trips')
+
+
+def load_heap_temp_table(mssql_conn, cursor, submitted_ids):
+    print("Creating temp table with submitted IDs.")
+    cursor.execute("CREATE TABLE #linkout_ids (id varchar(16))")
+    temp_table_insert = "INSERT INTO #linkout_ids (id) VALUES (?)"
+    cursor.fast_executemany = True  # enables bulk inserting in executemany
+    submitted_ids = [[s] for s in submitted_ids]  # Required format for executemany
+    cursor.executemany(temp_table_insert, submitted_ids)
+    mssql_conn.commit()
+    linkout_metrics.count('db_round_trips', 2)
+
+
+# The IDs are deduplicated and inserted in key order, so the clustered
+# primary key only ever appends, temp_table_batch_size rows per executemany.
+# COLLATE DATABASE_DEFAULT matches the temp table (created in tempdb) to
+# the reporting DB's collation, so the join can seek on the key.
+def load_indexed_temp_table(mssql_conn, cursor, submitted_ids):
+    submitted_ids = sorted(set(submitted_ids))
+
+    print(f"Creating indexed temp table with {len(submitted_ids)} submitted IDs.")
+    cursor.execute("""
+        CREATE TABLE #linkout_ids (
+            id varchar(16) COLLATE DATABASE_DEFAULT NOT NULL PRIMARY KEY CLUSTERED)""")
+    linkout_metrics.count('db_round_trips')
+
+    temp_table_insert = "INSERT INTO #linkout_ids (id) VALUES (?)"
+    cursor.fast_executemany = True  # enables bulk inserting in executemany
+    for i in range(0, len(submitted_ids), temp_table_batch_size):
+        cursor.executemany(
+            temp_table_insert, [[s] for s in submitted_ids[i:i + temp_table_batch_size]])
+        linkout_metrics.count('db_round_trips')
+    mssql_conn.commit()
+
+    # Fresh statistics so the optimizer sizes the anti-join correctly
+    cursor.execute("UPDATE STATISTICS #linkout_ids")
+    linkout_metrics.count('db_round_trips')
+    linkout_metrics.count('rows', len(submitted_ids))
+
+
+def iter_new_pmid_pubs_since(env, since):
+    with linkout_connections.connection(env, 'elements_db') as mssql_conn, \
+            mssql_conn.cursor() as cursor:
+        print("Connected to Elements Reporting DB. Querying for recent pubmed items.")
+        yield from iter_elements_rows(cursor, get_elements_pubmed_items_sql(
+            "(epr.[Created When] > ? or ppr.[Created When] > ?)"), since, since)
+
+
+def iter_all_pmid_pubs(env):
+    with linkout_connections.connection(env, 'elements_db') as mssql_conn, \
+            mssql_conn.cursor() as cursor:
+        print("Connected to Elements Reporting DB. Querying for all pubmed items.")
+        yield from iter_elements_rows(cursor, get_elements_pubmed_items_sql("1 = 1"))
+
+
+# Streams every Elements pubmed item ordered by eschol_id, as dicts,
+# for a merge against linkout_items.
+def iter_pmid_pubs_by_eschol_id(env):
+    with linkout_connections.connection(env, 'elements_db') as mssql_conn, \
+            mssql_conn.cursor() as cursor:
+        print("Connected to Elements Reporting DB. Streaming pubmed items by eSchol ID.")
+        rows = iter_elements_rows(cursor, get_elements_pubmed_items_sql(
+            "1 = 1", order_by="epr.[data source proprietary ID], ppr.[Created When]"))
+
+        columns = None
+        for row in rows:
+            if columns is None:
+                columns = [column[0] for column in cursor.description]
+            yield dict(zip(columns, row))
+
+
+# Runs the query and reads its results elements_fetch_size rows at a time,
+# yielding pyodbc rows as they arrive. Rows are tuples in the query's
+# column order (ucpms_id, eschol_id, pubmed_id, created_when) that also
+# allow access by name (row.eschol_id), so no per-row dict is built.
+#
+# The rows are consumed while they stream in, so the query is timed here
+# rather than as a stage of its own: elements_query_seconds is the time to
+# the first rows, elements_fetch_seconds the time spent waiting on the rest.
+def iter_elements_rows(cursor, sql, *params):
+    start = time.monotonic()
+    query_seconds = None
+    fetch_seconds = 0.0
+    try:
+        cursor.execute(sql, *params)
+        while True:
+            fetch_start = time.monotonic()
+            rows = cursor.fetchmany(elements_fetch_size)
+            if query_seconds is None:
+                query_seconds = time.monotonic() - start
+            else:
+                fetch_seconds += time.monotonic() - fetch_start
+            if not rows:
+                break
+            linkout_metrics.count('db_round_trips')
+            linkout_metrics.count('rows', len(rows))
+            yield from rows
+
+        # Step through the rest of the batch, so its COMMIT TRANSACTION runs
+        # before the connection is used for anything else
+        while cursor.nextset():
+            pass
+    finally:
+        if query_seconds is not None:
+            linkout_metrics.count('elements_query_seconds', round(query_seconds, 3))
+            linkout_metrics.count('elements_fetch_seconds', round(fetch_seconds, 3))
+
+
+# An item becomes eligible once both its eSchol and pubmed records exist,
+# so its created_when is the later of the two.
+def get_elements_pubmed_items_sql(where_clause, order_by="ppr.[Created When]"):
+    return f"""
+        SET TRANSACTION ISOLATION LEVEL SNAPSHOT;
+        BEGIN TRANSACTION;
+        select
+            p.id as ucpms_id,
+            epr.[data source proprietary ID] as eschol_id,
+            ppr.[data source proprietary ID] as pubmed_id,
+            case when epr.[Created When] > ppr.[Created When]
+                then epr.[Created When]
+                else ppr.[Created When]
+            end as created_when
+        from
+            publication p
+                join [publication record] epr
+                    on p.id = epr.[publication id]
+                    and epr.[data source] = 'escholarship'
+                join [publication record file] prf
+                    on epr.id = prf.[Publication Record ID]
+                    and prf.[index] = 0
+                join [Publication Record] ppr
+                    on p.id = ppr.[publication id]
+                    and ppr.[data source] = 'pubmed'
+        where
+            {where_clause}
+        order by
+            {order_by};
+        COMMIT TRANSACTION;"""
+
+
+# Looks up just the candidate IDs in the logging DB, lookup_batch_size at
+# a time as they stream in, rather than pulling every submitted ID.
+# The lookups use their own connection, since the items they pass on are
+# inserted into the logging DB while this generator is still running.
+def remove_logged_items(env, candidate_items):
+    seen_ids = set()
+    candidate_items = iter(candidate_items)
+
+    while candidate_batch := list(islice(candidate_items, lookup_batch_size)):
+        id_batch = [i.eschol_id for i in candidate_batch]
+        logged_ids = linkout_connections.retry(env, 'logging_db', get_logged_ids, id_batch)
+
+        # Elements can return the same eSchol ID twice; keep the first.
+        for item in candidate_batch:
+            if item.eschol_id not in logged_ids and item.eschol_id not in seen_ids:
+                seen_ids.add(item.eschol_id)
+                yield item
+
+
+def get_logged_ids(mysql_conn, id_batch):
+    with mysql_conn.cursor() as cursor:
+        placeholders = ', '.join(['%s'] * len(id_batch))
+        cursor.execute(
+            f"SELECT eschol_id FROM linkout_items WHERE eschol_id IN ({placeholders})",
+            id_batch)
+        linkout_metrics.count('db_round_trips')
+        return {row['eschol_id'] for row in cursor.fetchall()}
+
+
+# Syncs the local submitted-ID cache, then filters the candidates against it.
+def remove_cached_items(env, candidate_items):
+    with SubmittedIdCache() as submitted_ids:
+        linkout_connections.retry(env, 'logging_db', submitted_ids.sync)
+
+        seen_ids = set()
+        for item in candidate_items:
+            if item.eschol_id not in submitted_ids and item.eschol_id not in seen_ids:
+                seen_ids.add(item.eschol_id)
+                yield item
+
+
+def load_watermark():
+    if not os.path.exists(watermark_file):
+        return None
+    with open(watermark_file, 'r') as f:
+        return datetime.datetime.fromisoformat(json.load(f)['created_when'])
+
 
+def save_watermark(created_when):
+    previous = load_watermark()
+    if previous is not None and previous >= created_when:
+        return
 
+    os.makedirs(os.path.dirname(watermark_file), exist_ok=True)
+    temp_file = f"{watermark_file}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump({'created_when': created_when.isoformat()}, f)
+    os.replace(temp_file, watermark_file)
+
+
+# Returns (items added, total enqueued items).
 def add_new_items_to_logging_db(env, new_eschol_pubmed_items):
-    mysql_conn = get_logging_db_connection(env)
+    # Items already in the table are skipped, so reruns are safe
+    with linkout_connections.connection(env, 'logging_db') as mysql_conn:
+        print("Adding new items to the pmid logging db as they arrive from Elements.")
+        new_item_count = linkout_db.bulk_insert_linkout_items(mysql_conn, new_eschol_pubmed_items)
 
-    # Get the Item IDs already submitted
-    print(f"Adding {len(new_eschol_pubmed_items)} new items to the pmid logging db.")
-    with mysql_conn.cursor() as cursor:
-        linkout_insert_sql = """
-            INSERT INTO linkout_items (ucpms_id, eschol_id, pubmed_id)
-            VALUES (%(ucpms_id)s, %(eschol_id)s, %(pubmed_id)s)"""
-        cursor.executemany(linkout_insert_sql, new_eschol_pubmed_items)
-        mysql_conn.commit()
+    total_enqueued = linkout_connections.retry(env, 'logging_db', get_total_enqueued)
+    return new_item_count, total_enqueued
 
+
+def get_total_enqueued(mysql_conn):
+    with mysql_conn.cursor() as cursor:
         print(f"Checking new total enqueued items.")
         cursor.execute("""SELECT count(eschol_id) as total_enqueued
                 FROM linkout_items WHERE submitted IS NULL""")
-        total_enqueued = cursor.fetchone()['total_enqueued']
-        mysql_conn.close()
-
-    return total_enqueued
+        linkout_metrics.count('db_round_trips')
+        return cursor.fetchone()['total_enqueued']
 
 
 # =========================
@@ -0,0 +1,201 @@
+# Side index of eScholarship items' PubMed IDs, kept in the logging DB.
+#
+# Finding the items with a pmid in the eSchol DB means running JSON_TABLE
+# over every item's attrs. Instead, the eschol_pmids table holds
+# (eschol_id, pubmed_id, added) for each item with a numeric pmid, and
+# each sync only re-reads the items added or updated since the last one,
+# replacing their rows, so an item whose pmid changed or was removed is
+# picked up too. Lookups are then index reads, and exclusions an indexed
+# anti-join against linkout_items in the same DB.
+#
+# This relies on the eSchol DB's items.updated being set whenever an
+# item's attrs change. An item deleted from eScholarship leaves no row to
+# re-read, and an edit that missed updated would never be seen, so every
+# full_rebuild_interval the sync re-reads every item instead and then
+# drops the index rows it didn't touch: each row records the sync that
+# last wrote it.
+#
+# The tables are created by sql/eschol_pmid_index.sql. The first sync
+# is a full rebuild; after that, only the changes until the next one.
+
+import datetime
+import pymysql
+import linkout_connections
+import linkout_metrics
+from linkout_items import LinkOutItems
+
+sync_batch_size = 5000
+fetch_size = 5000
+# Re-read a little before the last sync, for updates committed late
+sync_lookback = datetime.timedelta(days=1)
+full_rebuild_interval = datetime.timedelta(days=7)
+first_sync = datetime.datetime(1970, 1, 1)
+
+# Every item added or updated since %s, with one row per pmid local ID,
+# or a single row with a NULL pmid if it has none.
+changed_items_sql = """
+    select i.id, i.added, i.updated, json_t.local_id_value
+    from
+        items i
+        left join JSON_TABLE(
+            i.attrs,
+            "$.local_ids[*]"
+            COLUMNS(local_id_type varchar(255) PATH "$.type",
+                    local_id_value varchar(255) PATH "$.id")
+        ) as json_t
+            on json_t.local_id_type in ('pmid')
+            and (json_t.local_id_value not REGEXP('[^0-9]')
+                and json_t.local_id_value != '')
+    where
+        i.updated > %s or i.added > %s
+    order by i.id
+    """
+
+# Indexed items that aren't in linkout_items yet, oldest first
+unsubmitted_items_sql = """
+    select p.eschol_id, p.pubmed_id
+    from eschol_pmids p
+    where not exists (
+        select 1 from linkout_items li
+        where li.eschol_id = p.eschol_id)
+    order by p.added, p.eschol_id
+    """
+
+
+# =========================
+# Brings eschol_pmids up to date with the eSchol DB. Each batch of changed
+# items is replaced in its own transaction, and the sync point only moves
+# once every batch is in, so a failed sync just starts again from the
+# last one. A full rebuild (when one is due, or full_rebuild=True) reads
+# every item, and only removes untouched rows once all of them are in.
+# Returns the number of items read.
+def sync(env, full_rebuild=False):
+    # Whole seconds, as stored in the datetime columns
+    sync_started = datetime.datetime.now().replace(microsecond=0)
+    synced_through, rebuilt_at = linkout_connections.retry(env, 'logging_db', get_sync_state)
+    if rebuilt_at is None or sync_started - rebuilt_at >= full_rebuild_interval:
+        full_rebuild = True
+
+    if full_rebuild:
+        since = first_sync
+        print("Rebuilding the eSchol pmid index from every item.")
+    else:
+        since = synced_through - sync_lookback
+        print(f"Syncing the eSchol pmid index with items added or updated since {since}.")
+
+    item_count = 0
+    latest = synced_through
+    for batch in iter_changed_item_batches(env, since):
+        linkout_connections.retry(env, 'logging_db', replace_items, batch, sync_started)
+        item_count += len({row[0] for row in batch})
+        for item_id, added, updated, pubmed_id in batch:
+            changed = max(added or first_sync, updated or first_sync)
+            if latest is None or changed > latest:
+                latest = changed
+
+    if full_rebuild:
+        linkout_connections.retry(env, 'logging_db', delete_stale_items, sync_started)
+
+    if latest is not None and (latest != synced_through or full_rebuild):
+        linkout_connections.retry(
+            env, 'logging_db', save_sync_state, latest, sync_started if full_rebuild else None)
+
+    linkout_metrics.count('eschol_items_synced', item_count)
+    print(f"eSchol pmid index synced: {item_count} {'items' if full_rebuild else 'changed items'}.")
+    return item_count
+
+
+# (synced_through, rebuilt_at), or (None, None) before the first sync
+def get_sync_state(mysql_conn):
+    with mysql_conn.cursor() as cursor:
+        cursor.execute("SELECT synced_through, rebuilt_at FROM eschol_pmid_sync WHERE id = 1")
+        linkout_metrics.count('db_round_trips')
+        row = cursor.fetchone()
+    return (row['synced_through'], row['rebuilt_at']) if row else (None, None)
+
+
+# rebuilt_at is only given after a full rebuild; otherwise it's kept.
+def save_sync_state(mysql_conn, synced_through, rebuilt_at=None):
+    with mysql_conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO eschol_pmid_sync (id, synced_through, rebuilt_at) VALUES (1, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                synced_through = GREATEST(synced_through, VALUES(synced_through)),
+                rebuilt_at = COALESCE(VALUES(rebuilt_at), rebuilt_at)""",
+            (synced_through, rebuilt_at))
+        linkout_metrics.count('db_round_trips')
+    mysql_conn.commit()
+
+
+# After a full rebuild, any row it didn't write belongs to an item that's
+# gone from eScholarship (or lost its pmid without an update).
+def delete_stale_items(mysql_conn, sync_started):
+    with mysql_conn.cursor() as cursor:
+        deleted = cursor.execute("DELETE FROM eschol_pmids WHERE synced < %s", (sync_started,))
+        linkout_metrics.count('db_round_trips')
+    mysql_conn.commit()
+    linkout_metrics.count('eschol_items_removed', deleted)
+    print(f"Removed {deleted} index rows for items no longer in eScholarship.")
+    return deleted
+
+
+# Yields lists of (item id, added, updated, pmid) rows, about
+# sync_batch_size at a time, never splitting one item's rows.
+def iter_changed_item_batches(env, since):
+    with linkout_connections.connection(env, 'eschol_db') as mysql_conn, \
+            mysql_conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        print("Connected to eSchol MySQL DB. Streaming changed items.")
+        cursor.execute(changed_items_sql, (since, since))
+
+        batch = []
+        while rows := cursor.fetchmany(fetch_size):
+            linkout_metrics.count('db_round_trips')
+            for row in rows:
+                if len(batch) >= sync_batch_size and row[0] != batch[-1][0]:
+                    yield batch
+                    batch = []
+                batch.append(row)
+        if batch:
+            yield batch
+
+
+# Replaces the index rows of every item in batch, in one transaction,
+# stamped with the sync that wrote them; items without a pmid are only
+# removed. Safe to repeat.
+def replace_items(mysql_conn, batch, synced):
+    item_ids = sorted({row[0] for row in batch})
+    pmid_rows = [
+        (item_id, pubmed_id, added, synced)
+        for item_id, added, updated, pubmed_id in batch if pubmed_id is not None]
+
+    with mysql_conn.cursor() as cursor:
+        placeholders = ', '.join(['%s'] * len(item_ids))
+        cursor.execute(f"DELETE FROM eschol_pmids WHERE eschol_id IN ({placeholders})", item_ids)
+        if pmid_rows:
+            cursor.executemany(
+                "INSERT IGNORE INTO eschol_pmids (eschol_id, pubmed_id, added, synced) "
+                "VALUES (%s, %s, %s, %s)",
+                pmid_rows)
+        linkout_metrics.count('db_round_trips', 2)
+    mysql_conn.commit()
+
+
+# =========================
+# Lookups, after a sync
+def fetch_unsubmitted_items(mysql_conn):
+    with mysql_conn.cursor(pymysql.cursors.Cursor) as cursor:
+        cursor.execute(unsubmitted_items_sql)
+        linkout_metrics.count('db_round_trips')
+        return LinkOutItems.from_rows(cursor.fetchall(), columns=('eschol_id', 'pubmed_id'))
+
+
+# Streams (None, eschol_id, pubmed_id) for every indexed item, oldest
+# first; eSchol items don't carry a ucpms_id.
+def iter_indexed_items(env):
+    with linkout_connections.connection(env, 'logging_db') as mysql_conn, \
+            mysql_conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        cursor.execute("SELECT eschol_id, pubmed_id FROM eschol_pmids ORDER BY added, eschol_id")
+        while rows := cursor.fetchmany(fetch_size):
+            linkout_metrics.count('db_round_trips')
+            for eschol_id, pubmed_id in rows:
+                yield None, eschol_id, pubmed_id
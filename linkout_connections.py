@@ -0,0 +1,233 @@
+# Connections to the three data stores: the LinkOut logging DB and the
+# eScholarship DB (MySQL), and the Elements reporting DB (SQL Server).
+#
+# A job wraps its run in ConnectionManager(env), and code inside it asks
+# for a store's connection with
+#     with linkout_connections.connection(env, 'logging_db') as mysql_conn:
+# Connections are opened on first use and handed back to the manager
+# afterwards, so later steps reuse them warm instead of paying for a new
+# TLS and auth handshake each time. A block that raises closes its
+# connection instead, since it may be mid-result or mid-transaction.
+# Outside a manager, connection() opens a fresh connection and closes it
+# afterwards, as the scripts used to.
+#
+# Opening a connection is retried with backoff on transient errors, and
+# retry() does the same for a whole idempotent read or update. Connect and
+# query times are counted in the run's metrics as <store>_connect_seconds
+# and <store>_query_seconds.
+
+from contextlib import contextmanager
+import sys
+import threading
+import time
+import pymysql
+import linkout_metrics
+
+default_max_attempts = 3
+default_backoff_seconds = 2.0
+# Idle connections older than this are pinged before they're reused
+idle_check_seconds = 30
+
+# Access denied, or an unknown database: retrying won't help
+permanent_mysql_errors = {1044, 1045, 1049}
+
+# Stack of active managers; a job that calls another job's main()
+# (enqueue calling submit) shares the outer job's connections.
+active_managers = []
+
+
+# =========================
+# Get Connections
+def connect_logging_db(env, local_infile=False):
+    return pymysql.connect(
+        host=env['LOGGING_DB_SERVER'],
+        user=env['LOGGING_DB_USER'],
+        password=env['LOGGING_DB_PASSWORD'],
+        database=env['LOGGING_DB_DATABASE'],
+        cursorclass=pymysql.cursors.DictCursor,
+        local_infile=local_infile)
+
+
+# For linkout_db's 'infile' loader (LOAD DATA LOCAL INFILE)
+def connect_logging_db_local_infile(env):
+    return connect_logging_db(env, local_infile=True)
+
+
+def connect_eschol_db(env):
+    return pymysql.connect(
+        host=env['ESCHOL_DB_SERVER_PROD'],
+        user=env['ESCHOL_DB_USER_PROD'],
+        password=env['ESCHOL_DB_PASSWORD_PROD'],
+        database=env['ESCHOL_DB_DATABASE_PROD'],
+        cursorclass=pymysql.cursors.DictCursor)
+
+
+def connect_elements_db(env):
+    # Only the Elements jobs need pyodbc
+    import pyodbc
+    mssql_conn = pyodbc.connect(
+        driver=env['ELEMENTS_REPORTING_DB_DRIVER_PROD'],
+        server=(env['ELEMENTS_REPORTING_DB_SERVER_PROD'] + ',' + env['ELEMENTS_REPORTING_DB_PORT_PROD']),
+        database=env['ELEMENTS_REPORTING_DB_DATABASE_PROD'],
+        uid=env['ELEMENTS_REPORTING_DB_USER_PROD'],
+        pwd=env['ELEMENTS_REPORTING_DB_PASSWORD_PROD'],
+        trustservercertificate='yes')
+    mssql_conn.autocommit = True  # Required when queries use TRANSACTION
+    return mssql_conn
+
+
+stores = {
+    'logging_db': connect_logging_db,
+    'logging_db_local_infile': connect_logging_db_local_infile,
+    'eschol_db': connect_eschol_db,
+    'elements_db': connect_elements_db,
+}
+
+
+def is_transient(e):
+    if isinstance(e, pymysql.err.OperationalError):
+        return not (e.args and e.args[0] in permanent_mysql_errors)
+    if isinstance(e, pymysql.err.InterfaceError):
+        return True
+    pyodbc = sys.modules.get('pyodbc')
+    return pyodbc is not None and isinstance(e, pyodbc.OperationalError)
+
+
+# Calls fn(), retrying transient errors with exponential backoff.
+def with_retries(fn, store, max_attempts=default_max_attempts,
+                 backoff_seconds=default_backoff_seconds):
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_attempts or not is_transient(e):
+                raise
+            delay = backoff_seconds * 2 ** (attempt - 1)
+            print(f"{store}: {e!r}; retrying in {delay:.0f}s "
+                  f"(attempt {attempt + 1} of {max_attempts}).")
+            linkout_metrics.count(f"{store}_retries")
+            time.sleep(delay)
+
+
+def connect(env, store):
+    def timed_connect():
+        start = time.monotonic()
+        conn = stores[store](env)
+        linkout_metrics.count(f"{store}_connects")
+        linkout_metrics.count(f"{store}_connect_seconds", round(time.monotonic() - start, 3))
+        return conn
+    return with_retries(timed_connect, store)
+
+
+# =========================
+class ConnectionManager:
+
+    def __init__(self, env):
+        self.env = env
+        self.idle = {store: [] for store in stores}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        active_managers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        active_managers.remove(self)
+        self.close()
+
+    # Hands out an idle connection if there is one, else opens another, so
+    # threads (e.g. pipeline stages) each get their own.
+    @contextmanager
+    def connection(self, store):
+        conn = self.checkout(store)
+        start = time.monotonic()
+        try:
+            yield conn
+        except BaseException:
+            close_quietly(conn)
+            raise
+        finally:
+            linkout_metrics.count(f"{store}_query_seconds", round(time.monotonic() - start, 3))
+        self.checkin(store, conn)
+
+    def checkout(self, store):
+        with self.lock:
+            idle = self.idle[store].pop() if self.idle[store] else None
+
+        if idle is not None:
+            conn, idle_since = idle
+            if time.monotonic() - idle_since < idle_check_seconds or is_alive(conn):
+                linkout_metrics.count(f"{store}_reuses")
+                return conn
+            close_quietly(conn)
+        return connect(self.env, store)
+
+    def checkin(self, store, conn):
+        # Like closing it, ends any open transaction, so the next user
+        # doesn't read from an old snapshot or inherit uncommitted writes.
+        # Elements connections are in autocommit mode, so only an explicit
+        # BEGIN TRANSACTION can be left open.
+        try:
+            if isinstance(conn, pymysql.connections.Connection):
+                conn.rollback()
+            else:
+                conn.execute("IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION")
+        except Exception:
+            close_quietly(conn)
+            return
+        with self.lock:
+            self.idle[store].append((conn, time.monotonic()))
+
+    def close(self):
+        with self.lock:
+            idle = [conn for conns in self.idle.values() for conn, _ in conns]
+            self.idle = {store: [] for store in stores}
+        for conn in idle:
+            close_quietly(conn)
+
+
+def is_alive(conn):
+    try:
+        if isinstance(conn, pymysql.connections.Connection):
+            conn.ping(reconnect=False)
+        else:
+            conn.execute("SELECT 1").fetchall()
+        return True
+    except Exception:
+        return False
+
+
+def close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+# =========================
+# The active manager's connection to store, or a new one that's closed
+# afterwards when no manager is active.
+@contextmanager
+def connection(env, store):
+    if active_managers:
+        with active_managers[0].connection(store) as conn:
+            yield conn
+        return
+
+    conn = connect(env, store)
+    start = time.monotonic()
+    try:
+        yield conn
+    finally:
+        linkout_metrics.count(f"{store}_query_seconds", round(time.monotonic() - start, 3))
+        close_quietly(conn)
+
+
+# Runs fn(conn, *args) on store's connection, retrying transient errors
+# on a fresh connection. fn must be safe to repeat: a read, or an update
+# that sets the same values again.
+def retry(env, store, fn, *args):
+    def attempt():
+        with connection(env, store) as conn:
+            return fn(conn, *args)
+    return with_retries(attempt, store)
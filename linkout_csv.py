@@ -0,0 +1,224 @@
+# Streaming, typed ingestion of the Elements batch CSV.
+#
+# The input has eschol_id, ucpms_id and pubmed_id columns (in any order,
+# others ignored; ucpms_id may be blank). Rows are parsed chunk_rows at a
+# time straight into LinkOutItems batches, so the file is never held as
+# strings: ucpms_id and pubmed_id become 64-bit integers and eschol_id a
+# fixed-width record. Malformed rows are left out and kept in
+# CsvItemReader.rejects with their line numbers.
+#
+# With workers > 1, the file is split into byte ranges at line breaks and
+# each range is parsed in its own process. That assumes no quoted field
+# contains a line break, which holds for the Elements export.
+#
+# Usage: python linkout_csv.py input/ucpms-eschol-pubmed-batch-input.csv [workers]
+
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import io
+import os
+import sys
+from linkout_items import LinkOutItems, is_pubmed_id, missing_id
+from submitted_id_cache import id_width
+
+chunk_rows = 100000
+# Each process reads this much at a time, and only about workers ranges
+# are parsed ahead of the one being consumed, so memory stays bounded by
+# workers * range_bytes however big the file is
+range_bytes = 32 * 1024 * 1024
+default_max_rejects = 1000
+required_columns = ('eschol_id', 'pubmed_id')
+# 18 digits always fit in a 64-bit integer
+max_id_digits = 18
+
+
+# =========================
+class LinkOutCsvError(Exception):
+    pass
+
+
+class CsvItemReader:
+
+    def __init__(self, file_name, workers=1, max_rejects=default_max_rejects):
+        self.file_name = file_name
+        self.workers = workers
+        self.max_rejects = max_rejects
+        self.rejects = []
+        self.line_count = 0
+
+    # Yields LinkOutItems batches in file order.
+    def __iter__(self):
+        with open(self.file_name, 'rb') as f:
+            header_line = f.readline()
+            data_start = f.tell()
+            file_size = os.fstat(f.fileno()).st_size
+        columns = get_column_indexes(self.file_name, header_line)
+
+        if self.workers > 1 and file_size - data_start > range_bytes:
+            batches = self.iter_ranges(columns, data_start, file_size)
+        else:
+            batches = self.iter_serial(columns)
+
+        yield from batches
+
+    # Reads every batch into one; callers that can take the batches as a
+    # stream should iterate instead.
+    def read_all(self):
+        return LinkOutItems.concat(self)
+
+    # The reader counts the header, so its line numbers are the file's
+    def iter_serial(self, columns):
+        with open(self.file_name, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for batch, rejects in parse_rows(reader, columns, self.max_rejects):
+                self.add_rejects(rejects, 0)
+                yield batch
+            self.line_count = reader.line_num - 1
+
+    # Ranges come back in order; each one's line numbers start from the
+    # line after the previous range's last. A range is only submitted once
+    # an earlier one is taken, so at most workers are parsed or waiting.
+    def iter_ranges(self, columns, data_start, file_size):
+        byte_ranges = get_byte_ranges(self.file_name, data_start, file_size)
+        print(f"Parsing {self.file_name} in {len(byte_ranges)} ranges across {self.workers} processes.")
+        ranges = iter(byte_ranges)
+
+        def submit_next():
+            byte_range = next(ranges, None)
+            if byte_range is not None:
+                futures.append(executor.submit(
+                    parse_byte_range, self.file_name, *byte_range, columns, self.max_rejects))
+
+        lines_before = 1  # the header
+        futures = deque()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for _ in range(self.workers):
+                submit_next()
+            while futures:
+                batch, rejects, line_count = futures.popleft().result()
+                submit_next()
+                self.add_rejects(rejects, lines_before)
+                lines_before += line_count
+                self.line_count += line_count
+                yield batch
+
+    def add_rejects(self, rejects, lines_before):
+        self.rejects.extend((line_number + lines_before, message) for line_number, message in rejects)
+        if len(self.rejects) > self.max_rejects:
+            raise LinkOutCsvError(
+                f"{self.file_name} has more than {self.max_rejects} malformed rows; "
+                "is it the right file?")
+
+    def report(self):
+        for line_number, message in self.rejects:
+            print(f"{os.path.basename(self.file_name)}:{line_number}: {message}")
+        print(f"Read {self.line_count} lines from {self.file_name}, "
+              f"{len(self.rejects)} malformed rows left out.")
+
+
+# =========================
+def get_column_indexes(file_name, header_line):
+    header = next(csv.reader([header_line.decode('utf-8-sig')]), [])
+    header = [name.strip() for name in header]
+    missing = [name for name in required_columns if name not in header]
+    if missing:
+        raise LinkOutCsvError(f"{file_name} is missing the {', '.join(missing)} columns.")
+    return (
+        header.index('eschol_id'),
+        header.index('ucpms_id') if 'ucpms_id' in header else None,
+        header.index('pubmed_id'),
+        len(header))
+
+
+# Splits [data_start, file_size) into ranges of about range_bytes, each
+# ending just after a line break.
+def get_byte_ranges(file_name, data_start, file_size):
+    ranges = []
+    with open(file_name, 'rb') as f:
+        start = data_start
+        while start < file_size:
+            f.seek(min(start + range_bytes, file_size) - 1)
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_byte_range(file_name, start, end, columns, max_rejects):
+    with open(file_name, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+
+    reader = csv.reader(io.StringIO(text, newline=''))
+    batches = []
+    rejects = []
+    for batch, batch_rejects in parse_rows(reader, columns, max_rejects):
+        batches.append(batch)
+        rejects.extend(batch_rejects)
+    return LinkOutItems.concat(batches), rejects, reader.line_num
+
+
+# Yields (LinkOutItems, rejects) every chunk_rows valid rows, where rejects
+# are (line number from the reader's start, message) for the rows left out.
+def parse_rows(reader, columns, max_rejects=default_max_rejects):
+    eschol_index, ucpms_index, pubmed_index, column_count = columns
+    ucpms_ids, eschol_ids, pubmed_ids = array('q'), bytearray(), array('q')
+    rejects = []
+
+    def reject(message):
+        rejects.append((reader.line_num, message))
+        if len(rejects) > max_rejects:
+            raise LinkOutCsvError(f"More than {max_rejects} malformed rows.")
+
+    for row in reader:
+        if not row:
+            continue  # blank line
+        if len(row) < column_count:
+            reject(f"expected {column_count} fields, got {len(row)}")
+            continue
+
+        eschol_id = row[eschol_index].strip()
+        ucpms_id = row[ucpms_index].strip() if ucpms_index is not None else ''
+        pubmed_id = row[pubmed_index].strip()
+
+        if not eschol_id or not eschol_id.isascii() or len(eschol_id) > id_width:
+            reject(f"eschol_id isn't a valid eSchol ID: {eschol_id!r}")
+        elif not is_pubmed_id(pubmed_id):
+            reject(f"pubmed_id isn't a PubMed ID: {pubmed_id!r}")
+        elif ucpms_id and not is_id(ucpms_id):
+            reject(f"ucpms_id isn't numeric: {ucpms_id!r}")
+        else:
+            ucpms_ids.append(int(ucpms_id) if ucpms_id else missing_id)
+            eschol_ids += eschol_id.encode('ascii').ljust(id_width, b'\0')
+            pubmed_ids.append(int(pubmed_id))
+
+            if len(pubmed_ids) >= chunk_rows:
+                yield make_batch(ucpms_ids, eschol_ids, pubmed_ids), rejects
+                ucpms_ids, eschol_ids, pubmed_ids = array('q'), bytearray(), array('q')
+                rejects = []
+
+    if pubmed_ids or rejects:
+        yield make_batch(ucpms_ids, eschol_ids, pubmed_ids), rejects
+
+
+def is_id(value):
+    return value.isascii() and value.isdigit() and len(value) <= max_id_digits
+
+
+# CSV items have no linkout_items.id yet
+def make_batch(ucpms_ids, eschol_ids, pubmed_ids):
+    ids = array('q', [missing_id]) * len(pubmed_ids)
+    return LinkOutItems(ids, ucpms_ids, eschol_ids, pubmed_ids)
+
+
+# =========================
+if __name__ == '__main__':
+    csv_reader = CsvItemReader(sys.argv[1], workers=int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    items = csv_reader.read_all()
+    csv_reader.report()
+    print(f"{len(items)} items ({items.nbytes} bytes).")
+    sys.exit(1 if csv_reader.rejects else 0)
@@ -0,0 +1,241 @@
+# Shared logging DB helpers for the linkout_items table.
+#
+# Bulk loads are idempotent: they rely on the unique key on
+# linkout_items.eschol_id, so rerunning a load skips (or updates)
+# rows that are already there instead of failing.
+
+import csv
+import os
+import tempfile
+import time
+import pymysql
+import linkout_metrics
+from linkout_items import LinkOutItems
+
+linkout_columns = ('ucpms_id', 'eschol_id', 'pubmed_id')
+staging_table = 'linkout_items_load'
+default_chunk_size = 2000
+default_update_batch_size = 1000
+
+
+# =========================
+# Loads items into linkout_items from any iterable, consumed as it's read.
+# Items are dicts with the linkout_columns keys, or tuples (e.g. pyodbc
+# rows) whose first fields are the linkout_columns in order.
+#
+# on_duplicate: 'ignore' leaves existing rows alone, 'update' overwrites
+#   their ucpms_id and pubmed_id.
+# method: 'multirow' sends one INSERT per chunk_size rows;
+#   'infile' spools the rows to a temp file and uses LOAD DATA LOCAL INFILE,
+#   which needs a connection opened with local_infile=True
+#   (linkout_connections' 'logging_db_local_infile' store) and local_infile
+#   enabled on the server, which MySQL 8 turns off by default.
+# Both methods treat existing rows the same way: they're left alone or
+# updated in place, keeping their id, submitted and pubmed_filename.
+#
+# Commits after each chunk. Returns the number of rows inserted or changed.
+def bulk_insert_linkout_items(mysql_conn, items, chunk_size=default_chunk_size,
+                              on_duplicate='ignore', method='multirow'):
+    start = time.monotonic()
+
+    if method == 'infile':
+        row_count, affected = load_data_infile(mysql_conn, items, on_duplicate)
+    elif method == 'multirow':
+        row_count, affected = insert_multirow(mysql_conn, items, chunk_size, on_duplicate)
+    else:
+        raise ValueError(f"Unknown bulk insert method: {method}")
+
+    seconds = time.monotonic() - start
+    rate = f"{row_count / seconds:.0f} rows/s" if seconds > 0 else "n/a"
+    linkout_metrics.count('rows', row_count)
+    print(f"Loaded {row_count} rows into linkout_items "
+          f"({affected} affected) in {seconds:.2f}s, {rate}.")
+    return affected
+
+
+def insert_multirow(mysql_conn, items, chunk_size, on_duplicate):
+    row_count = 0
+    affected = 0
+    chunk = []
+
+    with mysql_conn.cursor() as cursor:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                affected += execute_multirow_chunk(cursor, chunk, on_duplicate)
+                mysql_conn.commit()
+                row_count += len(chunk)
+                chunk = []
+
+        if chunk:
+            affected += execute_multirow_chunk(cursor, chunk, on_duplicate)
+            mysql_conn.commit()
+            row_count += len(chunk)
+
+    return row_count, affected
+
+
+def execute_multirow_chunk(cursor, chunk, on_duplicate):
+    params = []
+    for item in chunk:
+        params.extend(get_column_values(item))
+
+    linkout_metrics.count('db_round_trips')
+    return cursor.execute(get_multirow_insert_sql(len(chunk), on_duplicate), params)
+
+
+def get_column_values(item):
+    if isinstance(item, dict):
+        return [item[column] for column in linkout_columns]
+    return [item[i] for i in range(len(linkout_columns))]
+
+
+def get_multirow_insert_sql(row_count, on_duplicate):
+    row_placeholders = '(' + ', '.join(['%s'] * len(linkout_columns)) + ')'
+    values = ',\n'.join([row_placeholders] * row_count)
+    return get_insert_sql(f"VALUES\n{values}", on_duplicate)
+
+
+# rows_sql is the VALUES list or SELECT the rows come from
+def get_insert_sql(rows_sql, on_duplicate):
+    columns = ', '.join(linkout_columns)
+
+    if on_duplicate == 'ignore':
+        return f"INSERT IGNORE INTO linkout_items ({columns})\n{rows_sql}"
+    elif on_duplicate == 'update':
+        return f"INSERT INTO linkout_items ({columns})\n{rows_sql}\n" \
+               "ON DUPLICATE KEY UPDATE ucpms_id = VALUES(ucpms_id), pubmed_id = VALUES(pubmed_id)"
+    raise ValueError(f"Unknown on_duplicate behavior: {on_duplicate}")
+
+
+# The file is loaded into a keyless temporary copy of the linkout_items
+# columns, then moved across with the same INSERT as the multirow path.
+# The table is dropped either way, since pooled connections outlive a load.
+def load_data_infile(mysql_conn, items, on_duplicate):
+    insert_sql = get_insert_sql(
+        f"SELECT {', '.join(linkout_columns)} FROM {staging_table}", on_duplicate)
+    row_count = 0
+
+    spool_file = tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False, newline='')
+    try:
+        with spool_file:
+            writer = csv.writer(spool_file, delimiter='\t', lineterminator='\n')
+            for item in items:
+                writer.writerow(
+                    r'\N' if value is None else value
+                    for value in get_column_values(item))
+                row_count += 1
+
+        with mysql_conn.cursor() as cursor:
+            cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {staging_table}")
+            cursor.execute(f"""
+                CREATE TEMPORARY TABLE {staging_table}
+                SELECT {', '.join(linkout_columns)} FROM linkout_items LIMIT 0""")
+            try:
+                cursor.execute(f"""
+                    LOAD DATA LOCAL INFILE %s
+                    INTO TABLE {staging_table}
+                    FIELDS TERMINATED BY '\\t'
+                    LINES TERMINATED BY '\\n'
+                    ({', '.join(linkout_columns)})""", (spool_file.name,))
+                affected = cursor.execute(insert_sql)
+                mysql_conn.commit()
+            finally:
+                cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS {staging_table}")
+            linkout_metrics.count('db_round_trips', 5)
+    finally:
+        os.remove(spool_file.name)
+
+    return row_count, affected
+
+
+# =========================
+# Records each file name against the exact linkout_items.id values that
+# went into it, batch_size rows per statement, committing after each so
+# no lock is held for the whole table.
+def mark_items_submitted(mysql_conn, file_item_ids, batch_size=default_update_batch_size):
+    updated = 0
+    with mysql_conn.cursor() as cursor:
+        for submission_file, item_ids in file_item_ids.items():
+            for i in range(0, len(item_ids), batch_size):
+                id_batch = item_ids[i:i + batch_size]
+                placeholders = ', '.join(['%s'] * len(id_batch))
+                updated += cursor.execute(f"""
+                    UPDATE linkout_items
+                    SET
+                        submitted = now(),
+                        pubmed_filename = %s
+                    WHERE id IN ({placeholders})""",
+                    [submission_file] + list(id_batch))
+                mysql_conn.commit()
+                linkout_metrics.count('db_round_trips')
+
+    linkout_metrics.count('rows', updated)
+    print(f"Marked {updated} items as submitted in {len(file_item_ids)} files.")
+    return updated
+
+
+# The rows of the given [[first id, last id], ...] runs, as journaled by
+# linkout_journal.to_id_ranges. The runs only hold ids that were all in
+# the file they describe, so each one is matched exactly.
+def fetch_items_by_id_ranges(mysql_conn, item_id_ranges):
+    rows = []
+    with mysql_conn.cursor(pymysql.cursors.Cursor) as cursor:
+        for first_id, last_id in item_id_ranges:
+            cursor.execute("""SELECT id, eschol_id, pubmed_id FROM linkout_items
+                WHERE id BETWEEN %s AND %s ORDER BY id""", (first_id, last_id))
+            rows.extend(cursor.fetchall())
+            linkout_metrics.count('db_round_trips')
+    return LinkOutItems.from_rows(rows, columns=('id', 'eschol_id', 'pubmed_id'))
+
+
+# The rows with the given linkout_items.id values, batch_size per query,
+# ordered by eschol_id. Ids that are gone are skipped.
+def fetch_items_by_ids(mysql_conn, item_ids, batch_size=default_update_batch_size):
+    rows = []
+    with mysql_conn.cursor(pymysql.cursors.Cursor) as cursor:
+        for i in range(0, len(item_ids), batch_size):
+            id_batch = item_ids[i:i + batch_size]
+            placeholders = ', '.join(['%s'] * len(id_batch))
+            cursor.execute(f"""SELECT id, eschol_id, pubmed_id FROM linkout_items
+                WHERE id IN ({placeholders})""", list(id_batch))
+            rows.extend(cursor.fetchall())
+            linkout_metrics.count('db_round_trips')
+    rows.sort(key=lambda row: row[1])
+    return LinkOutItems.from_rows(rows, columns=('id', 'eschol_id', 'pubmed_id'))
+
+
+# =========================
+# Changes the pubmed_id of existing rows, given {linkout_items.id: pubmed_id}.
+def update_pubmed_ids(mysql_conn, item_pubmed_ids, batch_size=default_update_batch_size):
+    updated = 0
+    item_pubmed_ids = list(item_pubmed_ids.items())
+    with mysql_conn.cursor() as cursor:
+        for i in range(0, len(item_pubmed_ids), batch_size):
+            batch = item_pubmed_ids[i:i + batch_size]
+            updated += cursor.executemany(
+                "UPDATE linkout_items SET pubmed_id = %s WHERE id = %s",
+                [(pubmed_id, item_id) for item_id, pubmed_id in batch])
+            mysql_conn.commit()
+            linkout_metrics.count('db_round_trips')
+
+    linkout_metrics.count('rows', updated)
+    print(f"Updated the pubmed_id of {updated} items.")
+    return updated
+
+
+def delete_linkout_items(mysql_conn, item_ids, batch_size=default_update_batch_size):
+    deleted = 0
+    item_ids = list(item_ids)
+    with mysql_conn.cursor() as cursor:
+        for i in range(0, len(item_ids), batch_size):
+            id_batch = item_ids[i:i + batch_size]
+            placeholders = ', '.join(['%s'] * len(id_batch))
+            deleted += cursor.execute(
+                f"DELETE FROM linkout_items WHERE id IN ({placeholders})", id_batch)
+            mysql_conn.commit()
+            linkout_metrics.count('db_round_trips')
+
+    linkout_metrics.count('rows', deleted)
+    print(f"Deleted {deleted} items.")
+    return deleted
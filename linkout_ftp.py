@@ -0,0 +1,306 @@
+# PubMed LinkOut FTP uploads
+# https://docs.python.org/3/library/ftplib.html#ftplib.FTP.storbinary
+#
+# Uploads files over a bounded pool of logged-in FTP sessions,
+# several files at once, reporting throughput for each file.
+#
+# Transfers are resumable: each file's sha256 and size are kept in a
+# manifest next to the files, a retry after a dropped connection
+# continues from the remote SIZE with a REST offset, and a file only
+# counts as uploaded once the remote SIZE matches the local byte count.
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import ftplib
+from ftplib import FTP
+import hashlib
+import json
+import os
+import threading
+import time
+from queue import Queue, Empty
+import linkout_metrics
+
+default_concurrency = 4
+default_blocksize = 64 * 1024
+default_max_attempts = 5
+retry_backoff_seconds = 2
+manifest_filename = "linkout_upload_manifest.json"
+
+
+# =========================
+def connect_linkout_ftp(env):
+    ftp = FTP()
+    ftp.connect(env['LINKOUT_FTP_URL'], int(env.get('LINKOUT_FTP_PORT') or 21))
+    ftp.login(env['LINKOUT_FTP_USER'], env['LINKOUT_FTP_PASSWORD'])  # should return 230 successful login
+    ftp.cwd(env['LINKOUT_FTP_DIR'])  # should return 250 successful dir change
+    return ftp
+
+
+# =========================
+# Hands out up to max_sessions logged-in sessions, created on demand
+# with connect() and reused across files. Sessions that fail mid-transfer
+# are discarded rather than returned to the pool.
+class FTPSessionPool:
+
+    def __init__(self, connect, max_sessions=default_concurrency):
+        self.connect = connect
+        self.max_sessions = max_sessions
+        self.idle = Queue()
+        self.open_count = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def session(self):
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except BaseException:
+            self.discard(ftp)
+            raise
+        else:
+            self.idle.put(ftp)
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+
+        with self.lock:
+            can_open = self.open_count < self.max_sessions
+            if can_open:
+                self.open_count += 1
+
+        if not can_open:
+            return self.idle.get()
+
+        try:
+            return self.connect()
+        except BaseException:
+            with self.lock:
+                self.open_count -= 1
+            raise
+
+    def discard(self, ftp):
+        with self.lock:
+            self.open_count -= 1
+        ftp.close()
+
+    def close(self):
+        while True:
+            try:
+                ftp = self.idle.get_nowait()
+            except Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+
+
+def get_session_pool(env, concurrency=default_concurrency, connect=None):
+    if connect is None:
+        def connect():
+            return connect_linkout_ftp(env)
+
+    print(f"Connecting to PubMed Linkout FTP ({concurrency} sessions).")
+    return FTPSessionPool(connect, concurrency)
+
+
+# =========================
+# Names of the files in the LinkOut FTP dir
+def list_remote_files(env, connect=None):
+    ftp = connect() if connect is not None else connect_linkout_ftp(env)
+    try:
+        return sorted(os.path.basename(name) for name in ftp.nlst())
+    except ftplib.error_perm:
+        return []  # some servers answer an empty listing with 550
+    finally:
+        ftp.quit()
+
+
+def delete_remote_files(env, remote_names, connect=None):
+    if not remote_names:
+        return
+    ftp = connect() if connect is not None else connect_linkout_ftp(env)
+    try:
+        for remote_name in remote_names:
+            ftp.delete(remote_name)
+            print(f"Deleted from FTP: {remote_name}")
+    finally:
+        ftp.quit()
+    linkout_metrics.count('files_deleted', len(remote_names))
+
+
+# =========================
+# Per-file sha256 and byte counts, saved as JSON after every change so an
+# interrupted run can pick up where it stopped. A file whose checksum no
+# longer matches its entry (e.g. it was regenerated) is sent again in full.
+class UploadManifest:
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                self.entries = json.load(f)
+
+    def entry_for(self, file_name):
+        remote_name = os.path.basename(file_name)
+        sha256, byte_count = get_file_checksum(file_name)
+
+        with self.lock:
+            entry = self.entries.get(remote_name)
+            if entry is None or entry['sha256'] != sha256:
+                entry = {'sha256': sha256, 'bytes': byte_count, 'started': False, 'uploaded': False}
+                self.entries[remote_name] = entry
+                self.save()
+            return dict(entry)
+
+    def mark_started(self, remote_name):
+        with self.lock:
+            self.entries[remote_name]['started'] = True
+            self.save()
+
+    def mark_uploaded(self, remote_name):
+        with self.lock:
+            self.entries[remote_name]['uploaded'] = True
+            self.save()
+
+    def save(self):
+        temp_file = f"{self.manifest_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(temp_file, self.manifest_file)
+
+
+def get_file_checksum(file_name, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    byte_count = 0
+    with open(file_name, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            sha256.update(chunk)
+            byte_count += len(chunk)
+    return sha256.hexdigest(), byte_count
+
+
+# =========================
+# Uploads each local file under its base name. Returns a list of
+# (file name, bytes sent, seconds) in the same order as files.
+# Raises once every file has been attempted if any of them didn't arrive,
+# so callers never go on to update the logging DB for a partial upload.
+# on_uploaded(file name), if given, is called as each file is confirmed.
+def upload_files(env, files, concurrency=default_concurrency,
+                 blocksize=default_blocksize, connect=None,
+                 max_attempts=default_max_attempts, manifest_file=None,
+                 on_uploaded=None):
+    if not files:
+        return []
+
+    if manifest_file is None:
+        manifest_file = os.path.join(os.path.dirname(files[0]), manifest_filename)
+    manifest = UploadManifest(manifest_file)
+    caller_stage = linkout_metrics.current_stage()
+
+    def upload(file_name):
+        with linkout_metrics.attach_stage(caller_stage):
+            result = upload_file(pool, file_name, manifest, blocksize, max_attempts)
+            if on_uploaded is not None:
+                on_uploaded(file_name)
+        return result
+
+    with get_session_pool(env, concurrency, connect) as pool, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(upload, file_name) for file_name in files]
+
+    results = []
+    failed = []
+    for file_name, future in zip(files, futures):
+        try:
+            results.append(future.result())
+        except ftplib.all_errors as e:
+            failed.append(f"{os.path.basename(file_name)}: {e}")
+
+    if failed:
+        raise RuntimeError("FTP upload failed for:\n" + "\n".join(failed))
+
+    total_bytes = sum(r[1] for r in results)
+    print(f"Transferred {len(results)} files ({total_bytes} bytes).")
+    return results
+
+
+def upload_file(pool, file_name, manifest, blocksize=default_blocksize,
+                max_attempts=default_max_attempts):
+    remote_name = os.path.basename(file_name)
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            with pool.session() as ftp:
+                sent_bytes, seconds = send_missing_bytes(
+                    ftp, file_name, remote_name, manifest, blocksize)
+            break
+        except ftplib.all_errors as e:
+            if attempt == max_attempts:
+                raise
+            print(f"Retrying {remote_name} after error (attempt {attempt}): {e}")
+            time.sleep(retry_backoff_seconds * attempt)
+
+    manifest.mark_uploaded(remote_name)
+    linkout_metrics.count('bytes_sent', sent_bytes)
+    linkout_metrics.count('files_sent')
+    print(f"Transferred: {remote_name} "
+          f"({sent_bytes} bytes in {seconds:.2f}s, {format_rate(sent_bytes, seconds)})")
+    return remote_name, sent_bytes, seconds
+
+
+# Sends only what the server doesn't already have, then checks SIZE.
+# Returns (bytes sent, seconds).
+def send_missing_bytes(ftp, file_name, remote_name, manifest, blocksize):
+    entry = manifest.entry_for(file_name)
+    ftp.voidcmd('TYPE I')  # SIZE is only reliable in binary mode
+    remote_size = get_remote_size(ftp, remote_name)
+
+    if remote_size == entry['bytes'] and entry['uploaded']:
+        return 0, 0.0
+
+    # A partial remote file left by an earlier attempt at the same checksum
+    # can be resumed; anything else is overwritten from the start.
+    offset = 0
+    if entry['started'] and remote_size is not None and 0 < remote_size < entry['bytes']:
+        offset = remote_size
+
+    manifest.mark_started(remote_name)
+    with open(file_name, 'rb') as file:
+        file.seek(offset)
+        start = time.monotonic()
+        ftp.storbinary(f'STOR {remote_name}', file, blocksize=blocksize, rest=offset or None)
+        seconds = time.monotonic() - start
+
+    remote_size = get_remote_size(ftp, remote_name)
+    if remote_size != entry['bytes']:
+        raise ftplib.error_temp(
+            f"size mismatch after transfer: {remote_size} remote, {entry['bytes']} local")
+
+    return entry['bytes'] - offset, seconds
+
+
+def get_remote_size(ftp, remote_name):
+    try:
+        return ftp.size(remote_name)
+    except ftplib.error_perm:
+        return None  # 550: no such file yet
+
+
+def format_rate(byte_count, seconds):
+    if seconds <= 0:
+        return "n/a"
+    return f"{byte_count / seconds / 1024 / 1024:.2f} MB/s"
@@ -0,0 +1,409 @@
+# Compact, columnar batches of linkout items.
+#
+# Instead of one dict per row, a LinkOutItems batch keeps each column in
+# a flat buffer: linkout_items.id, ucpms_id and pubmed_id as 64-bit
+# integer arrays, and eschol_id as fixed-width NUL-padded bytes (the same
+# records as the submitted-ID cache). That's 40 bytes per item, so a
+# million links take about 40 MB rather than several hundred.
+#
+# Slicing returns a view over the same buffers, without copying. Indexing
+# and iterating give back plain dicts, one at a time, so code written for
+# DictCursor rows (page[0]['id'], linkout_xml.item_links(page)) still works.
+#
+# pubmed_ids are stored as integers, so from_rows only takes the ones
+# that read back unchanged: all digits, without leading zeros. eschol_ids
+# must fit a record: 1 to id_width printable ASCII characters, no spaces. Any
+# other row is left out of the batch and reported, with why, in its
+# rejects, so one bad row doesn't stop the rest of a submission. A missing
+# linkout_items.id or ucpms_id is stored as missing_id and read back as None.
+#
+# from_rows checks and packs rows pack_size at a time, a column at a time,
+# and only goes row by row through a chunk that has a bad row in it.
+
+from array import array
+from itertools import islice, repeat
+import re
+import linkout_metrics
+import linkout_xml
+from submitted_id_cache import id_width, decode_id
+
+missing_id = -1
+default_columns = ('ucpms_id', 'eschol_id', 'pubmed_id')
+max_pubmed_id_digits = 18  # fits a signed 64-bit integer
+max_pubmed_id = 10 ** max_pubmed_id_digits - 1
+pubmed_id_pattern = re.compile(r'[1-9][0-9]{0,%d}' % (max_pubmed_id_digits - 1))
+eschol_id_pattern = re.compile(r'[!-~]{1,%d}' % id_width)
+pack_size = 10000
+
+
+# =========================
+class LinkOutItems:
+
+    def __init__(self, ids=None, ucpms_ids=None, eschol_ids=b'', pubmed_ids=None, rejects=None):
+        self.ids = memoryview(ids if ids is not None else array('q'))
+        self.ucpms_ids = memoryview(ucpms_ids if ucpms_ids is not None else array('q'))
+        self.eschol_ids = memoryview(eschol_ids)
+        self.pubmed_ids = memoryview(pubmed_ids if pubmed_ids is not None else array('q'))
+        self.rejects = rejects if rejects is not None else []
+
+    # rows are tuples whose fields are named, in order, by columns; any of
+    # 'id', 'ucpms_id', 'eschol_id' and 'pubmed_id' (other names are skipped).
+    # Rows that can't be stored are left out, each one printed and kept in
+    # rejects as (linkout_items.id or None, eschol_id, message).
+    @classmethod
+    def from_rows(cls, rows, columns=default_columns):
+        indexes = [
+            columns.index(name) if name in columns else None
+            for name in ('id', 'ucpms_id', 'eschol_id', 'pubmed_id')]
+        return cls.from_columns(
+            [[row[index] for row in chunk] if index is not None else None
+             for index in indexes]
+            for chunk in iter_chunks(rows))
+
+    # items are dicts; 'id' and 'ucpms_id' are optional.
+    @classmethod
+    def from_items(cls, items, pubmed_key='pubmed_id'):
+        return cls.from_columns(
+            [[item.get('id') for item in chunk], [item.get('ucpms_id') for item in chunk],
+             [item['eschol_id'] for item in chunk], [item[pubmed_key] for item in chunk]]
+            for chunk in iter_chunks(items))
+
+    # column_chunks are [ids, ucpms_ids, eschol_ids, pubmed_ids] lists of
+    # values for up to pack_size rows; ids and ucpms_ids may be None.
+    @classmethod
+    def from_columns(cls, column_chunks):
+        buffers = array('q'), array('q'), bytearray(), array('q')
+        rejects = []
+        for columns in column_chunks:
+            if not pack_valid_columns(columns, buffers):
+                pack_rows(columns, buffers, rejects)
+
+        if rejects:
+            report_rejects(rejects)
+        return cls(*buffers, rejects)
+
+    # Copies several batches into one.
+    @classmethod
+    def concat(cls, batches):
+        ids, ucpms_ids, eschol_ids, pubmed_ids = array('q'), array('q'), bytearray(), array('q')
+        rejects = []
+        for batch in batches:
+            ids.frombytes(batch.ids.cast('B'))
+            ucpms_ids.frombytes(batch.ucpms_ids.cast('B'))
+            eschol_ids += batch.eschol_ids
+            pubmed_ids.frombytes(batch.pubmed_ids.cast('B'))
+            rejects.extend(batch.rejects)
+        return cls(ids, ucpms_ids, eschol_ids, pubmed_ids, rejects)
+
+    def __len__(self):
+        return len(self.pubmed_ids)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("LinkOutItems slices can't have a step.")
+            return LinkOutItems(
+                self.ids[start:stop], self.ucpms_ids[start:stop],
+                self.eschol_ids[start * id_width:stop * id_width], self.pubmed_ids[start:stop])
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("LinkOutItems index out of range")
+        return {
+            'id': get_optional_id(self.ids[key]),
+            'ucpms_id': get_optional_id(self.ucpms_ids[key]),
+            'eschol_id': decode_id(self.eschol_ids[key * id_width:(key + 1) * id_width].tobytes()),
+            'pubmed_id': str(self.pubmed_ids[key])}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Buffers are pickled as bytes, e.g. for a ProcessPoolExecutor.
+    def __reduce__(self):
+        return LinkOutItems, (
+            array('q', self.ids.tobytes()), array('q', self.ucpms_ids.tobytes()),
+            self.eschol_ids.tobytes(), array('q', self.pubmed_ids.tobytes()))
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.ucpms_ids.nbytes + self.eschol_ids.nbytes + self.pubmed_ids.nbytes
+
+    # Stored eschol_ids have no whitespace, so with the NUL padding turned
+    # into spaces they split apart in one call.
+    def get_eschol_ids(self, eschol_bytes=None):
+        if eschol_bytes is None:
+            eschol_bytes = self.eschol_ids.tobytes()
+        return eschol_bytes.replace(b'\0', b' ').split()
+
+    # (ucpms_id, eschol_id, pubmed_id) tuples, for linkout_db's bulk loader
+    def rows(self):
+        for ucpms_id, eschol_id, pubmed_id in zip(
+                self.ucpms_ids, self.get_eschol_ids(), self.pubmed_ids):
+            yield get_optional_id(ucpms_id), eschol_id.decode('ascii'), str(pubmed_id)
+
+    # (eschol_id, pubmed_id) pairs, for linkout_xml
+    def links(self):
+        for eschol_id, pubmed_id in zip(self.get_eschol_ids(), self.pubmed_ids):
+            yield eschol_id.decode('ascii'), pubmed_id
+
+    # =========================
+    # Rendering straight from the buffers: pubmed_ids are integers, so only
+    # the eschol_ids can ever need escaping, and they're checked in one pass.
+    def render_link_list(self):
+        eschol_bytes = self.eschol_ids.tobytes()
+        if needs_escaping(eschol_bytes):
+            return linkout_xml.render_link_list(self.links())
+        link_template = linkout_xml.link_template
+        return [
+            link_template % (eschol_id, b'%d' % pubmed_id, eschol_id[2:])
+            for eschol_id, pubmed_id in zip(self.get_eschol_ids(eschol_bytes), self.pubmed_ids)]
+
+    # The whole batch in one formatting call, with the template repeated
+    # once per link, rather than a bytes object per link joined afterwards.
+    def render(self):
+        eschol_bytes = self.eschol_ids.tobytes()
+        if needs_escaping(eschol_bytes):
+            return linkout_xml.render_links(self.links())
+        eschol_ids = self.get_eschol_ids(eschol_bytes)
+        fields = [None] * (3 * len(eschol_ids))
+        fields[0::3] = eschol_ids
+        fields[1::3] = [b'%d' % pubmed_id for pubmed_id in self.pubmed_ids]
+        fields[2::3] = [eschol_id[2:] for eschol_id in eschol_ids]
+        return (linkout_xml.link_template * len(eschol_ids)) % tuple(fields)
+
+    # Renders and writes batch_size links at a time; returns the link count.
+    def write_resource_file(self, file_name, batch_size=linkout_xml.default_batch_size):
+        with open(file_name, 'wb') as f, linkout_xml.LinkOutWriter(f) as writer:
+            for start in range(0, len(self), batch_size):
+                batch = self[start:start + batch_size]
+                writer.write_rendered(batch.render(), len(batch))
+        return writer.link_count
+
+    # Fixed pages of page_size items, as views.
+    def pages(self, page_size):
+        for start in range(0, len(self), page_size):
+            yield self[start:start + page_size]
+
+    # Same as linkout_xml.paginate_items, yielding (page view, rendered links).
+    def paginate(self, max_bytes=linkout_xml.default_max_file_bytes, max_links=None,
+                 batch_size=linkout_xml.default_batch_size):
+        page_start = 0
+        page_links = []
+        page_bytes = linkout_xml.file_overhead_bytes
+
+        for batch_start in range(0, len(self), batch_size):
+            batch = self[batch_start:batch_start + batch_size]
+            for i, rendered_link in enumerate(batch.render_link_list(), batch_start):
+                page_full = page_bytes + len(rendered_link) > max_bytes \
+                    or (max_links and len(page_links) == max_links)
+                if page_links and page_full:
+                    yield self[page_start:i], b''.join(page_links)
+                    page_start = i
+                    page_links = []
+                    page_bytes = linkout_xml.file_overhead_bytes
+
+                page_links.append(rendered_link)
+                page_bytes += len(rendered_link)
+
+        if page_links:
+            yield self[page_start:], b''.join(page_links)
+
+
+# =========================
+# Pages by rendered size over a stream of batches, with Paginator.
+# Closing it closes batches too, e.g. a reader still holding a file.
+def paginate_batches(batches, max_bytes=linkout_xml.default_max_file_bytes, max_links=None):
+    paginator = Paginator(max_bytes, max_links)
+    try:
+        for batch in batches:
+            yield from paginator.add(batch)
+        yield from paginator.finish()
+    finally:
+        close = getattr(batches, 'close', None)
+        if close is not None:
+            close()
+
+
+# Closes pages by rendered size over a stream of batches: add() yields the
+# pages each batch completes, and finish() the last, partial page. Pages
+# that fall within one batch are views; pages spanning batches are copied.
+class Paginator:
+
+    def __init__(self, max_bytes=linkout_xml.default_max_file_bytes, max_links=None):
+        self.max_bytes = max_bytes
+        self.max_links = max_links
+        self.reset()
+
+    def reset(self):
+        self.page_batches = []
+        self.page_links = []
+        self.page_bytes = linkout_xml.file_overhead_bytes
+
+    def add(self, batch):
+        start = 0
+        for i, rendered_link in enumerate(batch.render_link_list()):
+            page_count = len(self.page_links)
+            page_full = self.page_bytes + len(rendered_link) > self.max_bytes \
+                or (self.max_links and page_count == self.max_links)
+            if page_count and page_full:
+                self.page_batches.append(batch[start:i])
+                yield self.get_page()
+                self.reset()
+                start = i
+
+            self.page_links.append(rendered_link)
+            self.page_bytes += len(rendered_link)
+
+        if start < len(batch):
+            self.page_batches.append(batch[start:])
+
+    def finish(self):
+        if self.page_links:
+            yield self.get_page()
+        self.reset()
+
+    def get_page(self):
+        batches = [batch for batch in self.page_batches if len(batch)]
+        page = batches[0] if len(batches) == 1 else LinkOutItems.concat(batches)
+        return page, b''.join(self.page_links)
+
+
+# Regroups a stream of batches into pages of page_size items (the last
+# may be shorter). As with Paginator, pages spanning batches are copied.
+def iter_pages(batches, page_size):
+    pending = []
+    pending_count = 0
+    for batch in batches:
+        start = 0
+        while start < len(batch):
+            take = min(page_size - pending_count, len(batch) - start)
+            pending.append(batch[start:start + take])
+            pending_count += take
+            start += take
+            if pending_count == page_size:
+                yield pending[0] if len(pending) == 1 else LinkOutItems.concat(pending)
+                pending = []
+                pending_count = 0
+
+    if pending_count:
+        yield pending[0] if len(pending) == 1 else LinkOutItems.concat(pending)
+
+
+# =========================
+# Packing values into the buffers (ids, ucpms_ids, eschol_ids, pubmed_ids),
+# from columns of up to pack_size rows.
+def iter_chunks(rows):
+    rows = iter(rows)
+    while chunk := list(islice(rows, pack_size)):
+        yield chunk
+
+
+# Packs every row a column at a time, if they're all valid, and returns
+# True; otherwise packs nothing and returns False.
+def pack_valid_columns(columns, buffers):
+    id_values, ucpms_values, eschol_values, pubmed_values = columns
+
+    pubmed_ints = all_ints(pubmed_values)
+    if pubmed_ints:
+        if not 0 < min(pubmed_values) <= max(pubmed_values) <= max_pubmed_id:
+            return False
+    elif not all_match(pubmed_id_pattern, pubmed_values):
+        return False
+    if not all_match(eschol_id_pattern, eschol_values):
+        return False
+
+    ids, ucpms_ids, eschol_ids, pubmed_ids = buffers
+    ids.fromlist(get_ids(id_values, len(pubmed_values)))
+    ucpms_ids.fromlist(get_ids(ucpms_values, len(pubmed_values)))
+    eschol_ids += ''.join(
+        map(str.ljust, eschol_values, repeat(id_width), repeat('\0'))).encode('ascii')
+    pubmed_ids.fromlist(pubmed_values if pubmed_ints else list(map(int, pubmed_values)))
+    return True
+
+
+# Packs the rows one at a time, leaving out and adding to rejects any
+# that can't be stored.
+def pack_rows(columns, buffers, rejects):
+    id_values, ucpms_values, eschol_values, pubmed_values = columns
+    row_count = len(pubmed_values)
+    ids, ucpms_ids, eschol_ids, pubmed_ids = buffers
+
+    for item_id, ucpms_id, eschol_id, pubmed_value in zip(
+            id_values or [None] * row_count, ucpms_values or [None] * row_count,
+            eschol_values, pubmed_values):
+        pubmed_id = get_pubmed_id(pubmed_value)
+        if not is_eschol_id(eschol_id):
+            message = f"eschol_id isn't 1 to {id_width} printable ASCII characters: {eschol_id!r}"
+        elif pubmed_id is None:
+            message = f"pubmed_id isn't a PubMed ID: {pubmed_value!r}"
+        else:
+            ids.append(get_id(item_id))
+            ucpms_ids.append(get_id(ucpms_id))
+            eschol_ids += eschol_id.ljust(id_width, '\0').encode('ascii')
+            pubmed_ids.append(pubmed_id)
+            continue
+        rejects.append((item_id, eschol_id, message))
+
+
+def get_ids(values, row_count):
+    if values is None:
+        return [missing_id] * row_count
+    if all_ints(values):
+        return values
+    return [get_id(value) for value in values]
+
+
+# bool is an int subclass, but True shouldn't pass for an ID of 1
+def all_ints(values):
+    return set(map(type, values)) == {int}
+
+
+# True if every value is a str that pattern matches in full
+def all_match(pattern, values):
+    try:
+        return all(map(pattern.fullmatch, values))
+    except TypeError:
+        return False
+
+
+# =========================
+def needs_escaping(eschol_bytes):
+    return b'&' in eschol_bytes or b'<' in eschol_bytes or b'>' in eschol_bytes
+
+
+def get_id(value):
+    return missing_id if value is None or value == '' else int(value)
+
+
+def get_optional_id(value):
+    return None if value == missing_id else value
+
+
+# The pubmed_id as an integer, or None if it wouldn't read back the same
+def get_pubmed_id(value):
+    if isinstance(value, int):
+        value = str(value)
+    elif isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    elif not isinstance(value, str):
+        return None
+    value = value.strip()
+    return int(value) if is_pubmed_id(value) else None
+
+
+def is_eschol_id(value):
+    return isinstance(value, str) and eschol_id_pattern.fullmatch(value) is not None
+
+
+def is_pubmed_id(value):
+    return value.isascii() and value.isdigit() and len(value) <= max_pubmed_id_digits \
+        and not value.startswith('0')
+
+
+def report_rejects(rejects):
+    for item_id, eschol_id, message in rejects:
+        print(f"Skipping linkout item {item_id if item_id is not None else eschol_id}: {message}")
+    linkout_metrics.count('rejects', len(rejects))
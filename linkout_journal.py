@@ -0,0 +1,127 @@
+# Crash-safe journal of a run's progress, so a failed run can be resumed
+# instead of redone from the start.
+#
+# Each run appends JSON lines to state/journal/<job>/<run_time>.jsonl:
+#   {"event": "start", "params": {...}}       how the run was set up
+#   {"event": "rendered", "file": ..., ...}   a file was written, with
+#                                             whatever the job needs to
+#                                             finish it (page, id range)
+#   {"event": "uploaded", "file": ...}        its upload was confirmed
+#   {"event": "committed", "file": ...}       the logging DB was updated
+#   {"event": "finished"}                     the run completed
+# Jobs can add their own events (e.g. "paginated" once every page is
+# written). Each line is flushed and fsynced before the step that follows
+# it, so the journal never claims more than really happened; a line torn
+# by a crash mid-write is dropped when the journal is read back.
+
+import glob
+import json
+import os
+import threading
+
+journal_dir = "state/journal"
+
+
+# =========================
+class RunJournal:
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.params = {}
+        self.files = {}
+        self.events = set()
+
+        if os.path.exists(journal_file):
+            self.load()
+
+    # Starts a new journal for this run of job. Raises FileExistsError
+    # rather than mix two runs started in the same second.
+    @classmethod
+    def start(cls, job, run_time, params):
+        journal_file = os.path.join(journal_dir, job, f"{run_time}.jsonl")
+        os.makedirs(os.path.dirname(journal_file), exist_ok=True)
+        open(journal_file, 'x').close()
+        journal = cls(journal_file)
+        journal.record('start', params=params)
+        return journal
+
+    # The most recent run of job, if it didn't finish; otherwise None.
+    @classmethod
+    def latest_unfinished(cls, job):
+        journal_files = sorted(glob.glob(os.path.join(journal_dir, job, "*.jsonl")))
+        if not journal_files:
+            return None
+        journal = cls(journal_files[-1])
+        return None if 'finished' in journal.events else journal
+
+    def load(self):
+        with open(self.journal_file, 'rb') as f:
+            content = f.read()
+
+        # Only the last line can be torn by a crash. It's cut off, so that
+        # records appended from here on start on a line of their own.
+        complete_bytes = content.rfind(b'\n') + 1
+        if complete_bytes < len(content):
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(complete_bytes)
+
+        lines = content[:complete_bytes].decode('utf-8').splitlines()
+        for line_number, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError(f"{self.journal_file}:{line_number} is corrupt.") from None
+            self.apply(record)
+
+    def apply(self, record):
+        event = record['event']
+        if event == 'start':
+            self.params = record['params']
+        elif 'file' in record:
+            details = {k: v for k, v in record.items() if k not in ('event', 'file')}
+            entry = self.files.setdefault(record['file'], {})
+
+            # A file written again with different contents starts over
+            if event == 'rendered' and any(
+                    entry.get(k, v) != v for k, v in details.items()):
+                entry.clear()
+            entry.update(details)
+            entry[event] = True
+        else:
+            self.events.add(event)
+
+    # Appends one record, durably, before returning.
+    def record(self, event, **fields):
+        record = {'event': event, **fields}
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            with open(self.journal_file, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.apply(record)
+
+    def is_done(self, file_name, event):
+        with self.lock:
+            return self.files.get(file_name, {}).get(event, False)
+
+    def finish(self):
+        self.record('finished')
+        print(f"Run journal complete: {self.journal_file}")
+
+
+# Compact [[first, last], ...] runs of consecutive ids, for journaling
+# which linkout_items rows went into a file.
+def to_id_ranges(ids):
+    id_ranges = []
+    for item_id in sorted(ids):
+        if id_ranges and item_id == id_ranges[-1][1] + 1:
+            id_ranges[-1][1] = item_id
+        else:
+            id_ranges.append([item_id, item_id])
+    return id_ranges
+
+
+def from_id_ranges(id_ranges):
+    return [item_id for first, last in id_ranges for item_id in range(first, last + 1)]
@@ -0,0 +1,199 @@
+# Per-run metrics for the LinkOut jobs.
+#
+# Each job wraps its run in RunMetrics and each step in run.stage(name).
+# Stages record wall time; code inside a stage adds counters (rows,
+# bytes_written, bytes_sent, db_round_trips, ...) with count(). Peak RSS
+# is a high-water mark for the whole process, so it is recorded once per
+# run rather than per stage.
+#
+# The open stage is tracked per thread. A thread started inside a stage
+# has none of its own, so code that starts worker threads passes them its
+# current_stage(), or a stage name, to wrap their work in attach_stage().
+# When the run ends, one JSON line is appended to the metrics file, and
+# if METRICS_PROMETHEUS_DIR is set, a linkout_<job>.prom textfile is
+# written there for the node_exporter textfile collector.
+#
+# count() is a no-op outside a stage, and stage() outside a run, so
+# shared modules can call them unconditionally.
+
+from contextlib import contextmanager
+import datetime
+import json
+import os
+import resource
+import threading
+import time
+
+default_metrics_file = "output/linkout_metrics.jsonl"
+
+# Stack of active runs; a job that calls another job's main() (enqueue
+# calling submit) gets a separate record for the inner run.
+active_runs = []
+
+
+# =========================
+class RunMetrics:
+
+    def __init__(self, job, env=None):
+        env = env or {}
+        self.job = job
+        self.metrics_file = env.get('METRICS_FILE') or default_metrics_file
+        self.prometheus_dir = env.get('METRICS_PROMETHEUS_DIR')
+        self.stages = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.start = None
+
+    def __enter__(self):
+        self.started_at = datetime.datetime.now().replace(microsecond=0).isoformat()
+        self.start = time.monotonic()
+        active_runs.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        active_runs.remove(self)
+
+        if exc_type is None:
+            status = 'ok'
+        elif exc_type is SystemExit and exc_value.code in (0, None):
+            status = 'ok'
+        elif exc_type is SystemExit:
+            status = f'exit {exc_value.code}'
+        else:
+            status = f'failed: {exc_type.__name__}'
+
+        self.emit(status)
+
+    # The calling thread's open stage
+    @property
+    def current_stage(self):
+        return getattr(self.local, 'stage', None)
+
+    def get_stage(self, name):
+        with self.lock:
+            return self.stages.setdefault(name, {})
+
+    @contextmanager
+    def stage(self, name):
+        stage_metrics = self.get_stage(name)
+        start = time.monotonic()
+        try:
+            with self.attach_stage(stage_metrics):
+                yield stage_metrics
+        finally:
+            with self.lock:
+                stage_metrics['wall_seconds'] = round(
+                    stage_metrics.get('wall_seconds', 0.0) + time.monotonic() - start, 3)
+
+    # Credits the calling thread's counts to a stage (its metrics, or its
+    # name) without timing it, for worker threads doing that stage's work.
+    @contextmanager
+    def attach_stage(self, stage_metrics):
+        if isinstance(stage_metrics, str):
+            stage_metrics = self.get_stage(stage_metrics)
+        outer_stage = self.current_stage
+        self.local.stage = stage_metrics
+        try:
+            yield stage_metrics
+        finally:
+            self.local.stage = outer_stage
+
+    def count(self, name, n=1):
+        stage_metrics = self.current_stage
+        if stage_metrics is not None:
+            with self.lock:
+                stage_metrics[name] = stage_metrics.get(name, 0) + n
+
+    def get_record(self, status):
+        return {
+            'job': self.job,
+            'started_at': self.started_at,
+            'status': status,
+            'wall_seconds': round(time.monotonic() - self.start, 3),
+            'peak_rss_mb': get_peak_rss_mb(),
+            'children_peak_rss_mb': get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'stages': self.stages}
+
+    def emit(self, status):
+        record = self.get_record(status)
+
+        metrics_dir = os.path.dirname(self.metrics_file)
+        if metrics_dir:
+            os.makedirs(metrics_dir, exist_ok=True)
+        with open(self.metrics_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        if self.prometheus_dir:
+            write_prometheus_textfile(
+                os.path.join(self.prometheus_dir, f"linkout_{self.job}.prom"), record)
+
+
+# Adds to a counter on the calling thread's stage of the innermost active run.
+def count(name, n=1):
+    if active_runs:
+        active_runs[-1].count(name, n)
+
+
+# Times a stage of the innermost active run, for shared code that
+# doesn't have the run at hand.
+@contextmanager
+def stage(name):
+    if not active_runs:
+        yield None
+        return
+    with active_runs[-1].stage(name) as stage_metrics:
+        yield stage_metrics
+
+
+# The calling thread's open stage, to pass to attach_stage() in threads
+# it starts.
+def current_stage():
+    if not active_runs:
+        return None
+    return active_runs[-1].current_stage
+
+
+# Runs the calling thread's work as part of a stage (the metrics from
+# current_stage(), or a stage name). A no-op outside a run or with no stage.
+@contextmanager
+def attach_stage(stage_metrics):
+    if not active_runs or stage_metrics is None:
+        yield None
+        return
+    with active_runs[-1].attach_stage(stage_metrics) as attached_metrics:
+        yield attached_metrics
+
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+# =========================
+def write_prometheus_textfile(prometheus_file, record):
+    job = record['job']
+    lines = [
+        '# TYPE linkout_run_wall_seconds gauge',
+        f'linkout_run_wall_seconds{{job="{job}"}} {record["wall_seconds"]}',
+        '# TYPE linkout_run_peak_rss_mb gauge',
+        f'linkout_run_peak_rss_mb{{job="{job}"}} {record["peak_rss_mb"]}',
+        '# TYPE linkout_run_success gauge',
+        f'linkout_run_success{{job="{job}"}} {1 if record["status"] == "ok" else 0}',
+        '# TYPE linkout_run_last_timestamp_seconds gauge',
+        f'linkout_run_last_timestamp_seconds{{job="{job}"}} {time.time():.0f}',
+    ]
+
+    metric_names = sorted({name for stage in record['stages'].values() for name in stage})
+    for metric_name in metric_names:
+        lines.append(f'# TYPE linkout_stage_{metric_name} gauge')
+        for stage_name, stage in record['stages'].items():
+            if metric_name in stage:
+                lines.append(
+                    f'linkout_stage_{metric_name}{{job="{job}",stage="{stage_name}"}} {stage[metric_name]}')
+
+    # Written to a temp file and renamed so the collector never reads a partial file
+    temp_file = f"{prometheus_file}.tmp"
+    with open(temp_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_file, prometheus_file)
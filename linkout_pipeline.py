@@ -0,0 +1,159 @@
+# Bounded producer-consumer pipeline for overlapping fetch / render /
+# upload / commit.
+#
+# The source iterable is read in its own thread, and each stage runs in
+# its own thread(s), connected by bounded queues: a stage that falls
+# behind makes the ones before it wait (backpressure) instead of letting
+# work pile up in memory. If any stage raises, the others are cancelled
+# and the first error is re-raised from run_pipeline.
+#
+# Counts from the source thread go to the caller's metrics stage, and
+# counts from a stage's workers to the metrics stage of the same name.
+
+from queue import Queue, Empty, Full
+import threading
+import time
+import linkout_metrics
+
+default_queue_size = 2
+poll_seconds = 0.1
+end_of_stream = object()
+
+
+# =========================
+class PipelineCancelled(Exception):
+    pass
+
+
+# One step of the pipeline: fn(item) returns the item passed downstream.
+# With workers > 1, items may leave the stage out of order.
+class Stage:
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.busy_seconds = 0.0
+        self.item_count = 0
+        self.lock = threading.Lock()
+
+
+# enumerate() as a generator, for use as a pipeline source: run_pipeline
+# closes its source when it stops, and closing this closes the iterable
+# it numbers too (e.g. a generator holding a streaming DB cursor), rather
+# than leaving that to garbage collection.
+def numbered(iterable, start=0):
+    try:
+        yield from enumerate(iterable, start)
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+# Runs source through stages; returns the last stage's outputs.
+def run_pipeline(source, stages, queue_size=default_queue_size):
+    cancelled = threading.Event()
+    errors = []
+    queues = [Queue(maxsize=queue_size) for _ in stages]
+    results = []
+    results_lock = threading.Lock()
+    caller_stage = linkout_metrics.current_stage()
+
+    def fail(e):
+        with results_lock:
+            errors.append(e)
+        cancelled.set()
+
+    def put(q, item):
+        while not cancelled.is_set():
+            try:
+                q.put(item, timeout=poll_seconds)
+                return
+            except Full:
+                continue
+        raise PipelineCancelled()
+
+    def get(q):
+        while not cancelled.is_set():
+            try:
+                return q.get(timeout=poll_seconds)
+            except Empty:
+                continue
+        raise PipelineCancelled()
+
+    def read_source():
+        try:
+            with linkout_metrics.attach_stage(caller_stage):
+                for item in source:
+                    put(queues[0], item)
+            put(queues[0], end_of_stream)
+        except PipelineCancelled:
+            pass
+        except BaseException as e:
+            fail(e)
+        finally:
+            # Let a generator source clean up (e.g. close its DB cursor)
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+
+    def run_stage(stage_index, stage, finished_workers):
+        in_queue = queues[stage_index]
+        out_queue = queues[stage_index + 1] if stage_index + 1 < len(stages) else None
+        try:
+            while True:
+                item = get(in_queue)
+                if item is end_of_stream:
+                    # Pass the marker on to this stage's other workers,
+                    # and downstream once every worker is done.
+                    put(in_queue, end_of_stream)
+                    with stage.lock:
+                        finished_workers[0] += 1
+                        last_worker = finished_workers[0] == stage.workers
+                    if last_worker and out_queue is not None:
+                        put(out_queue, end_of_stream)
+                    return
+
+                start = time.monotonic()
+                with linkout_metrics.attach_stage(stage.name):
+                    output = stage.fn(item)
+                with stage.lock:
+                    stage.busy_seconds += time.monotonic() - start
+                    stage.item_count += 1
+
+                if out_queue is None:
+                    with results_lock:
+                        results.append(output)
+                else:
+                    put(out_queue, output)
+        except PipelineCancelled:
+            pass
+        except BaseException as e:
+            fail(e)
+
+    threads = [threading.Thread(target=read_source, name="pipeline-source")]
+    for stage_index, stage in enumerate(stages):
+        finished_workers = [0]
+        for worker in range(stage.workers):
+            threads.append(threading.Thread(
+                target=run_stage, args=(stage_index, stage, finished_workers),
+                name=f"pipeline-{stage.name}-{worker}"))
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.monotonic() - start
+
+    if errors:
+        raise errors[0]
+
+    for stage in stages:
+        print(f"Pipeline stage {stage.name}: {stage.item_count} items, "
+              f"{stage.busy_seconds:.2f}s busy across {stage.workers} workers "
+              f"in {wall_seconds:.2f}s.")
+        linkout_metrics.count(f"{stage.name}_busy_seconds", round(stage.busy_seconds, 3))
+
+    return results
@@ -0,0 +1,183 @@
+# Finds PMID-linked items in several sources at once and merges them
+# into one deduplicated stream.
+#
+# Each source is an iterable of tuples whose first fields are
+# (ucpms_id, eschol_id, pubmed_id), like linkout_db's bulk loader takes:
+#   - Elements reporting DB rows (see enqueue_new_pubmed_items_elements)
+#   - the eScholarship DB's items with a pmid local ID, by way of
+#     eschol_pmid_index (iter_eschol_items)
+#   - the Elements batch CSV (iter_csv_items)
+#
+# The sources are read in their own threads, and their rows are hash-joined
+# on eschol_id as they arrive, in one pass. An eschol_id found with more
+# than one PMID, whether from different sources or the same one, is a
+# conflict: it's held back from the merged stream and kept in
+# SourceMerge.conflicts to be reported instead.
+
+from collections import namedtuple
+import csv
+from queue import Queue, Empty, Full
+import re
+import threading
+import eschol_pmid_index
+import linkout_csv
+import linkout_metrics
+
+batch_size = 5000
+poll_seconds = 0.1
+batch_input_file = "input/ucpms-eschol-pubmed-batch-input.csv"
+pmid_pattern = re.compile('[0-9]+')
+end_of_source = object()
+
+# Fields in linkout_db.linkout_columns order, so merged items can go
+# straight to the bulk loader; sources lists the sources it was found in.
+MergedItem = namedtuple('MergedItem', ['ucpms_id', 'eschol_id', 'pubmed_id', 'sources'])
+
+# =========================
+# Sources
+# Read from the logging DB's side index, once it's synced with the eSchol DB
+def iter_eschol_items(env):
+    eschol_pmid_index.sync(env)
+    yield from eschol_pmid_index.iter_indexed_items(env)
+
+
+# The CSV has eschol_id, ucpms_id and pubmed_id columns, in any order.
+# It's parsed in typed chunks by linkout_csv; malformed rows are reported
+# with their line numbers once it's read.
+def iter_csv_items(file_name=batch_input_file):
+    print(f"Reading items from {file_name}.")
+    csv_reader = linkout_csv.CsvItemReader(file_name)
+    for batch in csv_reader:
+        yield from batch.rows()
+    csv_reader.report()
+
+
+# =========================
+class SourceMerge:
+
+    # sources is {source name: iterable of rows}
+    def __init__(self, sources):
+        self.sources = sources
+        self.entries = {}
+        self.conflicts = {}
+        self.source_counts = dict.fromkeys(sources, 0)
+        self.invalid_counts = dict.fromkeys(sources, 0)
+
+    # Yields MergedItems ordered by eschol_id once every source is read,
+    # since a later row from any source could still contradict an earlier one.
+    def __iter__(self):
+        with linkout_metrics.stage('merge_sources'):
+            self.read_sources()
+
+        for eschol_id in sorted(self.entries):
+            ucpms_id, pubmed_sources = self.entries[eschol_id]
+            if len(pubmed_sources) > 1:
+                self.conflicts[eschol_id] = {
+                    pubmed_id: sorted(sources) for pubmed_id, sources in pubmed_sources.items()}
+                continue
+            (pubmed_id, sources), = pubmed_sources.items()
+            yield MergedItem(ucpms_id, eschol_id, pubmed_id, sorted(sources))
+
+        self.report()
+
+    # Each source is read in its own thread into one bounded queue, and
+    # the rows are joined here as they arrive.
+    def read_sources(self):
+        batches = Queue(maxsize=2 * len(self.sources))
+        cancelled = threading.Event()
+        errors = []
+        caller_stage = linkout_metrics.current_stage()
+
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    batches.put(item, timeout=poll_seconds)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def read_source(name, rows):
+            try:
+                with linkout_metrics.attach_stage(caller_stage):
+                    batch = []
+                    for row in rows:
+                        batch.append(row)
+                        if len(batch) >= batch_size:
+                            if not put((name, batch)):
+                                return
+                            batch = []
+                    if batch:
+                        put((name, batch))
+            except BaseException as e:
+                errors.append(e)
+                cancelled.set()
+            finally:
+                # Let a generator source clean up (e.g. close its DB cursor)
+                close = getattr(rows, 'close', None)
+                if close is not None:
+                    close()
+                put((name, end_of_source))
+
+        threads = [
+            threading.Thread(target=read_source, args=(name, rows), name=f"source-{name}")
+            for name, rows in self.sources.items()]
+        for thread in threads:
+            thread.start()
+
+        try:
+            open_sources = len(threads)
+            while open_sources and not cancelled.is_set():
+                try:
+                    name, batch = batches.get(timeout=poll_seconds)
+                except Empty:
+                    continue
+                if batch is end_of_source:
+                    open_sources -= 1
+                else:
+                    self.join_batch(name, batch)
+        finally:
+            cancelled.set()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+    # Keeps {eschol_id: [ucpms_id, {pubmed_id: source names}]}. A ucpms_id
+    # is taken from whichever source has one (the eSchol DB doesn't).
+    def join_batch(self, name, batch):
+        entries = self.entries
+        for row in batch:
+            eschol_id = str(row[1]).strip()
+            pubmed_id = str(row[2]).strip()
+            if not pmid_pattern.fullmatch(pubmed_id):
+                self.invalid_counts[name] += 1
+                continue
+
+            entry = entries.get(eschol_id)
+            if entry is None:
+                entries[eschol_id] = [row[0], {pubmed_id: {name}}]
+            else:
+                if entry[0] is None:
+                    entry[0] = row[0]
+                entry[1].setdefault(pubmed_id, set()).add(name)
+        self.source_counts[name] += len(batch)
+
+    def report(self):
+        for name, row_count in self.source_counts.items():
+            print(f"{name}: {row_count} rows, {self.invalid_counts[name]} without a numeric PMID.")
+            linkout_metrics.count(f"{name}_rows", row_count)
+        print(f"{len(self.entries)} distinct eSchol IDs, "
+              f"{len(self.conflicts)} with conflicting PMIDs held back.")
+        linkout_metrics.count('merged_items', len(self.entries) - len(self.conflicts))
+        linkout_metrics.count('pmid_conflicts', len(self.conflicts))
+
+    # One row per conflicting PMID: eschol_id, pubmed_id, sources
+    def write_conflicts(self, file_name):
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['eschol_id', 'pubmed_id', 'sources'])
+            for eschol_id, pubmed_sources in sorted(self.conflicts.items()):
+                for pubmed_id, sources in sorted(pubmed_sources.items()):
+                    writer.writerow([eschol_id, pubmed_id, ' '.join(sources)])
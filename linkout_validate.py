@@ -0,0 +1,255 @@
+# Validates generated LinkOut resource files before they're uploaded.
+# https://www.ncbi.nlm.nih.gov/books/NBK3812/
+#
+# Files are parsed incrementally with expat, chunk_size bytes at a time,
+# so even very large files are never held in memory. Each file is checked
+# against the LinkOut 1.0 structure the scripts generate:
+#   - the LinkSet doctype, with the &icon.url; and &base.url; entities
+#     declared with their expected values, and no undeclared entities
+#   - every Link has LinkId, ProviderId, IconUrl, ObjectSelector
+#     (Database, ObjectList of ObjIds) and ObjectUrl (Base, Rule, UrlName,
+#     Attribute), in that order, and nothing else
+#   - LinkIds are unique, ObjIds are numeric PMIDs, and each Rule is its
+#     LinkId without the "qt" prefix
+#
+# Usage: python linkout_validate.py output/*.xml
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re
+import sys
+from xml.parsers import expat
+import linkout_metrics
+import linkout_xml
+
+chunk_size = 1024 * 1024
+default_max_errors = 20
+public_id = "-//NLM//DTD LinkOut 1.0//EN"
+expected_entities = {
+    'icon.url': "https://escholarship.org/images/pubmed_linkback.png",
+    'base.url': "https://escholarship.org/uc/item/"}
+
+# Required children of each container element, in order. ObjectList
+# holds one or more ObjIds, and LinkSet any number of Links.
+expected_children = {
+    'Link': ('LinkId', 'ProviderId', 'IconUrl', 'ObjectSelector', 'ObjectUrl'),
+    'ObjectSelector': ('Database', 'ObjectList'),
+    'ObjectUrl': ('Base', 'Rule', 'UrlName', 'Attribute'),
+}
+repeated_children = {'LinkSet': 'Link', 'ObjectList': 'ObjId'}
+
+# Expected text of each leaf element; None means any non-empty text.
+expected_text = {
+    'LinkId': None,
+    'ProviderId': linkout_xml.provider_id,
+    'IconUrl': expected_entities['icon.url'],
+    'Database': "PubMed",
+    'ObjId': None,
+    'Base': expected_entities['base.url'],
+    'Rule': None,
+    'UrlName': "Full text from University of California eScholarship",
+    'Attribute': "full-text PDF",
+}
+known_elements = set(expected_children) | set(repeated_children) | set(expected_text)
+pmid_pattern = re.compile('[0-9]+')
+
+
+# =========================
+class LinkOutValidationError(Exception):
+    pass
+
+
+class LinkOutValidator:
+
+    def __init__(self, file_name, max_errors=default_max_errors):
+        self.file_name = file_name
+        self.max_errors = max_errors
+        self.errors = []
+        self.doctype = None
+        self.entities = {}
+        self.stack = []
+        self.text = ''
+        self.link = None
+        self.link_ids = set()
+        self.link_count = 0
+
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartDoctypeDeclHandler = self.start_doctype
+        self.parser.EndDoctypeDeclHandler = self.end_doctype
+        self.parser.EntityDeclHandler = self.declare_entity
+        self.parser.SkippedEntityHandler = self.skip_entity
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+
+    # Returns a list of error messages; empty if the file is valid.
+    def validate(self):
+        try:
+            with open(self.file_name, 'rb') as f:
+                while chunk := f.read(chunk_size):
+                    self.parser.Parse(chunk, False)
+                    if len(self.errors) >= self.max_errors:
+                        return self.errors
+            self.parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            self.error(f"not well-formed: {expat.ErrorString(e.code)}", e.lineno)
+            return self.errors
+
+        if self.doctype is None:
+            self.error("missing the LinkSet doctype", 1)
+        return self.errors
+
+    def error(self, message, line=None):
+        if len(self.errors) < self.max_errors:
+            line = line or self.parser.CurrentLineNumber
+            self.errors.append(f"{os.path.basename(self.file_name)}:{line}: {message}")
+
+    # =========================
+    # expat handlers
+    def start_doctype(self, name, system_id, doctype_public_id, has_internal_subset):
+        self.doctype = (name, doctype_public_id)
+
+    # Checked as soon as the doctype ends, before any Link can use the entities
+    def end_doctype(self):
+        if self.doctype != ('LinkSet', public_id):
+            self.error(f"expected a LinkSet doctype with public ID {public_id}")
+        for name, value in expected_entities.items():
+            if self.entities.get(name) != value:
+                self.error(f"entity {name} should be declared as {value}")
+
+    def declare_entity(self, name, is_parameter, value, base, system_id, entity_public_id, notation):
+        self.entities[name] = value
+
+    def skip_entity(self, name, is_parameter):
+        self.error(f"undeclared entity &{name};")
+
+    # The stack holds [name, child names] for each open element (None for
+    # leaves), and text collects the character data since the last tag.
+    def start_element(self, name, attributes):
+        if self.text and not self.text.isspace():
+            self.error(f"unexpected text {self.text.strip()!r}")
+        self.text = ''
+
+        if self.stack:
+            children = self.stack[-1][1]
+            if children is None:
+                self.error(f"{self.stack[-1][0]} shouldn't contain {name}")
+            else:
+                children.append(name)
+        elif name != 'LinkSet':
+            self.error(f"root element should be LinkSet, not {name}")
+
+        if name not in known_elements:
+            self.error(f"unexpected element {name}")
+        if attributes:
+            self.error(f"{name} shouldn't have attributes")
+
+        if name == 'Link':
+            self.link = {}
+        self.stack.append([name, None if name in expected_text else []])
+
+    def character_data(self, data):
+        self.text += data
+
+    def end_element(self, name):
+        children = self.stack.pop()[1]
+        text = self.text
+        self.text = ''
+
+        if children is None:
+            self.check_leaf(name, text)
+            if self.link is not None:
+                self.link[name] = text
+            return
+
+        if text and not text.isspace():
+            self.error(f"unexpected text {text.strip()!r}")
+        if name in expected_children:
+            if tuple(children) != expected_children[name]:
+                self.error(f"{name} should contain {', '.join(expected_children[name])}, "
+                           f"not {', '.join(children) or 'nothing'}")
+        elif name in repeated_children:
+            child = repeated_children[name]
+            if any(c != child for c in children):
+                self.error(f"{name} should only contain {child} elements")
+            if name == 'ObjectList' and not children:
+                self.error("ObjectList should contain at least one ObjId")
+
+        if name == 'Link':
+            self.check_link(self.link)
+            self.link = None
+
+    def check_leaf(self, name, text):
+        expected = expected_text[name]
+        if expected is not None and text != expected:
+            self.error(f"{name} should be {expected!r}, not {text!r}")
+        elif expected is None and (not text or text.isspace()):
+            self.error(f"{name} is empty")
+        elif name == 'ObjId' and not pmid_pattern.fullmatch(text):
+            self.error(f"ObjId isn't a numeric PMID: {text!r}")
+
+    # link holds the text of the Link's leaf elements, by name
+    def check_link(self, link):
+        self.link_count += 1
+        link_id = link.get('LinkId')
+        if not link_id:
+            return
+        if link_id in self.link_ids:
+            self.error(f"duplicate LinkId {link_id}")
+        self.link_ids.add(link_id)
+        if link.get('Rule') is not None and link['Rule'] != link_id[2:]:
+            self.error(f"Rule {link['Rule']!r} doesn't match LinkId {link_id!r}")
+
+
+def validate_file(file_name, max_errors=default_max_errors):
+    return LinkOutValidator(file_name, max_errors).validate()
+
+
+# =========================
+# Validates files in parallel, one process per file up to workers.
+# Returns {file name: errors} for the files that failed.
+def validate_files(files, workers=None):
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    if workers <= 1:
+        results = [validate_file(file_name) for file_name in files]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(validate_file, files))
+
+    linkout_metrics.count('files_validated', len(files))
+    return {file_name: errors for file_name, errors in zip(files, results) if errors}
+
+
+# Raises LinkOutValidationError, listing the problems, if any file is invalid.
+def check_files(files, workers=None):
+    if not files:
+        return
+    print(f"Validating {len(files)} LinkOut files.")
+    with linkout_metrics.stage('validate'):
+        failures = validate_files(files, workers)
+    if failures:
+        raise LinkOutValidationError(
+            f"{len(failures)} of {len(files)} files failed validation:\n" +
+            "\n".join(error for errors in failures.values() for error in errors))
+    print(f"All {len(files)} files are valid.")
+
+
+# For pipelines, which validate each file as soon as it's written.
+# Returns file_name, so it can be a pipeline stage by itself.
+def check_file(file_name):
+    errors = validate_file(file_name)
+    linkout_metrics.count('files_validated')
+    if errors:
+        raise LinkOutValidationError(
+            f"{file_name} failed validation:\n" + "\n".join(errors))
+    return file_name
+
+
+# =========================
+if __name__ == '__main__':
+    failures = validate_files(sys.argv[1:])
+    for errors in failures.values():
+        print("\n".join(errors))
+    print(f"{len(sys.argv) - 1 - len(failures)} valid, {len(failures)} invalid.")
+    sys.exit(1 if failures else 0)
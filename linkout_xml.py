@@ -0,0 +1,183 @@
+# LinkOut resource file renderer, shared by every entry point
+# https://www.ncbi.nlm.nih.gov/books/NBK3812/
+#
+# Each link is rendered by filling a precompiled byte template, and
+# batches of links are joined and written in bulk, so a file is never
+# built up as an element tree or held in memory as a whole.
+#
+# Links are (eschol_id, pubmed_id) pairs. The LinkId is the full eSchol ID
+# (e.g. qt1234abcd) and the Rule is the ID without its "qt" prefix, which
+# &base.url; turns into https://escholarship.org/uc/item/1234abcd.
+
+from itertools import islice
+import re
+from xml.sax.saxutils import escape
+
+provider_id = "7383"
+default_batch_size = 5000
+
+# Target size for paginated resource files; see paginate_items
+default_max_file_bytes = 10 * 1024 * 1024
+
+doctype_header = '<?xml version="1.0" ?>\n' \
+                 '<!DOCTYPE LinkSet PUBLIC "-//NLM//DTD LinkOut 1.0//EN" ' \
+                 '"https://www.ncbi.nlm.nih.gov/projects/linkout/doc/LinkOut.dtd" ' \
+                 '[<!ENTITY icon.url "https://escholarship.org/images/pubmed_linkback.png"> ' \
+                 '<!ENTITY base.url "https://escholarship.org/uc/item/" > ]>\n'
+
+# The &icon.url; and &base.url; entities are declared in the doctype header,
+# so they're written as-is here instead of being escaped and replaced after.
+# Placeholders, in order: LinkId, ObjId, Rule.
+link_template = (
+    '\n\t<Link>'
+    '\n\t\t<LinkId>%s</LinkId>'
+    '\n\t\t<ProviderId>' + provider_id + '</ProviderId>'
+    '\n\t\t<IconUrl>&icon.url;</IconUrl>'
+    '\n\t\t<ObjectSelector>'
+    '\n\t\t\t<Database>PubMed</Database>'
+    '\n\t\t\t<ObjectList>'
+    '\n\t\t\t\t<ObjId>%s</ObjId>'
+    '\n\t\t\t</ObjectList>'
+    '\n\t\t</ObjectSelector>'
+    '\n\t\t<ObjectUrl>'
+    '\n\t\t\t<Base>&base.url;</Base>'
+    '\n\t\t\t<Rule>%s</Rule>'
+    '\n\t\t\t<UrlName>Full text from University of California eScholarship</UrlName>'
+    '\n\t\t\t<Attribute>full-text PDF</Attribute>'
+    '\n\t\t</ObjectUrl>'
+    '\n\t</Link>').encode('UTF8')
+
+doctype_header_bytes = doctype_header.encode('UTF8')
+link_set_open = b'<LinkSet>'
+link_set_close = b'\n</LinkSet>'
+empty_link_set = b'<LinkSet />'  # Matches ElementTree's output for an empty LinkSet
+file_overhead_bytes = len(doctype_header_bytes) + len(link_set_open) + len(link_set_close)
+
+special_chars = re.compile('[&<>]')
+
+
+# =========================
+def render_link(eschol_id, pubmed_id):
+    eschol_id = str(eschol_id)
+    return link_template % (
+        escape(eschol_id).encode('UTF8'),
+        escape(str(pubmed_id)).encode('UTF8'),
+        escape(eschol_id[2:]).encode('UTF8'))
+
+
+# Renders a batch of links as one bytes object.
+def render_links(links):
+    return b''.join(render_link_list(links))
+
+
+# Renders a batch of links, one bytes object per link. IDs almost never
+# need escaping, so the batch is checked once up front and, if it's clean,
+# rendered without per-field escaping.
+def render_link_list(links):
+    links = links if isinstance(links, list) else list(links)
+
+    fields = '\0'.join([f"{eschol_id}\0{pubmed_id}" for eschol_id, pubmed_id in links])
+    if special_chars.search(fields):
+        return [render_link(eschol_id, pubmed_id) for eschol_id, pubmed_id in links]
+
+    return [
+        link_template % (
+            eschol_id.encode('UTF8'),
+            str(pubmed_id).encode('UTF8'),
+            eschol_id[2:].encode('UTF8'))
+        for eschol_id, pubmed_id in links]
+
+
+# Adapts the scripts' item dicts to (eschol_id, pubmed_id) links.
+def item_links(items, pubmed_key='pubmed_id'):
+    for item in items:
+        yield item['eschol_id'], item[pubmed_key]
+
+
+# =========================
+# Splits items into pages whose resource files stay within max_bytes, and
+# within max_links links if that's given, measured on the rendered links
+# rather than a fixed row count. Yields (page items, rendered links) in
+# item order, so the same items always paginate and number the same way.
+# A link that alone exceeds max_bytes still gets a page of its own.
+def paginate_items(items, max_bytes=default_max_file_bytes, max_links=None,
+                   pubmed_key='pubmed_id', batch_size=default_batch_size):
+    items = iter(items)
+    page_items = []
+    page_links = []
+    page_bytes = file_overhead_bytes
+
+    while batch := list(islice(items, batch_size)):
+        for item, rendered_link in zip(batch, render_link_list(item_links(batch, pubmed_key))):
+            page_full = page_bytes + len(rendered_link) > max_bytes \
+                or (max_links and len(page_items) == max_links)
+            if page_items and page_full:
+                yield page_items, b''.join(page_links)
+                page_items = []
+                page_links = []
+                page_bytes = file_overhead_bytes
+
+            page_items.append(item)
+            page_links.append(rendered_link)
+            page_bytes += len(rendered_link)
+
+    if page_items:
+        yield page_items, b''.join(page_links)
+
+
+# =========================
+# Writes a LinkOut resource file to f, which must be opened in binary mode.
+class LinkOutWriter:
+
+    def __init__(self, f):
+        self.f = f
+        self.link_count = 0
+        self.bytes_written = 0
+        self.write(doctype_header_bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data):
+        self.f.write(data)
+        self.bytes_written += len(data)
+
+    def write_rendered(self, rendered_links, link_count):
+        if link_count == 0:
+            return
+        if self.link_count == 0:
+            self.write(link_set_open)
+        self.write(rendered_links)
+        self.link_count += link_count
+
+    def write_link(self, eschol_id, pubmed_id):
+        self.write_rendered(render_link(eschol_id, pubmed_id), 1)
+
+    def write_links(self, links, batch_size=default_batch_size):
+        batch = []
+        for link in links:
+            batch.append(link)
+            if len(batch) == batch_size:
+                self.write_rendered(render_links(batch), len(batch))
+                batch = []
+        self.write_rendered(render_links(batch), len(batch))
+
+    def close(self):
+        self.write(link_set_close if self.link_count else empty_link_set)
+
+
+# Writes a complete resource file; returns the number of links written.
+def write_resource_file(file_name, links):
+    with open(file_name, 'wb') as f, LinkOutWriter(f) as writer:
+        writer.write_links(links)
+    return writer.link_count
+
+
+# Same, for a page of links already rendered by paginate_items.
+def write_rendered_resource_file(file_name, rendered_links, link_count):
+    with open(file_name, 'wb') as f, LinkOutWriter(f) as writer:
+        writer.write_rendered(rendered_links, link_count)
+    return writer.link_count
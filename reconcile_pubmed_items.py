@@ -0,0 +1,326 @@
+# Reconciles linkout_items against Elements, catching drift that the
+# enqueue job can't see: eSchol items that lost their PubMed record in
+# Elements, or whose pubmed_id changed.
+#
+# Both sides are streamed ordered by eschol_id and merged in a single
+# pass, so memory is bounded by the size of the drift, not the tables.
+# The run writes a delta report (adds, changes, deletes), and rewrites
+# each already-submitted resource file that holds a changed or deleted
+# item under its original name, so re-uploading it replaces the stale
+# links on the LinkOut FTP. Adds aren't written to files: with --apply
+# they're enqueued in linkout_items for the next regular submission.
+#
+# Rows still pending (submitted IS NULL) are in no file yet, so their
+# changes and deletes go straight to the logging DB and the next regular
+# submission picks them up.
+#
+# Of the submitted rows, only those recorded against a real file name can
+# be fixed by a rewrite. Rows loaded by the batch scripts have no
+# pubmed_filename, and the old full resubmission recorded a wildcard
+# ('<date>_eschol_linkout_resource_*') rather than the file each item went
+# into; their changes and deletes are written to a separate skipped report
+# and left in the logging DB, since their links are still live on the FTP.
+#
+# Without --apply, nothing is uploaded and the logging DB isn't changed.
+
+from dotenv import dotenv_values
+import argparse
+import csv
+import datetime
+import os
+import pymysql
+import enqueue_new_pubmed_items_elements as enqueue
+import linkout_connections
+import linkout_db
+import linkout_ftp
+import linkout_metrics
+import linkout_validate
+import linkout_xml
+from submitted_id_cache import SubmittedIdCache
+
+fetch_size = 5000
+report_columns = ('action', 'eschol_id', 'ucpms_id', 'old_pubmed_id', 'new_pubmed_id', 'pubmed_filename')
+
+
+# =========================
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Reconcile the LinkOut logging DB against Elements.")
+    parser.add_argument(
+        '--apply', action='store_true',
+        help="Upload the rewritten resource files, then apply the adds, "
+             "changes and deletes to the logging DB.")
+    parser.add_argument(
+        '--ftp-concurrency', type=int, default=linkout_ftp.default_concurrency,
+        help="Number of FTP sessions uploading files at once.")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    env = dotenv_values(".env")
+    with linkout_metrics.RunMetrics('reconcile_pubmed_items', env) as metrics, \
+            linkout_connections.ConnectionManager(env):
+        reconcile_items(args, env, metrics)
+
+
+def reconcile_items(args, env, metrics):
+    run_time = datetime.datetime.now().replace(microsecond=0).isoformat()
+    run_time = run_time.replace(':', "-")
+    report_file = f"output/{run_time}_linkout_reconcile_report.csv"
+    skipped_file = f"output/{run_time}_linkout_reconcile_skipped.csv"
+    output_dir = f"output/{run_time}-linkout-reconcile"
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Merge both sides, writing the report as the deltas come out
+    with metrics.stage('merge'):
+        delta = get_delta(env, report_file)
+    print(f"Reconciliation: {len(delta.adds)} adds, {len(delta.changes)} changes, "
+          f"{len(delta.deletes)} deletes. Report: {report_file}")
+
+    # Rewrite the submitted files that hold changed or deleted items
+    with metrics.stage('render'):
+        update_files = create_update_files(env, delta, output_dir)
+    report_skipped(delta, skipped_file)
+
+    if not args.apply:
+        print("Dry run: not uploading or changing the logging DB (use --apply).")
+        return
+
+    # Only touch the logging DB once the rewritten files are on the FTP
+    uploaded_files = set()
+    with metrics.stage('upload'):
+        if update_files:
+            linkout_validate.check_files(update_files)
+            uploaded_files = {
+                remote_name for remote_name, sent_bytes, seconds in
+                linkout_ftp.upload_files(env, update_files, concurrency=args.ftp_concurrency)}
+
+    with metrics.stage('logging_db_update'):
+        linkout_connections.retry(env, 'logging_db', apply_delta, delta, uploaded_files)
+
+    print("Program complete. Exiting.")
+
+
+# =========================
+# The deltas are small next to the tables, so they're kept in memory.
+class Delta:
+
+    def __init__(self):
+        self.adds = []
+        self.changes = []
+        self.deletes = []
+
+    # {pubmed_filename: {linkout_items.id: new pubmed_id, or None to drop it}}
+    def get_file_edits(self):
+        file_edits = {}
+        for elements_item, logged_item in self.changes:
+            if has_file_name(logged_item):
+                file_edits.setdefault(logged_item['pubmed_filename'], {})[
+                    logged_item['id']] = elements_item['pubmed_id']
+        for logged_item in self.deletes:
+            if has_file_name(logged_item):
+                file_edits.setdefault(logged_item['pubmed_filename'], {})[
+                    logged_item['id']] = None
+        return file_edits
+
+    # (action, Elements item, logged item) for the changes and deletes to
+    # submitted items whose file can't be rewritten
+    def get_skipped(self):
+        skipped = [
+            ('change', elements_item, logged_item) for elements_item, logged_item in self.changes
+            if not is_pending(logged_item) and not has_file_name(logged_item)]
+        skipped.extend(
+            ('delete', None, logged_item) for logged_item in self.deletes
+            if not is_pending(logged_item) and not has_file_name(logged_item))
+        return skipped
+
+
+# False for rows with no pubmed_filename, or the old resubmission's wildcard
+def has_file_name(logged_item):
+    pubmed_filename = logged_item['pubmed_filename']
+    return bool(pubmed_filename) and '*' not in pubmed_filename
+
+
+# True for rows enqueued but not yet in any submitted file
+def is_pending(logged_item):
+    return logged_item['submitted'] is None
+
+
+def get_delta(env, report_file):
+    delta = Delta()
+
+    with open(report_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=report_columns)
+        writer.writeheader()
+
+        for action, elements_item, logged_item in merge_by_eschol_id(
+                enqueue.iter_pmid_pubs_by_eschol_id(env), iter_logged_items(env)):
+
+            if action == 'add':
+                delta.adds.append(elements_item)
+            elif action == 'change':
+                delta.changes.append((elements_item, logged_item))
+            else:
+                delta.deletes.append(logged_item)
+            linkout_metrics.count(f"{action}s")
+            writer.writerow(get_report_row(action, elements_item, logged_item))
+
+    return delta
+
+
+def get_report_row(action, elements_item, logged_item):
+    return {
+        'action': action,
+        'eschol_id': (elements_item or logged_item)['eschol_id'],
+        'ucpms_id': (elements_item or logged_item)['ucpms_id'],
+        'old_pubmed_id': logged_item['pubmed_id'] if logged_item else None,
+        'new_pubmed_id': elements_item['pubmed_id'] if elements_item else None,
+        'pubmed_filename': logged_item['pubmed_filename'] if logged_item else None}
+
+
+def report_skipped(delta, skipped_file):
+    skipped = delta.get_skipped()
+    if not skipped:
+        return
+
+    with open(skipped_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=report_columns)
+        writer.writeheader()
+        for action, elements_item, logged_item in skipped:
+            writer.writerow(get_report_row(action, elements_item, logged_item))
+
+    linkout_metrics.count('skipped', len(skipped))
+    print(f"Skipped {len(skipped)} changes and deletes to items with no file "
+          f"to rewrite; they're left in the logging DB. Report: {skipped_file}")
+
+
+# Streams linkout_items with an unbuffered cursor, ordered by eschol_id.
+def iter_logged_items(env):
+    with linkout_connections.connection(env, 'logging_db') as mysql_conn, \
+            mysql_conn.cursor(pymysql.cursors.SSDictCursor) as cursor:
+        print("Connected to logging DB. Streaming items by eSchol ID.")
+        cursor.execute("""
+            SELECT id, ucpms_id, eschol_id, pubmed_id, pubmed_filename, submitted
+            FROM linkout_items ORDER BY eschol_id""")
+        while rows := cursor.fetchmany(fetch_size):
+            linkout_metrics.count('db_round_trips')
+            linkout_metrics.count('rows', len(rows))
+            yield from rows
+
+
+# Walks two streams ordered by eschol_id in step, yielding
+# (action, Elements item, logged item) for each difference:
+#   add: in Elements only; change: in both with different pubmed_ids;
+#   delete: in linkout_items only.
+# Logged rows without a ucpms_id were loaded from eScholarship rather than
+# Elements (batch_eschol_to_pubmed_linkout), so they're never deleted.
+def merge_by_eschol_id(elements_items, logged_items):
+    elements_items = iter_unique_in_order(elements_items, "Elements")
+    logged_items = iter_unique_in_order(logged_items, "linkout_items")
+    elements_item = next(elements_items, None)
+    logged_item = next(logged_items, None)
+
+    while elements_item is not None or logged_item is not None:
+        if logged_item is None or (
+                elements_item is not None and elements_item['eschol_id'] < logged_item['eschol_id']):
+            yield 'add', elements_item, None
+            elements_item = next(elements_items, None)
+
+        elif elements_item is None or logged_item['eschol_id'] < elements_item['eschol_id']:
+            if logged_item['ucpms_id'] is not None:
+                yield 'delete', None, logged_item
+            logged_item = next(logged_items, None)
+
+        else:
+            if str(elements_item['pubmed_id']) != str(logged_item['pubmed_id']):
+                yield 'change', elements_item, logged_item
+            elements_item = next(elements_items, None)
+            logged_item = next(logged_items, None)
+
+
+# Elements can return the same eSchol ID twice; keeps the first. A merge
+# over a stream that isn't in order would report false deltas, so an
+# out-of-order ID (e.g. from a collation mismatch) stops the run.
+def iter_unique_in_order(items, source_name):
+    previous_id = None
+    for item in items:
+        if previous_id is not None:
+            if item['eschol_id'] == previous_id:
+                continue
+            if item['eschol_id'] < previous_id:
+                raise RuntimeError(
+                    f"{source_name} items aren't ordered by eschol_id: "
+                    f"{item['eschol_id']} came after {previous_id}.")
+        previous_id = item['eschol_id']
+        yield item
+
+
+# =========================
+# Rewrites each affected file from its current rows, with changed
+# pubmed_ids applied and deleted items left out. A file left with no
+# items is still written (as an empty LinkSet) to clear it on the FTP.
+def create_update_files(env, delta, output_dir):
+    file_edits = delta.get_file_edits()
+    if not file_edits:
+        return []
+
+    update_files = []
+
+    with linkout_connections.connection(env, 'logging_db') as mysql_conn, \
+            mysql_conn.cursor() as cursor:
+        for pubmed_filename, edits in sorted(file_edits.items()):
+            cursor.execute("""
+                SELECT id, eschol_id, pubmed_id FROM linkout_items
+                WHERE pubmed_filename = %s ORDER BY id""", (pubmed_filename,))
+            linkout_metrics.count('db_round_trips')
+            file_items = cursor.fetchall()
+
+            links = [
+                (item['eschol_id'], edits.get(item['id'], item['pubmed_id']))
+                for item in file_items
+                if not (item['id'] in edits and edits[item['id']] is None)]
+
+            update_file = f"{output_dir}/{pubmed_filename}"
+            print(f"Exporting: {update_file} ({len(links)} links)")
+            linkout_xml.write_resource_file(update_file, links)
+            linkout_metrics.count('bytes_written', os.path.getsize(update_file))
+            update_files.append(update_file)
+
+    return update_files
+
+
+# Every step can be repeated (the inserts skip rows that already exist),
+# so a run interrupted by a dropped connection is retried from the top.
+# Changes and deletes are only applied to pending items, and to items
+# whose rewritten file is in uploaded_files; the rest stay as they are,
+# and show up again in the next run.
+def apply_delta(mysql_conn, delta, uploaded_files):
+    print("Connected to logging DB. Applying the reconciliation.")
+
+    changes = [
+        (elements_item, logged_item) for elements_item, logged_item in delta.changes
+        if is_pending(logged_item) or logged_item['pubmed_filename'] in uploaded_files]
+    deletes = [
+        logged_item for logged_item in delta.deletes
+        if is_pending(logged_item) or logged_item['pubmed_filename'] in uploaded_files]
+
+    if changes:
+        linkout_db.update_pubmed_ids(mysql_conn, {
+            logged_item['id']: elements_item['pubmed_id']
+            for elements_item, logged_item in changes})
+
+    if deletes:
+        linkout_db.delete_linkout_items(mysql_conn, [item['id'] for item in deletes])
+
+        # The local ID cache only syncs additions; deletes need a rebuild
+        with SubmittedIdCache() as submitted_ids:
+            submitted_ids.rebuild(mysql_conn)
+
+    if delta.adds:
+        linkout_db.bulk_insert_linkout_items(mysql_conn, delta.adds)
+
+
+# =========================
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,115 @@
 from dotenv import dotenv_values
+import argparse
 import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import pymysql
-import xml.etree.ElementTree as ET
-from ftplib import FTP
-import subprocess
-
-# Batching vars
+import linkout_connections
+import linkout_db
+import linkout_ftp
+import linkout_items
+import linkout_journal
+import linkout_metrics
+import linkout_pipeline
+import linkout_validate
+import linkout_xml
+from linkout_items import LinkOutItems
+from linkout_xml import LinkOutWriter
+
+# Batching vars; page_size is only used with --max-file-bytes 0
 page_size = 20000
-# batch_input_file = "input/ucpms-eschol-pubmed-batch-input.csv"
+fetch_size = 5000
 
+# Run journal, for --resume
+journal_job = 'resubmit_full_pubmed_items'
 
-# =========================
-def get_logging_db_connection(env):
-    mysql_conn = pymysql.connect(
-        host=env['LOGGING_DB_SERVER'],
-        user=env['LOGGING_DB_USER'],
-        password=env['LOGGING_DB_PASSWORD'],
-        database=env['LOGGING_DB_DATABASE'],
-        cursorclass=pymysql.cursors.DictCursor)
+# Incremental resubmission vars
+bucket_count = 64
+incremental_file_stub = "eschol_linkout_resource_bucket"
+page_digests_file = "state/resubmit_page_digests.json"
 
-    return mysql_conn
+# Full runs write dated pages and --incremental runs write bucket files.
+# Neither replaces the other's files on the FTP, so if both were left
+# there, every link would be listed twice.
+full_file_pattern = re.compile(r'\d{4}-\d{2}-\d{2}_eschol_linkout_resource_\d{5}\.xml')
+bucket_file_pattern = re.compile(re.escape(incremental_file_stub) + r'_\d{5}\.xml')
+# batch_input_file = "input/ucpms-eschol-pubmed-batch-input.csv"
 
 
-# Returns a list of lists, of size n or fewer.
-def chunk_into_n(full_list, n):
-    for i in range(0, len(full_list), n):
-        yield full_list[i:i + n]
+# =========================
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Resubmit every logged item to PubMed LinkOut.")
+    parser.add_argument(
+        '--stream', action='store_true',
+        help="Stream items from the logging DB with a server-side cursor, "
+             "holding only one page in memory at a time.")
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help="Number of processes rendering pages in parallel (default: 1).")
+    parser.add_argument(
+        '--verify-serial', action='store_true',
+        help="Re-render each page serially and check the parallel output "
+             "is byte-for-byte identical.")
+    parser.add_argument(
+        '--ftp-concurrency', type=int, default=linkout_ftp.default_concurrency,
+        help="Number of FTP sessions uploading files at once.")
+    parser.add_argument(
+        '--ftp-blocksize', type=int, default=linkout_ftp.default_blocksize,
+        help="Block size in bytes for each FTP transfer.")
+    parser.add_argument(
+        '--max-file-bytes', type=int, default=linkout_xml.default_max_file_bytes,
+        help="Close each resource file when its rendered size would pass this many "
+             f"bytes (default: {linkout_xml.default_max_file_bytes}). "
+             f"0 writes fixed pages of {page_size} items instead.")
+    parser.add_argument(
+        '--max-links', type=int,
+        help="Also close each resource file at this many links.")
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help="Overlap the stages: stream pages from the logging DB, upload each "
+             "file as soon as it's rendered, and mark its items as submitted "
+             "once its upload is confirmed.")
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help="Assign items to stable hash buckets and only render and upload "
+             "the bucket files whose contents changed since the last run.")
+    parser.add_argument(
+        '--buckets', type=int, default=bucket_count,
+        help=f"Number of bucket files for --incremental (default: {bucket_count}). "
+             "Changing this rewrites every bucket.")
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Pick up the last resubmission that didn't finish: only the pages "
+             "its journal doesn't show as rendered, uploaded and marked as "
+             "submitted are redone. Its file names and page sizes are kept.")
+    parser.add_argument(
+        '--replace-other-layout', action='store_true',
+        help="When switching between full and --incremental runs, delete the "
+             "other mode's files from the FTP once this run's files are uploaded. "
+             "Without it, a run won't start while they're there.")
+    args = parser.parse_args()
+    if args.resume and args.incremental:
+        parser.error("--incremental runs keep their own bucket digests; "
+                     "rerun them instead of using --resume.")
+    return args
 
 
 def main():
+    args = get_args()
     env = dotenv_values(".env")
+    with linkout_metrics.RunMetrics('resubmit_full_pubmed_items', env) as metrics, \
+            linkout_connections.ConnectionManager(env):
+        resubmit_all_items(args, env, metrics)
+
+
+def resubmit_all_items(args, env, metrics):
 
     # Runtime string for dirs, filenames, logging DB
     run_time = datetime.datetime.now()
@@ -39,140 +119,551 @@ def main():
 
     output_dir = "output"
 
-    # Get the new items enqueued for submission
-    all_items = get_all_items(env)
-    all_item_count = len(all_items)
-    print(f"Full item count: {all_item_count}")
+    other_layout_files = get_other_layout_files(env, args)
+
+    if args.incremental:
+        resubmit_changed_buckets(env, output_dir, args, metrics, other_layout_files)
+        print("Program complete. Exiting.")
+        return
+
+    # A resumed run carries on with the original run's file names and page
+    # sizes, after the pages its journal already shows as rendered.
+    if args.resume:
+        journal = linkout_journal.RunJournal.latest_unfinished(journal_job)
+        if journal is None:
+            print("No unfinished resubmission to resume. Exiting.")
+            return
+        print(f"Resuming from {journal.journal_file}.")
+        submission_file_stub = journal.params['submission_file_stub']
+        args.max_file_bytes = journal.params['max_file_bytes']
+        args.max_links = journal.params['max_links']
+        with metrics.stage('resume'):
+            first_page, after_id = finish_journaled_files(env, output_dir, journal, args)
+    else:
+        submission_file_stub = f"{run_date}_eschol_linkout_resource"
+        journal = linkout_journal.RunJournal.start(journal_job, run_time, {
+            'submission_file_stub': submission_file_stub,
+            'max_file_bytes': args.max_file_bytes,
+            'max_links': args.max_links})
+        first_page, after_id = 0, None
+
+    # Once every page was rendered, finishing them was all that was left
+    if 'paginated' in journal.events:
+        print("Every page had already been rendered.")
+
+    elif args.pipeline:
+        with metrics.stage('pipeline'):
+            resubmit_pipelined(env, output_dir, submission_file_stub, args,
+                               journal, first_page, after_id)
+
+    else:
+        resubmit_batched(env, output_dir, submission_file_stub, args, metrics,
+                         journal, first_page, after_id)
+
+    # The bucket files go, and so do their digests, so the next
+    # --incremental run writes every bucket again
+    if other_layout_files:
+        linkout_ftp.delete_remote_files(env, other_layout_files)
+        if os.path.exists(page_digests_file):
+            os.remove(page_digests_file)
+
+    journal.finish()
+    print("Program complete. Exiting.")
+
+
+# The other mode's files on the FTP. Raises unless --replace-other-layout
+# was given, in which case the caller deletes them after its own upload.
+def get_other_layout_files(env, args):
+    pattern = full_file_pattern if args.incremental else bucket_file_pattern
+    other_layout_files = [
+        remote_name for remote_name in linkout_ftp.list_remote_files(env)
+        if pattern.fullmatch(remote_name)]
+
+    if other_layout_files and not args.replace_other_layout:
+        other_mode = "full" if args.incremental else "--incremental"
+        raise RuntimeError(
+            f"The FTP still has {len(other_layout_files)} files from {other_mode} runs "
+            f"(e.g. {other_layout_files[0]}), which would list every link twice. "
+            "Rerun with --replace-other-layout to delete them after this upload.")
+    if other_layout_files:
+        print(f"{len(other_layout_files)} {'full' if args.incremental else 'bucket'} "
+              "files will be deleted from the FTP after this upload.")
+    return other_layout_files
+
+
+def resubmit_batched(env, output_dir, submission_file_stub, args, metrics,
+                     journal, first_page=0, after_id=None):
+
+    # Get all the logged items, paginated for the XML files.
+    # When streaming, the fetch happens as pages are rendered,
+    # so its time is counted in the render stage.
+    if args.stream:
+        items = iter_item_batches(env, after_id)
+    else:
+        with metrics.stage('fetch'):
+            items = get_all_items(env, after_id)
+        print(f"Full item count: {len(items)}")
+    item_pages = paginate(items, args)
 
     # Create the XML files
-    submission_file_stub = f"{run_date}_eschol_linkout_resource"
-    submission_files_with_path = create_submission_files(
-        all_items, output_dir, submission_file_stub)
+    with metrics.stage('render'):
+        submission_files_with_path, file_item_id_ranges = create_submission_files(
+            item_pages, output_dir, submission_file_stub,
+            workers=args.workers, verify_serial=args.verify_serial,
+            journal=journal, first_page=first_page)
+    journal.record('paginated')
 
     # Send to PubMed FTP
-    upload_submission_files_to_ftp(
-        env, output_dir, submission_files_with_path)
+    with metrics.stage('upload'):
+        upload_submission_files_to_ftp(
+            env, output_dir, submission_files_with_path,
+            concurrency=args.ftp_concurrency, blocksize=args.ftp_blocksize,
+            journal=journal)
 
     # Update the logging DB
-    update_logging_db(env, submission_file_stub)
-
-    print("Program complete. Exiting.")
-
-
-def get_all_items(env):
-    mysql_conn = get_logging_db_connection(env)
-
-    print("Connected to logging DB. Getting all items for resubmission.")
-    with mysql_conn.cursor() as cursor:
-        cursor.execute("SELECT eschol_id, pubmed_id FROM linkout_items")
-        new_items = cursor.fetchall()
-    mysql_conn.close()
+    with metrics.stage('logging_db_update'):
+        update_logging_db(env, file_item_id_ranges, journal)
+
+
+# Reads every item into one columnar batch; nothing is kept from a failed
+# read, so it's retried from the start.
+def get_all_items(env, after_id=None):
+    print("Getting all items for resubmission.")
+    all_items = linkout_connections.with_retries(
+        lambda: LinkOutItems.concat(iter_item_batches(env, after_id)), 'logging_db')
+    linkout_metrics.count('rows', len(all_items))
+    return all_items
+
+
+# Streams all items in id order as columnar batches of up to fetch_size,
+# read from an unbuffered cursor as plain tuples. A resumed run starts
+# after the last id its finished pages covered.
+def iter_item_batches(env, after_id=None):
+    with linkout_connections.connection(env, 'logging_db') as mysql_conn, \
+            mysql_conn.cursor(pymysql.cursors.SSCursor) as cursor:
+        print("Connected to logging DB. Streaming all items for resubmission.")
+        cursor.execute(
+            "SELECT id, eschol_id, pubmed_id FROM linkout_items WHERE id > %s ORDER BY id",
+            (-1 if after_id is None else after_id,))
+        while rows := cursor.fetchmany(fetch_size):
+            linkout_metrics.count('db_round_trips')
+            yield LinkOutItems.from_rows(rows, columns=('id', 'eschol_id', 'pubmed_id'))
+
+
+# Streams all items with an unbuffered cursor, fetch_size rows per round trip.
+# The connection stays open until the generator is exhausted or closed.
+def iter_all_items(env, order_by="id"):
+    all_items_sql = f"SELECT id, eschol_id, pubmed_id FROM linkout_items ORDER BY {order_by}"
+
+    with linkout_connections.connection(env, 'logging_db') as mysql_conn, \
+            mysql_conn.cursor(pymysql.cursors.SSDictCursor) as cursor:
+        print("Connected to logging DB. Streaming all items for resubmission.")
+        cursor.execute(all_items_sql)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            linkout_metrics.count('db_round_trips')
+            if not rows:
+                break
+            yield from rows
+
+
+# Yields (page items, rendered links): pages sized by their rendered bytes
+# when args.max_file_bytes is set, otherwise fixed pages of page_size items
+# left to the renderers (rendered links None). items is one LinkOutItems
+# batch, whose pages are views into it, or a stream of batches.
+def paginate(items, args):
+    if isinstance(items, LinkOutItems):
+        if args.max_file_bytes:
+            yield from items.paginate(args.max_file_bytes, args.max_links)
+        else:
+            for eschol_page in items.pages(page_size):
+                yield eschol_page, None
+    else:
+        # Closing this closes the stream too, and so its cursor
+        try:
+            if args.max_file_bytes:
+                paginator = linkout_items.Paginator(args.max_file_bytes, args.max_links)
+                for item_batch in items:
+                    yield from paginator.add(item_batch)
+                yield from paginator.finish()
+            else:
+                for eschol_page in linkout_items.iter_pages(items, page_size):
+                    yield eschol_page, None
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+
+# Returns the file names and {file name: item id runs}, the exact ids
+# written to each file as linkout_journal.to_id_ranges runs. Pages are read
+# in id order, but a row committed late can still fall between a page's
+# first and last ids without being in it.
+def create_submission_files(item_pages, output_dir, submission_file_stub,
+                            workers=1, verify_serial=False, journal=None, first_page=0):
+    submission_files_with_path = []
+    file_item_id_ranges = {}
+    item_count = 0
 
-    return new_items
+    for page_number, (eschol_page, submission_file_with_path) in enumerate(render_pages(
+            item_pages, output_dir, submission_file_stub, workers, first_page), first_page):
 
+        if verify_serial:
+            verify_page_matches_serial(eschol_page, submission_file_with_path)
 
-def create_submission_files(all_items, output_dir, submission_file_stub):
+        item_id_ranges = linkout_journal.to_id_ranges(eschol_page.ids)
+        submission_files_with_path.append(submission_file_with_path)
+        file_item_id_ranges[os.path.basename(submission_file_with_path)] = item_id_ranges
+        item_count += len(eschol_page)
+        linkout_metrics.count('rows', len(eschol_page))
+        linkout_metrics.count('bytes_written', os.path.getsize(submission_file_with_path))
+        if journal is not None:
+            record_rendered(journal, submission_file_with_path, page_number, item_id_ranges)
 
-    eschol_pmid_pubs_pages = list(chunk_into_n(all_items, page_size))
-    submission_files_with_path = []
+    print(f"{len(submission_files_with_path)} pages for batch upload ({item_count} items).")
 
-    print(f"{len(eschol_pmid_pubs_pages)} pages for batch upload.")
-    for page_number, eschol_page in enumerate(eschol_pmid_pubs_pages):
+    # Return the output filenames
+    return submission_files_with_path, file_item_id_ranges
 
-        # Create the XML from new_items dict
-        xml_data = create_xml_data(eschol_page)
 
-        # Export XML --> string to output file
-        file_number = str(page_number).zfill(5)
-        submission_file_with_path = f'{output_dir}/{submission_file_stub}_{file_number}.xml'
-        with open(submission_file_with_path, 'w') as f:
-            print(f"Exporting: {submission_file_with_path}")
+# Yields (page, output file) in page order. With workers > 1, pages are
+# written in a process pool, with at most two pages per worker in flight
+# so a streamed read doesn't pile up in memory ahead of the renderers.
+def render_pages(item_pages, output_dir, submission_file_stub, workers=1, first_page=0):
+    page_files = (
+        (eschol_page, rendered_links,
+         get_submission_file_with_path(output_dir, submission_file_stub, page_number))
+        for page_number, (eschol_page, rendered_links) in enumerate(item_pages, first_page))
 
-            # Add the header manually before the XML body
-            doctype_header = '<?xml version="1.0" ?>\n' \
-                             '<!DOCTYPE LinkSet PUBLIC "-//NLM//DTD LinkOut 1.0//EN" ' \
-                             '"https://www.ncbi.nlm.nih.gov/projects/linkout/doc/LinkOut.dtd" ' \
-                             '[<!ENTITY icon.url "https://escholarship.org/images/pubmed_linkback.png"> ' \
-                             '<!ENTITY base.url "https://escholarship.org/uc/item/" > ]>\n'
-            f.write(doctype_header)
+    if workers <= 1:
+        for eschol_page, rendered_links, submission_file_with_path in page_files:
+            yield eschol_page, write_submission_file(
+                eschol_page, submission_file_with_path, rendered_links)
+        return
 
-            # Element tree: Convert to string, replace & html escaping
-            ET.indent(xml_data, space="\t", level=0)
-            xml_string = ET.tostring(xml_data, encoding='unicode')
-            xml_string = xml_string.replace('&amp;', '&')
-            f.write(xml_string)
+    max_in_flight = workers * 2
+    in_flight = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for eschol_page, rendered_links, submission_file_with_path in page_files:
+            future = executor.submit(
+                write_submission_file, eschol_page, submission_file_with_path, rendered_links)
+            in_flight.append((eschol_page, future))
 
-        submission_files_with_path.append(submission_file_with_path)
+            if len(in_flight) >= max_in_flight:
+                eschol_page, future = in_flight.pop(0)
+                yield eschol_page, future.result()
 
-    # Return the output filename
-    return submission_files_with_path
+        for eschol_page, future in in_flight:
+            yield eschol_page, future.result()
 
 
-def create_xml_data(new_items):
-    link_set = ET.Element("LinkSet")
+# The zero-padded page number keeps file names deterministic,
+# however the pages are rendered.
+def get_submission_file_with_path(output_dir, submission_file_stub, page_number):
+    file_number = str(page_number).zfill(5)
+    return f'{output_dir}/{submission_file_stub}_{file_number}.xml'
 
-    for item in new_items:
-        link = ET.SubElement(link_set, "Link")
-        ET.SubElement(link, "LinkId").text = item['eschol_id'][2:]
-        ET.SubElement(link, "ProviderId").text = "7383"
-        # ET.SubElement(link, "IconURL").text = "https://escholarship.org/images/pubmed_linkback.png"
-        ET.SubElement(link, "IconUrl").text = "&icon.url;"
 
-        # Link > ObjectSelector
-        object_selector = ET.SubElement(link, "ObjectSelector")
-        ET.SubElement(object_selector, "Database").text = "PubMed"
+# Pages sized by paginate arrive already rendered.
+def write_submission_file(eschol_page, submission_file_with_path, rendered_links=None):
 
-        # Link > ObjectSelector > ObjectList
-        object_list = ET.SubElement(object_selector, "ObjectList")
-        ET.SubElement(object_list, "ObjId").text = str(item['pubmed_id'])
+    # Stream the page into the output file as <Link>s
+    print(f"Exporting: {submission_file_with_path}")
+    if rendered_links is None:
+        eschol_page.write_resource_file(submission_file_with_path)
+    else:
+        linkout_xml.write_rendered_resource_file(
+            submission_file_with_path, rendered_links, len(eschol_page))
 
-        # Link > ObjectURL
-        object_url = ET.SubElement(link, "ObjectUrl")
-        # ET.SubElement(object_url, "Rule").text = f"https://escholarship.org/uc/item/{item['eschol_id']}"
-        ET.SubElement(object_url, "Base").text = '&base.url;'
-        ET.SubElement(object_url, "Rule").text = item['eschol_id']
-        ET.SubElement(object_url, "UrlName").text = "Full text from University of California eScholarship"
-        ET.SubElement(object_url, "Attribute").text = "full-text PDF"
+    return submission_file_with_path
 
-    return link_set
 
+# Renders the page again in this process, one link at a time from its
+# item dicts rather than the columnar fast path, and compares the bytes.
+def verify_page_matches_serial(eschol_page, submission_file_with_path):
+    serial_output = io.BytesIO()
+    with LinkOutWriter(serial_output) as writer:
+        writer.write_links(linkout_xml.item_links(eschol_page))
 
-def upload_submission_files_to_ftp(env, output_dir, submission_file_with_path):
-    # https://docs.python.org/3/library/ftplib.html#ftplib.FTP.storbinary
+    with open(submission_file_with_path, 'rb') as f:
+        if f.read() != serial_output.getvalue():
+            raise RuntimeError(
+                f"{submission_file_with_path} doesn't match the serial rendering of its page.")
 
-    print("Connecting to PubMed Linkout FTP.")
-    ftp = FTP(env['LINKOUT_FTP_URL'],
-              env['LINKOUT_FTP_USER'],
-              env['LINKOUT_FTP_PASSWORD'])  # should return 230 successful login
 
-    ftp.cwd(env['LINKOUT_FTP_DIR'])  # should return 250 successful dir change
+# =========================
+# Resuming from the run journal
+#
+# Every page's file is journaled as it's rendered, uploaded and marked as
+# submitted, with the exact ids that went into it. Pages are cut from
+# items read in id order, so the pages journaled without a gap from page 0
+# end at a known id: those are finished first, and the rest of the run
+# carries on after that id with the next page number, as though it had
+# never stopped.
+def record_rendered(journal, submission_file_with_path, page_number, item_id_ranges):
+    journal.record(
+        'rendered', file=os.path.basename(submission_file_with_path), page=page_number,
+        item_id_ranges=item_id_ranges, bytes=os.path.getsize(submission_file_with_path))
+
+
+# Uploads and marks the journaled files that still need it, rendering any
+# whose file is missing or changed again from its journaled ids.
+# Returns the next page number and the last id the journaled pages cover.
+def finish_journaled_files(env, output_dir, journal, args):
+    rendered_pages = {
+        entry['page']: (submission_file, entry)
+        for submission_file, entry in journal.files.items() if entry.get('rendered')}
+
+    first_page = 0
+    after_id = None
+    unfinished_files = []
+    while first_page in rendered_pages:
+        submission_file, entry = rendered_pages[first_page]
+        submission_file_with_path = get_submission_file_with_path(
+            output_dir, journal.params['submission_file_stub'], first_page)
+
+        if not entry.get('committed'):
+            if (not os.path.exists(submission_file_with_path) or
+                    os.path.getsize(submission_file_with_path) != entry['bytes']):
+                eschol_page = linkout_connections.retry(
+                    env, 'logging_db', linkout_db.fetch_items_by_id_ranges,
+                    entry['item_id_ranges'])
+                write_submission_file(eschol_page, submission_file_with_path)
+                record_rendered(
+                    journal, submission_file_with_path, first_page, entry['item_id_ranges'])
+            unfinished_files.append(submission_file_with_path)
+
+        after_id = entry['item_id_ranges'][-1][1]
+        first_page += 1
+
+    print(f"{first_page} pages already rendered, {len(unfinished_files)} of them unfinished.")
 
-    for submission_file_with_path in submission_file_with_path:
-        submission_file = submission_file_with_path.split(f"{output_dir}/")[1]
+    upload_submission_files_to_ftp(
+        env, output_dir, unfinished_files,
+        concurrency=args.ftp_concurrency, blocksize=args.ftp_blocksize, journal=journal)
+    update_logging_db(env, {
+        os.path.basename(f): journal.files[os.path.basename(f)]['item_id_ranges']
+        for f in unfinished_files}, journal)
 
-        print(f"Transferring: {submission_file}")
-        with open(submission_file_with_path, 'rb') as file:
-            ftp.storbinary(f'STOR {submission_file}', file)
+    return first_page, after_id
 
-    ftp.quit()
 
+# =========================
+# Pipelined resubmission
+#
+# Fetch, render, upload and logging DB update run at the same time:
+# page N+1 is rendered while page N uploads and the DB read streams
+# ahead, with bounded queues between the stages. Each file's items are
+# marked as submitted as soon as that file's upload is confirmed, so a
+# failed run leaves only the files that really arrived marked.
+def resubmit_pipelined(env, output_dir, submission_file_stub, args,
+                       journal, first_page=0, after_id=None):
+    item_pages = linkout_pipeline.numbered(
+        paginate(iter_item_batches(env, after_id), args), first_page)
+    manifest = linkout_ftp.UploadManifest(
+        os.path.join(output_dir, linkout_ftp.manifest_filename))
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+
+    def render(numbered_page):
+        page_number, (eschol_page, rendered_links) = numbered_page
+        submission_file_with_path = get_submission_file_with_path(
+            output_dir, submission_file_stub, page_number)
+        if executor is None:
+            write_submission_file(eschol_page, submission_file_with_path, rendered_links)
+        else:
+            executor.submit(
+                write_submission_file, eschol_page, submission_file_with_path,
+                rendered_links).result()
+
+        if args.verify_serial:
+            verify_page_matches_serial(eschol_page, submission_file_with_path)
+
+        # Nothing is uploaded until its file has passed validation
+        if executor is None:
+            linkout_validate.check_file(submission_file_with_path)
+        else:
+            executor.submit(linkout_validate.check_file, submission_file_with_path).result()
+
+        item_id_ranges = linkout_journal.to_id_ranges(eschol_page.ids)
+        linkout_metrics.count('rows', len(eschol_page))
+        linkout_metrics.count('bytes_written', os.path.getsize(submission_file_with_path))
+        record_rendered(journal, submission_file_with_path, page_number, item_id_ranges)
+        return submission_file_with_path, item_id_ranges
+
+    # A page rendered the same as in the run being resumed keeps its
+    # journaled upload and logging DB update, so neither is redone
+    def upload(rendered_file):
+        submission_file_with_path, item_id_ranges = rendered_file
+        submission_file = os.path.basename(submission_file_with_path)
+        if not journal.is_done(submission_file, 'uploaded'):
+            linkout_ftp.upload_file(pool, submission_file_with_path, manifest, args.ftp_blocksize)
+            journal.record('uploaded', file=submission_file)
+        return submission_file_with_path, item_id_ranges
+
+    # Runs alongside the source's streaming read, so it gets a
+    # connection of its own from the manager
+    def mark_submitted(uploaded_file):
+        submission_file_with_path, item_id_ranges = uploaded_file
+        submission_file = os.path.basename(submission_file_with_path)
+        if not journal.is_done(submission_file, 'committed'):
+            linkout_connections.retry(
+                env, 'logging_db', linkout_db.mark_items_submitted,
+                {submission_file: linkout_journal.from_id_ranges(item_id_ranges)})
+            journal.record('committed', file=submission_file)
+        return submission_file_with_path
+
+    try:
+        with linkout_ftp.get_session_pool(env, args.ftp_concurrency) as pool:
+            submitted_files = linkout_pipeline.run_pipeline(item_pages, [
+                linkout_pipeline.Stage('render', render, workers=max(args.workers, 1)),
+                linkout_pipeline.Stage('upload', upload, workers=args.ftp_concurrency),
+                linkout_pipeline.Stage('logging_db_update', mark_submitted)])
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    journal.record('paginated')
+    print(f"{len(submitted_files)} files rendered, uploaded and marked as submitted.")
 
-def update_logging_db(env, submission_file_stub):
-    mysql_conn = get_logging_db_connection(env)
-    submission_file = f"{submission_file_stub}_*"
 
-    print("Connected to logging DB. Updating submitted items.")
-    with mysql_conn.cursor() as cursor:
-        cursor.execute(f"""
-            UPDATE linkout_items
-            SET
-                submitted = now(),
-                pubmed_filename = '{submission_file}';
-            """)
-        mysql_conn.commit()
+# =========================
+# Incremental resubmission
+#
+# Each item is assigned to one of n buckets by a hash of its eschol_id, and
+# each bucket is written to a file with a stable name, so re-uploading a
+# bucket replaces that file on the FTP. A digest of each bucket's rows is
+# kept between runs. One scan of the logging DB digests every bucket
+# without rendering anything; only the buckets whose digest changed are
+# then fetched by id, rendered, uploaded and marked in the logging DB.
+def resubmit_changed_buckets(env, output_dir, args, metrics, other_layout_files=()):
+    previous_state = load_page_digests()
+
+    # Replacing full-run files means every bucket has to be on the FTP
+    if previous_state.get('bucket_count') != args.buckets or other_layout_files:
+        previous_state = {'bucket_count': args.buckets, 'digests': {}}
+
+    with metrics.stage('digest'):
+        bucket_ids, digests = get_bucket_digests(env, args.buckets)
+
+    changed_buckets = [
+        bucket for bucket in range(args.buckets)
+        if digests[bucket] != previous_state['digests'].get(str(bucket))]
+    print(f"{len(changed_buckets)} of {args.buckets} buckets changed since the last resubmission.")
+    if not changed_buckets:
+        return
+
+    with metrics.stage('render'):
+        bucket_files = {}
+        file_item_ids = {}
+        for bucket in changed_buckets:
+            bucket_file, item_ids = create_bucket_file(env, output_dir, bucket, bucket_ids[bucket])
+            bucket_files[bucket] = bucket_file
+            file_item_ids[os.path.basename(bucket_file)] = item_ids
+
+    with metrics.stage('upload'):
+        upload_submission_files_to_ftp(
+            env, output_dir, list(bucket_files.values()),
+            concurrency=args.ftp_concurrency, blocksize=args.ftp_blocksize)
+
+    with metrics.stage('logging_db_update'):
+        print("Updating submitted items in the logging DB.")
+        linkout_connections.retry(
+            env, 'logging_db', linkout_db.mark_items_submitted, file_item_ids)
+
+    for bucket in changed_buckets:
+        previous_state['digests'][str(bucket)] = digests[bucket]
+    save_page_digests(previous_state)
+
+    linkout_ftp.delete_remote_files(env, other_layout_files)
+
+
+def get_bucket(eschol_id, n_buckets):
+    return zlib.crc32(eschol_id.encode('UTF8')) % n_buckets
+
+
+# Digests every bucket in one scan, without rendering. Rows arrive
+# ordered by eschol_id, so each bucket's digest is stable without holding
+# its rows in memory. Returns the ids and digests, each indexed by bucket.
+def get_bucket_digests(env, n_buckets):
+    bucket_ids = [array('q') for _ in range(n_buckets)]
+    hashers = [hashlib.sha256() for _ in range(n_buckets)]
+
+    for item in iter_all_items(env, order_by="eschol_id"):
+        bucket = get_bucket(item['eschol_id'], n_buckets)
+        bucket_ids[bucket].append(item['id'])
+        hashers[bucket].update(
+            f"{item['eschol_id']}\t{item['pubmed_id']}\n".encode('UTF8'))
+
+    return bucket_ids, [h.hexdigest() for h in hashers]
+
+
+# Fetches one bucket's rows by id and writes its file. Returns the file
+# name and the ids that went into it.
+def create_bucket_file(env, output_dir, bucket, item_ids):
+    bucket_file = f"{output_dir}/{incremental_file_stub}_{str(bucket).zfill(5)}.xml"
+    bucket_items = linkout_connections.retry(
+        env, 'logging_db', linkout_db.fetch_items_by_ids, item_ids)
+
+    print(f"Exporting: {bucket_file}")
+    bucket_items.write_resource_file(bucket_file)
+    linkout_metrics.count('rows', len(bucket_items))
+    linkout_metrics.count('bytes_written', os.path.getsize(bucket_file))
+    return bucket_file, array('q', bucket_items.ids)
+
+
+def load_page_digests():
+    if not os.path.exists(page_digests_file):
+        return {}
+    with open(page_digests_file, 'r') as f:
+        return json.load(f)
+
+
+def save_page_digests(state):
+    os.makedirs(os.path.dirname(page_digests_file), exist_ok=True)
+    temp_file = f"{page_digests_file}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp_file, page_digests_file)
 
-    mysql_conn.close()
 
+# =========================
+# With a journal, files it shows as uploaded are skipped, and each
+# upload is journaled as soon as it's confirmed.
+def upload_submission_files_to_ftp(env, output_dir, submission_files_with_path,
+                                   concurrency=linkout_ftp.default_concurrency,
+                                   blocksize=linkout_ftp.default_blocksize,
+                                   journal=None):
+    on_uploaded = None
+    if journal is not None:
+        submission_files_with_path = [
+            f for f in submission_files_with_path
+            if not journal.is_done(os.path.basename(f), 'uploaded')]
+
+        def on_uploaded(submission_file_with_path):
+            journal.record('uploaded', file=os.path.basename(submission_file_with_path))
+
+    # Don't upload anything unless every file is valid LinkOut
+    linkout_validate.check_files(submission_files_with_path)
+
+    print(f"Uploading {len(submission_files_with_path)} files from {output_dir}.")
+    linkout_ftp.upload_files(
+        env, submission_files_with_path,
+        concurrency=concurrency, blocksize=blocksize, on_uploaded=on_uploaded)
+
+
+# Marks exactly the ids written to each file, given as item id runs.
+# With a journal, each file's items are committed and journaled in turn,
+# skipping files it shows as done.
+def update_logging_db(env, file_item_id_ranges, journal=None):
+    print("Updating submitted items in the logging DB.")
+    for submission_file, item_id_ranges in file_item_id_ranges.items():
+        if journal is not None and journal.is_done(submission_file, 'committed'):
+            continue
+        linkout_connections.retry(
+            env, 'logging_db', linkout_db.mark_items_submitted,
+            {submission_file: linkout_journal.from_id_ranges(item_id_ranges)})
+        if journal is not None:
+            journal.record('committed', file=submission_file)
 
 
 # =========================
@@ -0,0 +1,34 @@
+-- Side index of eScholarship items' PubMed IDs, in the logging DB next to
+-- linkout_items, so exclusions are an indexed anti-join on eschol_id.
+-- Maintained by eschol_pmid_index.sync(); see that module.
+--
+-- Schema assumption: the eSchol DB's items table has an updated datetime
+-- column that changes whenever an item's attrs (and so its pmid) change.
+-- Incremental syncs only re-read items whose added or updated is past
+-- synced_through. Deleted items are only dropped by the periodic full
+-- rebuild, which removes every row whose synced is older than the rebuild.
+
+CREATE TABLE IF NOT EXISTS eschol_pmids (
+    eschol_id varchar(16) NOT NULL,
+    pubmed_id varchar(32) NOT NULL,
+    added datetime NULL,
+    synced datetime NOT NULL,
+    PRIMARY KEY (eschol_id, pubmed_id),
+    KEY eschol_pmids_added (added),
+    KEY eschol_pmids_pubmed_id (pubmed_id),
+    KEY eschol_pmids_synced (synced)
+);
+
+-- One row: items added or updated after synced_through (less a lookback)
+-- are re-read on the next sync, and once rebuilt_at is older than
+-- eschol_pmid_index.full_rebuild_interval, every item is.
+CREATE TABLE IF NOT EXISTS eschol_pmid_sync (
+    id tinyint NOT NULL PRIMARY KEY,
+    synced_through datetime NOT NULL,
+    rebuilt_at datetime NULL
+);
+
+-- For a database created before the columns above:
+-- ALTER TABLE eschol_pmids ADD COLUMN synced datetime NOT NULL DEFAULT '1970-01-01',
+--     ADD KEY eschol_pmids_synced (synced);
+-- ALTER TABLE eschol_pmid_sync ADD COLUMN rebuilt_at datetime NULL;
@@ -1,25 +1,45 @@
 from dotenv import dotenv_values
+import argparse
 import datetime
 import pymysql
-import xml.etree.ElementTree as ET
-from ftplib import FTP
+import os
 import subprocess
+import linkout_connections
+import linkout_db
+import linkout_ftp
+import linkout_journal
+import linkout_metrics
+import linkout_validate
+from linkout_items import LinkOutItems
 
+# Run journal, for --resume
+journal_job = 'submit_new_pubmed_items'
 
-# =========================
-def get_logging_db_connection(env):
-    mysql_conn = pymysql.connect(
-        host=env['LOGGING_DB_SERVER'],
-        user=env['LOGGING_DB_USER'],
-        password=env['LOGGING_DB_PASSWORD'],
-        database=env['LOGGING_DB_DATABASE'],
-        cursorclass=pymysql.cursors.DictCursor)
 
-    return mysql_conn
+# =========================
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Submit newly enqueued items to PubMed LinkOut.")
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Finish the last submission that didn't complete, skipping the "
+             "steps its journal shows as done, instead of starting a new one.")
+    return parser.parse_args()
+
+
+# Run from enqueue_new_pubmed_items_elements, this reuses enqueue's
+# connections: the outer ConnectionManager stays the active one.
+def main(resume=False):
+    env = dotenv_values(".env")
+    with linkout_metrics.RunMetrics('submit_new_pubmed_items', env) as metrics, \
+            linkout_connections.ConnectionManager(env):
+        submit_new_items(env, metrics, resume)
 
 
-def main():
-    env = dotenv_values(".env")
+# Each step is journaled once it's done. A resumed run finishes the
+# journaled file and its items, so items that were uploaded before a
+# failure aren't picked up and sent again in a new file.
+def submit_new_items(env, metrics, resume=False):
 
     # Runtime string for dirs, filenames, logging DB
     run_time = datetime.datetime.now()
@@ -28,128 +48,128 @@ def main():
     run_date = run_time.split('T')[0]
 
     output_dir = "output"
-    submission_file = f"{run_date}_eschol_linkout_resource.xml"
 
-    # Get the new items enqueued for submission
-    new_items = get_new_items_for_submission(env)
-    new_item_count = len(new_items)
+    if resume:
+        journal = linkout_journal.RunJournal.latest_unfinished(journal_job)
+        if journal is None:
+            print("No unfinished submission to resume. Exiting.")
+            return
+        print(f"Resuming from {journal.journal_file}.")
+        submission_file = journal.params['submission_file']
+    else:
+        # Only a file that was uploaded but never marked gets sent twice
+        unfinished = linkout_journal.RunJournal.latest_unfinished(journal_job)
+        if unfinished is not None and any(
+                entry.get('uploaded') and not entry.get('committed')
+                for entry in unfinished.files.values()):
+            print(f"Warning: the last submission ({unfinished.journal_file}) was uploaded "
+                  "but its items weren't marked as submitted, so they'll be sent again. "
+                  "Run with --resume to finish it instead.")
+        submission_file = f"{run_date}_eschol_linkout_resource.xml"
+        journal = linkout_journal.RunJournal.start(
+            journal_job, run_time, {'submission_file': submission_file})
 
-    # Create the XML file
-    submission_file_with_path = create_submission_file(new_items, output_dir, submission_file)
+    submission_file_with_path = f'{output_dir}/{submission_file}'
+    entry = journal.files.get(submission_file, {})
+
+    if not entry.get('rendered'):
+        # Get the new items enqueued for submission
+        with metrics.stage('fetch'):
+            new_items = get_new_items_for_submission(env)
+
+        # Create the XML file
+        with metrics.stage('render'):
+            create_submission_file(new_items, output_dir, submission_file)
+            record_rendered(journal, submission_file_with_path, new_items.ids)
+
+    elif not entry.get('uploaded') and (
+            not os.path.exists(submission_file_with_path) or
+            os.path.getsize(submission_file_with_path) != entry['bytes']):
+        # Rebuilt from exactly the items the journal says went into it
+        with metrics.stage('render'):
+            new_items = linkout_connections.retry(
+                env, 'logging_db', linkout_db.fetch_items_by_id_ranges, entry['item_id_ranges'])
+            create_submission_file(new_items, output_dir, submission_file)
+            record_rendered(journal, submission_file_with_path, new_items.ids)
+
+    item_ids = linkout_journal.from_id_ranges(journal.files[submission_file]['item_id_ranges'])
 
     # Send to PubMed FTP
-    upload_submission_file_to_ftp(env, submission_file_with_path, submission_file)
+    with metrics.stage('upload'):
+        if not journal.is_done(submission_file, 'uploaded'):
+            upload_submission_file_to_ftp(env, submission_file_with_path)
+            journal.record('uploaded', file=submission_file)
 
     # Update the logging DB
-    update_logging_db(env, submission_file)
+    with metrics.stage('logging_db_update'):
+        if not journal.is_done(submission_file, 'committed'):
+            update_logging_db(env, submission_file, item_ids)
+            journal.record('committed', file=submission_file)
 
     # Email stakeholders
-    send_notification_email(env, submission_file, new_item_count)
+    with metrics.stage('notify'):
+        if 'notified' not in journal.events:
+            send_notification_email(env, submission_file, len(item_ids))
+            journal.record('notified')
 
+    journal.finish()
     print("Program complete. Exiting.")
 
 
+def record_rendered(journal, submission_file_with_path, item_ids):
+    journal.record(
+        'rendered', file=os.path.basename(submission_file_with_path),
+        bytes=os.path.getsize(submission_file_with_path),
+        item_id_ranges=linkout_journal.to_id_ranges(item_ids))
+
+
 def get_new_items_for_submission(env):
-    mysql_conn = get_logging_db_connection(env)
+    return linkout_connections.retry(env, 'logging_db', fetch_new_items)
+
 
+def fetch_new_items(mysql_conn):
+    # Plain tuple rows, stored column by column
     print("Connected to logging DB. Getting new items for submission.")
-    with mysql_conn.cursor() as cursor:
-        cursor.execute("""SELECT eschol_id, pubmed_id FROM linkout_items
+    with mysql_conn.cursor(pymysql.cursors.Cursor) as cursor:
+        cursor.execute("""SELECT id, eschol_id, pubmed_id FROM linkout_items
             WHERE submitted IS NULL""")
-        new_items = cursor.fetchall()
-    mysql_conn.close()
+        new_items = LinkOutItems.from_rows(cursor.fetchall(), columns=('id', 'eschol_id', 'pubmed_id'))
+        linkout_metrics.count('db_round_trips')
+        linkout_metrics.count('rows', len(new_items))
 
     return new_items
 
 
 def create_submission_file(new_items, output_dir, submission_file):
 
-    # Create the XML from new_items dict
-    xml_data = create_xml_data(new_items)
-
-    # Export XML --> string to output file
+    # Stream each new item into the output file as a <Link>
     submission_file_with_path = f'{output_dir}/{submission_file}'
-    with open(submission_file_with_path, 'w') as f:
-        print(f"Exporting: {submission_file_with_path}")
-
-        # Add the header manually before the XML body
-        doctype_header = '<?xml version="1.0" ?>\n' \
-                         '<!DOCTYPE LinkSet PUBLIC "-//NLM//DTD LinkOut 1.0//EN" ' \
-                         '"https://www.ncbi.nlm.nih.gov/projects/linkout/doc/LinkOut.dtd" ' \
-                         '[<!ENTITY icon.url "https://escholarship.org/images/pubmed_linkback.png"> ' \
-                         '<!ENTITY base.url "https://escholarship.org/uc/item/" > ]>\n'
-        f.write(doctype_header)
-
-        # Element tree: Convert to string, replace & html escaping
-        ET.indent(xml_data, space="\t", level=0)
-        xml_string = ET.tostring(xml_data, encoding='unicode')
-        xml_string = xml_string.replace('&amp;', '&')
-        f.write(xml_string)
+    print(f"Exporting: {submission_file_with_path}")
+    new_items.write_resource_file(submission_file_with_path)
+
+    linkout_metrics.count('rows', len(new_items))
+    linkout_metrics.count('bytes_written', os.path.getsize(submission_file_with_path))
 
     # Return the output filename
     return submission_file_with_path
 
 
-def create_xml_data(new_items):
-    link_set = ET.Element("LinkSet")
-
-    for item in new_items:
-        link = ET.SubElement(link_set, "Link")
-        ET.SubElement(link, "LinkId").text = item['eschol_id']
-        ET.SubElement(link, "ProviderId").text = "7383"
-        # ET.SubElement(link, "IconURL").text = "https://escholarship.org/images/pubmed_linkback.png"
-        ET.SubElement(link, "IconUrl").text = "&icon.url;"
-
-        # Link > ObjectSelector
-        object_selector = ET.SubElement(link, "ObjectSelector")
-        ET.SubElement(object_selector, "Database").text = "PubMed"
-
-        # Link > ObjectSelector > ObjectList
-        object_list = ET.SubElement(object_selector, "ObjectList")
-        ET.SubElement(object_list, "ObjId").text = str(item['pubmed_id'])
-
-        # Link > ObjectURL
-        object_url = ET.SubElement(link, "ObjectUrl")
-        # ET.SubElement(object_url, "Rule").text = f"https://escholarship.org/uc/item/{item['eschol_id']}"
-        ET.SubElement(object_url, "Base").text = '&base.url;'
-        ET.SubElement(object_url, "Rule").text = item['eschol_id'][2:]
-        ET.SubElement(object_url, "UrlName").text = "Full text from University of California eScholarship"
-        ET.SubElement(object_url, "Attribute").text = "full-text PDF"
-
-    return link_set
-
-
-def upload_submission_file_to_ftp(env, submission_file_with_path, submission_file):
-    # https://docs.python.org/3/library/ftplib.html#ftplib.FTP.storbinary
-
-    print("Connecting to PubMed Linkout FTP.")
-    ftp = FTP(env['LINKOUT_FTP_URL'],
-              env['LINKOUT_FTP_USER'],
-              env['LINKOUT_FTP_PASSWORD'])  # should return 230 successful login
-
-    ftp.cwd(env['LINKOUT_FTP_DIR'])  # should return 250 successful dir change
-
-    print(f"Transferring: {submission_file}")
-    with open(submission_file_with_path, 'rb') as file:
-        ftp.storbinary(f'STOR {submission_file}', file)
-
-    ftp.quit()
-
-
-def update_logging_db(env, submission_file):
-    mysql_conn = get_logging_db_connection(env)
+# Sent through linkout_ftp, so a dropped connection is retried and resumed
+# from the remote SIZE, and the file only counts as uploaded once the
+# server holds all its bytes. The upload manifest goes next to the file.
+def upload_submission_file_to_ftp(env, submission_file_with_path):
+    linkout_validate.check_files([submission_file_with_path])
+    linkout_ftp.upload_files(env, [submission_file_with_path], concurrency=1)
 
-    print("Connected to logging DB. Updating submitted items.")
-    with mysql_conn.cursor() as cursor:
-        cursor.execute(f"""
-            UPDATE linkout_items
-            SET
-                submitted = now(),
-                pubmed_filename = '{submission_file}'
-            WHERE pubmed_filename IS NULL""")
-        mysql_conn.commit()
 
-    mysql_conn.close()
+# Only marks the rows that went into the file; anything enqueued
+# after get_new_items_for_submission ran waits for the next submission.
+# Marking an item again only re-stamps it, so the update can be retried.
+def update_logging_db(env, submission_file, submitted_item_ids):
+    print("Updating submitted items in the logging DB.")
+    linkout_connections.retry(
+        env, 'logging_db', linkout_db.mark_items_submitted,
+        {submission_file: submitted_item_ids})
 
 
 def send_notification_email(env, submission_file, new_item_count):
@@ -171,13 +191,15 @@ Thank you!'''
 
 # =========================
 # Runs the program if the bit is 1, otherwise flip the bit and exit.
+# A resumed run always runs, and counts as this fortnight's submission.
 if __name__ == '__main__':
+    args = get_args()
     with open("biweekly_bit.txt", 'r') as f:
         biweekly_bit = f.read().strip()
 
-    if biweekly_bit == '1':
+    if biweekly_bit == '1' or args.resume:
         biweekly_bit = 0
-        main()
+        main(args.resume)
     else:
         biweekly_bit = 1
 
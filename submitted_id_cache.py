@@ -0,0 +1,164 @@
+# Local cache of eSchol IDs already in the linkout_items logging table.
+#
+# The IDs are kept in a sorted file of fixed-width records (NUL-padded to
+# id_width bytes, matching the varchar(16) used for eSchol IDs elsewhere),
+# memory-mapped and binary-searched for lookups. Alongside it, a small JSON
+# file stores the highest linkout_items.id seen, so each sync only pulls
+# rows added since the last one.
+#
+# Auto-increment ids aren't committed in order: a row can become visible
+# after rows with higher ids. Each sync re-reads the sync_lookback_ids ids
+# below the highest one seen, so a row that committed late is still picked
+# up; the ones already cached are merged away.
+#
+# Rows deleted from linkout_items aren't seen by an incremental sync;
+# call rebuild() after deleting from the table.
+
+import json
+import heapq
+import mmap
+import os
+
+id_width = 16
+fetch_size = 5000
+sync_lookback_ids = 10000
+default_cache_dir = "state"
+cache_filename = "submitted_ids.bin"
+meta_filename = "submitted_ids.json"
+
+
+# =========================
+class SubmittedIdCache:
+
+    def __init__(self, cache_dir=default_cache_dir):
+        self.cache_file = os.path.join(cache_dir, cache_filename)
+        self.meta_file = os.path.join(cache_dir, meta_filename)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.max_id = 0
+        if os.path.exists(self.meta_file) and os.path.exists(self.cache_file):
+            with open(self.meta_file, 'r') as f:
+                self.max_id = json.load(f)['max_id']
+        else:
+            open(self.cache_file, 'wb').close()
+
+        self.f = None
+        self.mm = None
+        self.count = 0
+        self.open_map()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, eschol_id):
+        key = encode_id(eschol_id)
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            record = self.mm[mid * id_width:(mid + 1) * id_width]
+            if record < key:
+                low = mid + 1
+            elif record > key:
+                high = mid
+            else:
+                return True
+        return False
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield decode_id(self.mm[i * id_width:(i + 1) * id_width])
+
+    # Pulls linkout_items rows added since the last sync, plus the lookback
+    # window below them, and merges them in. Returns the number of IDs added.
+    # mysql_conn should use a DictCursor, as get_logging_db_connection does.
+    def sync(self, mysql_conn):
+        read_ids = []
+        new_max_id = self.max_id
+        previous_count = self.count
+
+        with mysql_conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT id, eschol_id FROM linkout_items WHERE id > %s ORDER BY id",
+                (max(self.max_id - sync_lookback_ids, 0),))
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                read_ids.extend(encode_id(row['eschol_id']) for row in rows)
+                new_max_id = max(new_max_id, rows[-1]['id'])
+
+        if read_ids:
+            read_ids.sort()
+            self.merge(read_ids)
+        self.save_meta(new_max_id)
+
+        new_id_count = self.count - previous_count
+        print(f"Submitted ID cache synced: {new_id_count} new IDs, {self.count} total.")
+        return new_id_count
+
+    def rebuild(self, mysql_conn):
+        self.close()
+        open(self.cache_file, 'wb').close()
+        self.save_meta(0)
+        self.open_map()
+        return self.sync(mysql_conn)
+
+    # Writes the union of the current file and new_ids (both sorted) to a
+    # temp file and swaps it in.
+    def merge(self, new_ids):
+        temp_file = f"{self.cache_file}.tmp"
+        existing = (self.mm[i * id_width:(i + 1) * id_width] for i in range(self.count))
+
+        with open(temp_file, 'wb') as out:
+            previous = None
+            for record in heapq.merge(existing, new_ids):
+                if record != previous:
+                    out.write(record)
+                    previous = record
+
+        self.close()
+        os.replace(temp_file, self.cache_file)
+        self.open_map()
+
+    def save_meta(self, max_id):
+        self.max_id = max_id
+        temp_file = f"{self.meta_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump({'max_id': max_id, 'id_width': id_width}, f)
+        os.replace(temp_file, self.meta_file)
+
+    def open_map(self):
+        self.f = open(self.cache_file, 'rb')
+        size = os.fstat(self.f.fileno()).st_size
+        self.count = size // id_width
+
+        # mmap can't map an empty file
+        if size:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = b''
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.mm = b''
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+def encode_id(eschol_id):
+    encoded = eschol_id.encode('ascii')
+    if len(encoded) > id_width:
+        raise ValueError(f"eSchol ID longer than {id_width} bytes: {eschol_id}")
+    return encoded.ljust(id_width, b'\0')
+
+
+def decode_id(record):
+    return record.rstrip(b'\0').decode('ascii')
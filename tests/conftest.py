@@ -0,0 +1,27 @@
+# Shared modules live in the repo root
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+eschol_id_chars = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+# Synthetic (id, ucpms_id, eschol_id, pubmed_id) item dicts, like the
+# benchmark's, always the same for a given count.
+def generate_rows(row_count, seed=7383):
+    rng = random.Random(seed)
+    return [
+        {'id': i + 1,
+         'ucpms_id': rng.randrange(1000000, 9999999),
+         'eschol_id': 'qt' + ''.join(rng.choices(eschol_id_chars, k=8)),
+         'pubmed_id': rng.randrange(10000000, 40000000)}
+        for i in range(row_count)]
+
+
+@pytest.fixture
+def rows():
+    return generate_rows(2000)
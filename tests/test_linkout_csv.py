@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+
+import pytest
+
+import linkout_csv
+
+# {row index: fields}, each written just before that row
+bad_rows = {
+    10: ['1', 'qtbad00001', 'abc'],
+    250: ['x', 'qtbad00002', '1'],
+    500: ['1', '', '1'],
+    600: ['1', 'qtbad00004', '0123'],
+    750: ['1', 'qtbad00003']}
+
+
+@pytest.fixture
+def batch_csv(rows, tmp_path):
+    file_name = tmp_path / "batch.csv"
+    with open(file_name, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ucpms_id', 'eschol_id', 'pubmed_id'])
+        for row_number, row in enumerate(rows):
+            if row_number in bad_rows:
+                writer.writerow(bad_rows[row_number])
+            writer.writerow([row['ucpms_id'], row['eschol_id'], row['pubmed_id']])
+    return str(file_name)
+
+
+@pytest.fixture
+def small_ranges(monkeypatch):
+    monkeypatch.setattr(linkout_csv, 'range_bytes', 4096)
+
+
+def read_rows(csv_reader):
+    return [row for batch in csv_reader for row in batch.rows()]
+
+
+# Malformed rows must be left out and reported at their line numbers, and
+# parsing in byte ranges must give the same items and rejects as one pass.
+def test_reads_rows_and_rejects_by_line(rows, batch_csv, small_ranges):
+    serial_reader = linkout_csv.CsvItemReader(batch_csv)
+    serial_rows = read_rows(serial_reader)
+
+    assert serial_rows == [
+        (row['ucpms_id'], row['eschol_id'], str(row['pubmed_id'])) for row in rows]
+    assert [line_number for line_number, message in serial_reader.rejects] == [
+        row_number + 2 + i for i, row_number in enumerate(sorted(bad_rows))]
+
+    range_reader = linkout_csv.CsvItemReader(batch_csv, workers=2)
+    assert read_rows(range_reader) == serial_rows
+    assert range_reader.rejects == serial_reader.rejects
+    assert range_reader.line_count == serial_reader.line_count
+
+
+# Only about workers ranges are parsed ahead of the batch being consumed.
+def test_ranges_are_parsed_a_few_ahead(batch_csv, small_ranges, monkeypatch):
+    submitted = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args):
+            submitted.append(args[1:3])
+            return super().submit(fn, *args)
+
+    monkeypatch.setattr(linkout_csv, 'ProcessPoolExecutor', RecordingExecutor)
+    csv_reader = linkout_csv.CsvItemReader(batch_csv, workers=2)
+    batches = iter(csv_reader)
+
+    next(batches)
+    assert len(submitted) == 3
+    next(batches)
+    assert len(submitted) == 4
+
+    batch_count = 2 + sum(1 for batch in batches)
+    assert len(submitted) == batch_count > 4
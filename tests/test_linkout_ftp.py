@@ -0,0 +1,183 @@
+# linkout_ftp against a local pyftpdlib server, the same stand-in the
+# benchmark's ftp_upload stage uses.
+
+from ftplib import FTP
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+
+import linkout_ftp
+
+pyftpdlib = pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer  # noqa: E402
+from pyftpdlib.handlers import FTPHandler  # noqa: E402
+from pyftpdlib.servers import ThreadedFTPServer  # noqa: E402
+
+
+@pytest.fixture
+def ftp_server(tmp_path):
+    ftp_logger = logging.getLogger('pyftpdlib')
+    ftp_logger.addHandler(logging.NullHandler())
+    ftp_logger.propagate = False
+
+    ftp_root = tmp_path / "ftp"
+    ftp_root.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_user('test', 'test', str(ftp_root), perm='elradfmwMT')
+    handler = type('TestFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+    server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+    thread.start()
+    try:
+        yield ftp_root, server.address[1]
+    finally:
+        server.close_all()
+
+
+@pytest.fixture
+def files(tmp_path):
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    file_names = []
+    for i in range(6):
+        file_name = output_dir / f"resource_{i:05d}.xml"
+        file_name.write_bytes(os.urandom(1024) * (20 + i))
+        file_names.append(str(file_name))
+    return file_names
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(linkout_ftp, 'retry_backoff_seconds', 0.1)
+
+
+# A connect() for upload_files that logs in with ftp_class and keeps
+# every session it opens in sessions.
+def get_connect(ftp_server, ftp_class=FTP, sessions=None):
+    ftp_root, port = ftp_server
+
+    def connect():
+        ftp = ftp_class()
+        ftp.connect('127.0.0.1', port)
+        ftp.login('test', 'test')
+        ftp.cwd('/')
+        if sessions is not None:
+            sessions.append(ftp)
+        return ftp
+    return connect
+
+
+def assert_uploaded(ftp_server, files):
+    ftp_root, port = ftp_server
+    for file_name in files:
+        remote_file = ftp_root / os.path.basename(file_name)
+        with open(file_name, 'rb') as f:
+            assert remote_file.read_bytes() == f.read()
+
+    manifest_file = os.path.join(os.path.dirname(files[0]), linkout_ftp.manifest_filename)
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    assert all(manifest[os.path.basename(file_name)]['uploaded'] for file_name in files)
+
+
+# =========================
+def test_uploads_concurrently_over_reused_sessions(ftp_server, files):
+    lock = threading.Lock()
+    active = [0, 0]  # now, most at once
+
+    class CountingFTP(FTP):
+        def storbinary(self, *args, **kwargs):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            try:
+                time.sleep(0.05)
+                return super().storbinary(*args, **kwargs)
+            finally:
+                with lock:
+                    active[0] -= 1
+
+    sessions = []
+    results = linkout_ftp.upload_files(
+        None, files, concurrency=2, connect=get_connect(ftp_server, CountingFTP, sessions))
+
+    assert [remote_name for remote_name, sent_bytes, seconds in results] == [
+        os.path.basename(file_name) for file_name in files]
+    assert len(sessions) == 2
+    assert active[1] == 2
+    assert_uploaded(ftp_server, files)
+
+    # A rerun finds every file already there and sends nothing
+    results = linkout_ftp.upload_files(None, files, concurrency=2, connect=get_connect(ftp_server))
+    assert [sent_bytes for remote_name, sent_bytes, seconds in results] == [0] * len(files)
+
+
+def test_resumes_after_dropped_connection(ftp_server, files):
+    rests = []
+
+    # The first transfer stops after three blocks, which the server keeps,
+    # and the session then drops
+    class DroppingFTP(FTP):
+        def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+            rests.append(rest)
+            if len(rests) > 1:
+                return super().storbinary(cmd, fp, blocksize, callback, rest)
+            super().storbinary(cmd, io.BytesIO(fp.read(3 * blocksize)), blocksize, callback, rest)
+            raise ConnectionResetError("connection dropped")
+
+    [result] = linkout_ftp.upload_files(
+        None, files[:1], concurrency=1, blocksize=1024, connect=get_connect(ftp_server, DroppingFTP))
+
+    assert rests == [None, 3 * 1024]
+    remote_name, sent_bytes, seconds = result
+    assert sent_bytes == os.path.getsize(files[0]) - 3 * 1024
+    assert_uploaded(ftp_server, files[:1])
+
+
+def test_size_mismatch_sends_the_file_again(ftp_server, files):
+    rests = []
+    lied = []
+
+    class MisreportingFTP(FTP):
+        def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+            rests.append(rest)
+            return super().storbinary(cmd, fp, blocksize, callback, rest)
+
+        # The first SIZE after a transfer comes back one byte short
+        def size(self, remote_name):
+            remote_size = super().size(remote_name)
+            if len(rests) == 1 and not lied:
+                lied.append(remote_name)
+                return remote_size - 1
+            return remote_size
+
+    [result] = linkout_ftp.upload_files(
+        None, files[:1], concurrency=1, connect=get_connect(ftp_server, MisreportingFTP))
+
+    assert lied
+    assert rests == [None, None]
+    assert result[1] == os.path.getsize(files[0])
+    assert_uploaded(ftp_server, files[:1])
+
+
+def test_raises_once_every_file_is_tried(ftp_server, files):
+    failing_name = os.path.basename(files[1])
+
+    class RefusingFTP(FTP):
+        def storbinary(self, cmd, *args, **kwargs):
+            if cmd.endswith(failing_name):
+                raise ConnectionResetError("connection dropped")
+            return super().storbinary(cmd, *args, **kwargs)
+
+    with pytest.raises(RuntimeError, match=failing_name):
+        linkout_ftp.upload_files(
+            None, files, concurrency=2, max_attempts=2, connect=get_connect(ftp_server, RefusingFTP))
+
+    other_files = files[:1] + files[2:]
+    assert_uploaded(ftp_server, other_files)
@@ -0,0 +1,72 @@
+import pytest
+
+import linkout_items
+import linkout_xml
+from linkout_items import LinkOutItems
+
+
+def test_from_rows_reads_back_rows(rows):
+    items = LinkOutItems.from_items(rows)
+
+    assert list(items) == [dict(row, pubmed_id=str(row['pubmed_id'])) for row in rows]
+    assert items.rejects == []
+
+
+# A row whose pubmed_id wouldn't read back the same is left out and
+# reported, and the rest of the batch is kept.
+@pytest.mark.parametrize('pubmed_id', ['PMC123', '', None, '0123', '-5', '1.5', '9' * 19])
+def test_from_rows_rejects_bad_pubmed_ids(pubmed_id, capsys):
+    items = LinkOutItems.from_rows(
+        [(1, 'qtaaaaaaaa', '12345'), (2, 'qtbbbbbbbb', pubmed_id), (3, 'qtcccccccc', 67890)],
+        columns=('id', 'eschol_id', 'pubmed_id'))
+
+    assert [(item['id'], item['pubmed_id']) for item in items] == [(1, '12345'), (3, '67890')]
+    assert [(item_id, eschol_id) for item_id, eschol_id, message in items.rejects] == [
+        (2, 'qtbbbbbbbb')]
+    assert "Skipping linkout item 2" in capsys.readouterr().out
+    assert LinkOutItems.concat([items, items]).rejects == items.rejects * 2
+
+
+@pytest.mark.parametrize('eschol_id', [
+    'qt' + 'a' * 15, 'qtüñíçødé', 'qt aaaaaa', '', None, 'qt\0aaaaaa', b'qtbbbbbbbb'])
+def test_from_rows_rejects_bad_eschol_ids(eschol_id, capsys):
+    items = LinkOutItems.from_rows(
+        [(1, 'qtaaaaaaaa', '12345'), (2, eschol_id, '23456'), (3, 'qtcccccccc', 67890)],
+        columns=('id', 'eschol_id', 'pubmed_id'))
+
+    assert [(item['id'], item['eschol_id']) for item in items] == [
+        (1, 'qtaaaaaaaa'), (3, 'qtcccccccc')]
+    assert [(item_id, message.split(':')[0]) for item_id, row_eschol_id, message in items.rejects] == [
+        (2, "eschol_id isn't 1 to 16 printable ASCII characters")]
+    assert "Skipping linkout item 2" in capsys.readouterr().out
+
+
+# Chunks with a bad row go row by row, the rest column by column; both
+# must pack the same.
+def test_from_rows_packs_the_same_either_way(rows, monkeypatch):
+    monkeypatch.setattr(linkout_items, 'pack_size', 300)
+    bad_rows = {450: {'pubmed_id': 'x'}, 1210: {'eschol_id': 'q' * 17}}
+    mixed_rows = [dict(row, **bad_rows.get(i, {})) for i, row in enumerate(rows)]
+    mixed_rows[100]['pubmed_id'] = str(mixed_rows[100]['pubmed_id'])
+    mixed_rows[700]['id'] = None
+
+    items = LinkOutItems.from_items(mixed_rows)
+
+    kept_rows = [row for i, row in enumerate(mixed_rows) if i not in bad_rows]
+    assert list(items) == [dict(row, pubmed_id=str(row['pubmed_id'])) for row in kept_rows]
+    assert [item_id for item_id, eschol_id, message in items.rejects] == [
+        rows[i]['id'] for i in sorted(bad_rows)]
+    assert items.render() == LinkOutItems.from_items(kept_rows).render()
+
+
+# render() formats the batch in one go; render_link_list() one link at a
+# time, falling back to escaping when an eschol_id needs it.
+@pytest.mark.parametrize('escaped_id', [None, 'qtab&cd<ef>'])
+def test_render_matches_link_by_link_render(rows, escaped_id):
+    if escaped_id:
+        rows = [dict(rows[0], eschol_id=escaped_id)] + rows[1:]
+    items = LinkOutItems.from_items(rows)
+
+    assert items.render() == b''.join(items.render_link_list()) == linkout_xml.render_links(
+        linkout_xml.item_links(rows))
+    assert items[10:20].render() == linkout_xml.render_links(linkout_xml.item_links(rows[10:20]))
@@ -0,0 +1,196 @@
+import contextlib
+import json
+import os
+import types
+
+import pytest
+
+import linkout_connections
+import linkout_journal
+import resubmit_full_pubmed_items as resubmit
+from linkout_items import LinkOutItems
+from linkout_journal import RunJournal
+
+
+@pytest.fixture(autouse=True)
+def journal_dir(tmp_path, monkeypatch):
+    journal_dir = tmp_path / "journal"
+    monkeypatch.setattr(linkout_journal, 'journal_dir', str(journal_dir))
+    return journal_dir
+
+
+def read_events(journal_file):
+    with open(journal_file) as f:
+        return [json.loads(line)['event'] for line in f]
+
+
+# =========================
+def test_torn_last_line_is_dropped_and_appending_carries_on():
+    journal = RunJournal.start('job', "2026-01-01T00-00-00", {'max_links': 10})
+    journal.record('rendered', file="a.xml", page=0)
+    journal.record('uploaded', file="a.xml")
+    with open(journal.journal_file, 'a') as f:
+        f.write('{"event": "committed", "fi')
+
+    resumed = RunJournal(journal.journal_file)
+    assert resumed.params == {'max_links': 10}
+    assert resumed.is_done("a.xml", 'uploaded')
+    assert not resumed.is_done("a.xml", 'committed')
+
+    resumed.record('committed', file="a.xml")
+    assert read_events(journal.journal_file) == ['start', 'rendered', 'uploaded', 'committed']
+    assert RunJournal(journal.journal_file).is_done("a.xml", 'committed')
+
+
+def test_corrupt_line_before_the_last_stops_the_load():
+    journal = RunJournal.start('job', "2026-01-01T00-00-00", {})
+    with open(journal.journal_file, 'a') as f:
+        f.write('not json\n{"event": "finished"}\n')
+
+    with pytest.raises(ValueError, match=r"\.jsonl:2 is corrupt"):
+        RunJournal(journal.journal_file)
+
+
+def test_two_runs_started_in_the_same_second_are_refused():
+    RunJournal.start('job', "2026-01-01T00-00-00", {})
+    with pytest.raises(FileExistsError):
+        RunJournal.start('job', "2026-01-01T00-00-00", {})
+
+
+# Only the job's latest run is resumed: an older unfinished run, or
+# another job's, is never picked up.
+def test_latest_unfinished_only_resumes_the_latest_run_of_the_job():
+    assert RunJournal.latest_unfinished('job') is None
+
+    older = RunJournal.start('job', "2026-01-01T00-00-00", {'run': 'older'})
+    latest = RunJournal.start('job', "2026-01-02T00-00-00", {'run': 'latest'})
+    RunJournal.start('other_job', "2026-01-03T00-00-00", {'run': 'other'})
+    assert RunJournal.latest_unfinished('job').journal_file == latest.journal_file
+
+    latest.finish()
+    assert 'finished' not in RunJournal(older.journal_file).events
+    assert RunJournal.latest_unfinished('job') is None
+
+
+# A file rendered again with other contents must be uploaded and
+# committed again, not counted as done from the earlier render.
+def test_rendering_different_contents_starts_the_file_over():
+    journal = RunJournal.start('job', "2026-01-01T00-00-00", {})
+    journal.record('rendered', file="a.xml", page=0, item_id_ranges=[[1, 5]], bytes=100)
+    journal.record('uploaded', file="a.xml")
+    journal.record('rendered', file="a.xml", page=0, item_id_ranges=[[1, 5]], bytes=100)
+    assert journal.is_done("a.xml", 'uploaded')
+
+    journal.record('rendered', file="a.xml", page=0, item_id_ranges=[[1, 6]], bytes=120)
+    assert not journal.is_done("a.xml", 'uploaded')
+    assert not RunJournal(journal.journal_file).is_done("a.xml", 'uploaded')
+
+
+def test_id_ranges_round_trip():
+    ids = [7, 1, 2, 3, 5, 10, 11]
+    assert linkout_journal.to_id_ranges(ids) == [[1, 3], [5, 5], [7, 7], [10, 11]]
+    assert linkout_journal.from_id_ranges(linkout_journal.to_id_ranges(ids)) == sorted(ids)
+    assert linkout_journal.to_id_ranges([]) == []
+
+
+# =========================
+# resubmit --resume
+@pytest.fixture
+def resubmit_journal(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("output")
+    return RunJournal.start(resubmit.journal_job, "2026-01-01T00-00-00", {
+        'submission_file_stub': "2026-01-01_eschol_linkout_resource",
+        'max_file_bytes': 5000, 'max_links': None})
+
+
+def render_page(journal, page_number, item_ids, upload=False, commit=False):
+    file_with_path = resubmit.get_submission_file_with_path(
+        "output", journal.params['submission_file_stub'], page_number)
+    page = LinkOutItems.from_rows(
+        [(item_id, f"qt{item_id:08d}", 1000 + item_id) for item_id in item_ids],
+        columns=('id', 'eschol_id', 'pubmed_id'))
+    resubmit.write_submission_file(page, file_with_path)
+    resubmit.record_rendered(
+        journal, file_with_path, page_number, linkout_journal.to_id_ranges(item_ids))
+    if upload:
+        journal.record('uploaded', file=os.path.basename(file_with_path))
+    if commit:
+        journal.record('committed', file=os.path.basename(file_with_path))
+    return file_with_path
+
+
+# Pages journaled without a gap from page 0 are finished and skipped;
+# the run carries on after the last id they cover.
+def test_resume_finishes_journaled_pages_and_skips_their_ids(resubmit_journal, monkeypatch):
+    journal = resubmit_journal
+    page_0 = render_page(journal, 0, range(1, 11), upload=True, commit=True)
+    page_1 = render_page(journal, 1, range(11, 21), upload=True)
+    page_2 = render_page(journal, 2, [21, 22, 25])
+    render_page(journal, 4, range(40, 50))  # after a gap, so redone by the run
+    os.remove(page_2)
+
+    fetched = []
+    uploaded = []
+    committed = {}
+
+    def retry(env, store, fn, *args):
+        fetched.append(args[0])
+        return LinkOutItems.from_rows(
+            [(item_id, f"qt{item_id:08d}", 1000 + item_id)
+             for item_id in linkout_journal.from_id_ranges(args[0])],
+            columns=('id', 'eschol_id', 'pubmed_id'))
+
+    def upload_files(env, output_dir, files, concurrency, blocksize, journal):
+        uploaded.extend(files)
+        for file_with_path in files:
+            journal.record('uploaded', file=os.path.basename(file_with_path))
+
+    monkeypatch.setattr(linkout_connections, 'retry', retry)
+    monkeypatch.setattr(resubmit, 'upload_submission_files_to_ftp', upload_files)
+    monkeypatch.setattr(
+        resubmit, 'update_logging_db',
+        lambda env, file_item_id_ranges, journal: committed.update(file_item_id_ranges))
+
+    args = types.SimpleNamespace(ftp_concurrency=1, ftp_blocksize=8192)
+    resumed = RunJournal.latest_unfinished(resubmit.journal_job)
+    first_page, after_id = resubmit.finish_journaled_files({}, "output", resumed, args)
+
+    assert (first_page, after_id) == (3, 25)
+    assert fetched == [[[21, 22], [25, 25]]]
+    assert os.path.exists(page_2)
+    assert uploaded == [page_1, page_2]
+    assert committed == {
+        os.path.basename(page_1): [[11, 20]],
+        os.path.basename(page_2): [[21, 22], [25, 25]]}
+    assert os.path.basename(page_0) not in committed
+
+
+# A resumed run keeps the journaled run's file names and page sizes,
+# whatever this run was started with.
+def test_resume_uses_the_journaled_runs_config(resubmit_journal, monkeypatch):
+    render_page(resubmit_journal, 0, range(1, 11), upload=True, commit=True)
+    carried_on = {}
+
+    def resubmit_batched(env, output_dir, submission_file_stub, args, metrics,
+                         journal, first_page, after_id):
+        carried_on.update(
+            submission_file_stub=submission_file_stub, max_file_bytes=args.max_file_bytes,
+            first_page=first_page, after_id=after_id, journal_file=journal.journal_file)
+
+    monkeypatch.setattr(resubmit, 'get_other_layout_files', lambda env, args: [])
+    monkeypatch.setattr(
+        resubmit, 'finish_journaled_files', lambda env, output_dir, journal, args: (1, 10))
+    monkeypatch.setattr(resubmit, 'resubmit_batched', resubmit_batched)
+
+    args = types.SimpleNamespace(
+        incremental=False, resume=True, pipeline=False, max_file_bytes=999999, max_links=5)
+    metrics = types.SimpleNamespace(stage=lambda name: contextlib.nullcontext())
+    resubmit.resubmit_all_items(args, {}, metrics)
+
+    assert carried_on == {
+        'submission_file_stub': "2026-01-01_eschol_linkout_resource",
+        'max_file_bytes': 5000, 'first_page': 1, 'after_id': 10,
+        'journal_file': resubmit_journal.journal_file}
+    assert args.max_links is None
+    assert RunJournal.latest_unfinished(resubmit.journal_job) is None
@@ -0,0 +1,65 @@
+import json
+import threading
+
+import linkout_metrics
+import linkout_pipeline
+
+
+def read_record(metrics_file):
+    with open(metrics_file) as f:
+        return json.loads(f.readlines()[-1])
+
+
+# A thread's counts go to the stage it works for, whatever stage the
+# main thread has open at the time.
+def test_counts_go_to_the_counting_threads_stage(tmp_path):
+    metrics_file = str(tmp_path / "metrics.jsonl")
+    worker_started = threading.Event()
+    main_counted = threading.Event()
+
+    def work(stage_metrics):
+        with linkout_metrics.attach_stage(stage_metrics):
+            worker_started.set()
+            main_counted.wait(5)
+            linkout_metrics.count('rows', 10)
+
+    with linkout_metrics.RunMetrics('test_job', {'METRICS_FILE': metrics_file}) as metrics:
+        with metrics.stage('fetch'):
+            worker = threading.Thread(target=work, args=(linkout_metrics.current_stage(),))
+            worker.start()
+        worker_started.wait(5)
+        with metrics.stage('upload'):
+            linkout_metrics.count('bytes_sent', 5)
+            main_counted.set()
+            worker.join()
+        linkout_metrics.count('outside_any_stage')
+
+    record = read_record(metrics_file)
+    assert record['stages']['fetch']['rows'] == 10
+    assert 'rows' not in record['stages']['upload']
+    assert record['stages']['upload']['bytes_sent'] == 5
+    assert all('peak_rss_mb' not in stage for stage in record['stages'].values())
+    assert record['peak_rss_mb'] > 0
+
+
+def test_pipeline_workers_count_to_their_own_stage(tmp_path):
+    metrics_file = str(tmp_path / "metrics.jsonl")
+
+    def fetch_pages():
+        for page in range(5):
+            linkout_metrics.count('pages_fetched')
+            yield page
+
+    def render(page):
+        linkout_metrics.count('rows', 100)
+        return page
+
+    with linkout_metrics.RunMetrics('test_job', {'METRICS_FILE': metrics_file}) as metrics:
+        with metrics.stage('pipeline'):
+            linkout_pipeline.run_pipeline(fetch_pages(), [
+                linkout_pipeline.Stage('render', render, workers=2)])
+
+    record = read_record(metrics_file)
+    assert record['stages']['pipeline']['pages_fetched'] == 5
+    assert record['stages']['render']['rows'] == 500
+    assert 'rows' not in record['stages']['pipeline']
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+import linkout_pipeline
+from linkout_pipeline import Stage, run_pipeline
+
+timeout_seconds = 10
+
+
+# Runs the pipeline in a thread of its own, so a deadlock fails the test
+# instead of hanging it. Returns the results, or raises the pipeline's error.
+def run_with_timeout(source, stages, **kwargs):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['results'] = run_pipeline(source, stages, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join(timeout_seconds)
+    assert not thread.is_alive(), "pipeline deadlocked"
+    assert not [t for t in threading.enumerate() if t.name.startswith('pipeline-')]
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['results']
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(linkout_pipeline, 'poll_seconds', 0.01)
+
+
+# =========================
+def test_single_workers_keep_the_source_order():
+    results = run_with_timeout(range(200), [
+        Stage('double', lambda n: n * 2),
+        Stage('label', lambda n: f"item {n}")])
+
+    assert results == [f"item {n * 2}" for n in range(200)]
+
+
+def test_stage_error_reaches_the_caller_and_stops_the_rest():
+    source_closed = threading.Event()
+    uploaded = []
+
+    # An endless source: the pipeline only stops if the error stops it
+    def source():
+        try:
+            n = 0
+            while True:
+                yield n
+                n += 1
+        finally:
+            source_closed.set()
+
+    def render(n):
+        if n == 5:
+            raise ValueError("bad page 5")
+        return n
+
+    with pytest.raises(ValueError, match="bad page 5"):
+        run_with_timeout(source(), [
+            Stage('render', render, workers=2),
+            Stage('upload', uploaded.append)])
+
+    assert source_closed.is_set()
+    assert 5 not in uploaded
+
+
+def test_slow_stage_holds_back_the_source():
+    queue_size = 2
+    lead = []
+    produced = [0]
+    consumed = [0]
+
+    def source():
+        for n in range(40):
+            lead.append(produced[0] - consumed[0])
+            produced[0] += 1
+            yield n
+
+    def upload(n):
+        time.sleep(0.02)
+        consumed[0] += 1
+        return n
+
+    stages = [Stage('render', lambda n: n), Stage('upload', upload)]
+    results = run_with_timeout(source(), stages, queue_size=queue_size)
+
+    assert results == list(range(40))
+    # Each stage holds one item and its input queue queue_size more;
+    # the source holds the one it is waiting to put
+    assert max(lead) <= len(stages) * (queue_size + 1) + 1
@@ -0,0 +1,39 @@
+import pytest
+
+import linkout_validate
+import linkout_xml
+
+
+@pytest.fixture
+def valid_file(rows, tmp_path):
+    file_name = tmp_path / "valid.xml"
+    linkout_xml.write_resource_file(file_name, linkout_xml.item_links(rows))
+    return file_name
+
+
+def test_passes_rendered_files(valid_file, tmp_path):
+    empty_file = tmp_path / "empty.xml"
+    linkout_xml.write_resource_file(empty_file, [])
+
+    assert linkout_validate.validate_files([str(valid_file), str(empty_file)], workers=1) == {}
+
+
+@pytest.mark.parametrize('old, new', [
+    ('&icon.url;', '&icon.ur;'),
+    ('<ObjId>', '<ObjId>x'),
+    ('<ObjId>{pubmed_id}</ObjId>', '<ObjId></ObjId>'),
+    ('<Rule>', '<Rule>x'),
+    ('<LinkId>{second_eschol_id}', '<LinkId>{eschol_id}'),
+    ('<ProviderId>7383</ProviderId>', ''),
+    ('</LinkSet>', ''),
+])
+def test_fails_broken_files(rows, valid_file, tmp_path, old, new):
+    fields = {
+        'eschol_id': rows[0]['eschol_id'],
+        'second_eschol_id': rows[1]['eschol_id'],
+        'pubmed_id': rows[0]['pubmed_id']}
+    broken_file = tmp_path / "broken.xml"
+    broken_file.write_text(valid_file.read_text().replace(
+        old.format(**fields), new.format(**fields), 1))
+
+    assert str(broken_file) in linkout_validate.validate_files([str(broken_file)], workers=1)
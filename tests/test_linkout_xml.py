@@ -0,0 +1,153 @@
+# linkout_xml's output, checked against resource files the scripts wrote
+# before it replaced their ElementTree builders.
+#
+# The files in golden/ were written by each script's own builder, as it
+# was before linkout_xml, from the items in golden/items.csv. The four
+# copies had drifted: linkout_xml keeps submit_new_pubmed_items' layout
+# (LinkId = full eSchol ID, Rule = the ID without "qt"), so its output
+# must match that script's files byte for byte, and the other scripts'
+# files in everything but those two fields.
+
+import csv
+import io
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import linkout_xml
+from linkout_items import LinkOutItems
+
+golden_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+
+def read_golden(file_name):
+    with open(os.path.join(golden_dir, file_name), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def golden_items():
+    with open(os.path.join(golden_dir, "items.csv"), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def render(links):
+    output = io.BytesIO()
+    with linkout_xml.LinkOutWriter(output) as writer:
+        writer.write_links(links)
+    return output.getvalue()
+
+
+# [{tag: text}] for each Link, with the entities expanded
+def parse_links(xml_bytes):
+    return [
+        {element.tag: element.text for element in link.iter() if len(element) == 0}
+        for link in ET.fromstring(xml_bytes).iter('Link')]
+
+
+# =========================
+def test_matches_submit_new_pubmed_items(golden_items, tmp_path):
+    expected = read_golden("submit_new_pubmed_items.xml")
+
+    assert render(linkout_xml.item_links(golden_items)) == expected
+
+    file_name = tmp_path / "resource.xml"
+    linkout_xml.write_resource_file(file_name, linkout_xml.item_links(golden_items))
+    assert file_name.read_bytes() == expected
+
+    columnar_items = LinkOutItems.from_items(golden_items)
+    columnar_items.write_resource_file(file_name)
+    assert file_name.read_bytes() == expected
+
+    [(page, rendered_links)] = linkout_xml.paginate_items(golden_items)
+    linkout_xml.write_rendered_resource_file(file_name, rendered_links, len(page))
+    assert file_name.read_bytes() == expected
+
+
+def test_matches_submit_new_pubmed_items_when_empty(tmp_path):
+    expected = read_golden("submit_new_pubmed_items_empty.xml")
+
+    assert render([]) == expected
+    LinkOutItems.from_items([]).write_resource_file(tmp_path / "empty.xml")
+    assert (tmp_path / "empty.xml").read_bytes() == expected
+
+
+@pytest.mark.parametrize('golden_file, baseline_link_id, baseline_rule', [
+    ("resubmit_full_pubmed_items.xml", lambda eschol_id: eschol_id[2:], lambda eschol_id: eschol_id),
+    ("batch_elements_reporting_db_to_pubmed_linkout.xml", lambda eschol_id: eschol_id, lambda eschol_id: eschol_id),
+    ("batch_eschol_to_pubmed_linkout.xml", lambda eschol_id: eschol_id, lambda eschol_id: eschol_id),
+])
+def test_differs_from_other_scripts_only_in_link_id_and_rule(
+        golden_items, golden_file, baseline_link_id, baseline_rule):
+    golden = read_golden(golden_file)
+    output = render(linkout_xml.item_links(golden_items))
+
+    # Same doctype and entities
+    assert output.split(b'<LinkSet')[0] == golden.split(b'<LinkSet')[0]
+
+    golden_links = parse_links(golden)
+    output_links = parse_links(output)
+    assert len(output_links) == len(golden_links) == len(golden_items)
+    for item, golden_link, output_link in zip(golden_items, golden_links, output_links):
+        eschol_id = item['eschol_id']
+        assert golden_link.pop('LinkId') == baseline_link_id(eschol_id)
+        assert golden_link.pop('Rule') == baseline_rule(eschol_id)
+        assert output_link.pop('LinkId') == eschol_id
+        assert output_link.pop('Rule') == eschol_id[2:]
+        assert output_link == golden_link
+
+
+# The scripts' builders un-escaped every &amp;, which broke IDs containing
+# &; linkout_xml escapes the fields and leaves only the entities as-is.
+def test_escapes_ids():
+    items = [
+        {'eschol_id': 'qt12345678', 'pubmed_id': 12345678},
+        {'eschol_id': 'qtab&cd<ef>', 'pubmed_id': '987&654'}]
+    output = render(linkout_xml.item_links(items))
+
+    links = parse_links(output)
+    assert [(link['LinkId'], link['ObjId'], link['Rule']) for link in links] == [
+        ('qt12345678', '12345678', '12345678'),
+        ('qtab&cd<ef>', '987&654', 'ab&cd<ef>')]
+    assert links[0]['IconUrl'] == "https://escholarship.org/images/pubmed_linkback.png"
+    assert links[0]['Base'] == "https://escholarship.org/uc/item/"
+
+
+def test_columnar_items_match_item_dicts(rows):
+    items = LinkOutItems.from_items(rows)
+    output = io.BytesIO()
+    with linkout_xml.LinkOutWriter(output) as writer:
+        writer.write_rendered(items.render(), len(items))
+
+    assert output.getvalue() == render(linkout_xml.item_links(rows))
+
+
+# Each page must match itself rendered whole, stay within the byte limit
+# (unless it's a single link) and the link limit, and the pages must cover
+# every row in order.
+@pytest.mark.parametrize('max_links_per_page, max_links', [
+    (None, None),
+    (1000, None),
+    (None, 777),
+    (0, None),
+])
+def test_paginated_pages_match_whole_pages(rows, max_links_per_page, max_links):
+    link_bytes = len(linkout_xml.render_links(linkout_xml.item_links(rows[:1])))
+    if max_links_per_page is None:
+        max_bytes = linkout_xml.default_max_file_bytes
+    else:
+        max_bytes = max(linkout_xml.file_overhead_bytes + link_bytes * max_links_per_page, 1)
+
+    paged_rows = []
+    for page, rendered_links in linkout_xml.paginate_items(rows, max_bytes, max_links):
+        output = io.BytesIO()
+        with linkout_xml.LinkOutWriter(output) as writer:
+            writer.write_rendered(rendered_links, len(page))
+
+        assert output.getvalue() == render(linkout_xml.item_links(page))
+        assert len(output.getvalue()) <= max_bytes or len(page) == 1
+        assert not max_links or len(page) <= max_links
+        paged_rows.extend(page)
+
+    assert paged_rows == rows
@@ -0,0 +1,107 @@
+import pytest
+
+import linkout_db
+import reconcile_pubmed_items as reconcile
+
+
+def elements_item(eschol_id, pubmed_id, ucpms_id=1):
+    return {'ucpms_id': ucpms_id, 'eschol_id': eschol_id, 'pubmed_id': pubmed_id}
+
+
+def logged_item(item_id, eschol_id, pubmed_id, ucpms_id=1,
+                pubmed_filename="2026-01-01_eschol_linkout_resource_00000.xml",
+                submitted="2026-01-01 00:00:00"):
+    return {'id': item_id, 'ucpms_id': ucpms_id, 'eschol_id': eschol_id, 'pubmed_id': pubmed_id,
+            'pubmed_filename': pubmed_filename, 'submitted': submitted}
+
+
+def merge(elements_items, logged_items):
+    return [
+        (action, (elements or {}).get('eschol_id'), (logged or {}).get('id'))
+        for action, elements, logged in reconcile.merge_by_eschol_id(
+            iter(elements_items), iter(logged_items))]
+
+
+# =========================
+def test_merge_finds_adds_changes_and_deletes():
+    elements_items = [
+        elements_item('qt000000a1', 101),
+        elements_item('qt000000b2', 102),
+        elements_item('qt000000b2', 999),  # duplicate, the first one is kept
+        elements_item('qt000000c3', 103),
+        elements_item('qt000000e5', 105),
+        elements_item('qt000000f6', 106),  # after the logged side runs out
+        elements_item('qt000000g7', 107)]
+    logged_items = [
+        logged_item(1, 'qt000000b2', '102'),
+        logged_item(2, 'qt000000c3', 555),
+        logged_item(3, 'qt000000c3', 556),  # duplicate
+        logged_item(4, 'qt000000d4', 104),
+        logged_item(5, 'qt000000d5', 104, ucpms_id=None),  # from eScholarship, kept
+        logged_item(6, 'qt000000e5', 105)]
+
+    assert merge(elements_items, logged_items) == [
+        ('add', 'qt000000a1', None),
+        ('change', 'qt000000c3', 2),
+        ('delete', None, 4),
+        ('add', 'qt000000f6', None),
+        ('add', 'qt000000g7', None)]
+
+
+def test_merge_with_one_side_empty():
+    assert merge([elements_item('qt000000a1', 101)], []) == [('add', 'qt000000a1', None)]
+    assert merge([], [logged_item(1, 'qt000000a1', 101)]) == [('delete', None, 1)]
+    assert merge([], []) == []
+
+
+def test_merge_stops_on_out_of_order_ids():
+    with pytest.raises(RuntimeError, match="aren't ordered"):
+        merge([elements_item('qt000000b2', 102), elements_item('qt000000a1', 101)], [])
+
+
+# Pending rows are fixed in the logging DB; only submitted rows with no
+# real file name are skipped.
+def test_pending_rows_are_applied_not_skipped(monkeypatch):
+    pending = logged_item(1, 'qt000000a1', 101, pubmed_filename=None, submitted=None)
+    batch_loaded = logged_item(2, 'qt000000b2', 102, pubmed_filename=None)
+    wildcard = logged_item(3, 'qt000000c3', 103, pubmed_filename="2020-01-01_eschol_linkout_resource_*")
+    in_file = logged_item(4, 'qt000000d4', 104)
+    pending_delete = logged_item(5, 'qt000000e5', 105, pubmed_filename=None, submitted=None)
+
+    delta = reconcile.Delta()
+    delta.changes = [
+        (elements_item(item['eschol_id'], 200 + item['id']), item)
+        for item in (pending, batch_loaded, wildcard, in_file)]
+    delta.deletes = [pending_delete]
+
+    assert delta.get_file_edits() == {in_file['pubmed_filename']: {4: 204}}
+    assert [(action, item['id']) for action, elements, item in delta.get_skipped()] == [
+        ('change', 2), ('change', 3)]
+
+    applied = {}
+    monkeypatch.setattr(
+        linkout_db, 'update_pubmed_ids',
+        lambda mysql_conn, item_pubmed_ids: applied.update(changes=item_pubmed_ids))
+    monkeypatch.setattr(
+        linkout_db, 'delete_linkout_items',
+        lambda mysql_conn, item_ids: applied.update(deletes=item_ids))
+
+    class FakeIdCache:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def rebuild(self, mysql_conn):
+            applied['cache_rebuilt'] = True
+
+    monkeypatch.setattr(reconcile, 'SubmittedIdCache', FakeIdCache)
+
+    reconcile.apply_delta(None, delta, uploaded_files=set())
+    assert applied == {'changes': {1: 201}, 'deletes': [5], 'cache_rebuilt': True}
+
+    applied.clear()
+    delta.deletes = []
+    reconcile.apply_delta(None, delta, uploaded_files={in_file['pubmed_filename']})
+    assert applied == {'changes': {1: 201, 4: 204}}
@@ -0,0 +1,46 @@
+import os
+import pathlib
+import types
+
+import pytest
+
+import resubmit_full_pubmed_items as resubmit
+from linkout_items import LinkOutItems
+
+
+def render_files(rows, output_dir, workers, max_file_bytes):
+    args = types.SimpleNamespace(max_file_bytes=max_file_bytes, max_links=None)
+    item_pages = resubmit.paginate(LinkOutItems.from_items(rows), args)
+    os.makedirs(output_dir)
+    files, file_item_id_ranges = resubmit.create_submission_files(
+        item_pages, str(output_dir), "resource", workers=workers, verify_serial=True)
+    return {os.path.basename(f): pathlib.Path(f).read_bytes() for f in files}, file_item_id_ranges
+
+
+# Pages cut by rendered size arrive pre-rendered; fixed pages are
+# rendered by the workers themselves.
+@pytest.mark.parametrize('max_file_bytes', [20000, 0])
+def test_parallel_files_match_serial_files(rows, tmp_path, monkeypatch, max_file_bytes):
+    monkeypatch.setattr(resubmit, 'page_size', 150)
+
+    serial_files, serial_ranges = render_files(rows, tmp_path / "serial", 1, max_file_bytes)
+    parallel_files, parallel_ranges = render_files(rows, tmp_path / "parallel", 2, max_file_bytes)
+
+    assert len(serial_files) > 4
+    assert parallel_files == serial_files
+    assert parallel_ranges == serial_ranges
+
+
+def test_verify_serial_catches_changed_bytes(rows, tmp_path):
+    page = LinkOutItems.from_items(rows[:10])
+    file_name = str(tmp_path / "page.xml")
+    resubmit.write_submission_file(page, file_name)
+    resubmit.verify_page_matches_serial(page, file_name)
+
+    with open(file_name, 'rb') as f:
+        content = f.read()
+    with open(file_name, 'wb') as f:
+        f.write(content.replace(b'<Link>', b'<Link >', 1))
+
+    with pytest.raises(RuntimeError):
+        resubmit.verify_page_matches_serial(page, file_name)